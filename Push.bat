@@ -1,6 +1,10 @@
 @echo off
 cd /d "%~dp0"
-git add .
+REM Publish cac manifest output con ton dong (chi stage dung cac file output da ghi nhan)
+python -m utils.publisher
+REM Chi stage cac file da duoc track va tai nguyen dung chung, khong quet toan bo OutputImage
+git add -u
+git add config.json mockup watermark fonts
 git commit -m "Update PC"
 git push origin main --force
-pause
\ No newline at end of file
+pause
@@ -15,6 +15,6 @@ REM Lấy thư mục hiện tại của file .bat
 cd /d "%~dp0"
 
 REM Chạy module Python
-python -m ktbcreator.main
+python -m ktbcreator.main %*
 
 pause
\ No newline at end of file
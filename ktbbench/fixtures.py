@@ -0,0 +1,144 @@
+# ktbbench/fixtures.py
+"""
+Dữ liệu giả cho benchmark ktbimage:
+- Ảnh sản phẩm tổng hợp (nền trắng/đen + design ngẫu nhiên trong vùng crop), sinh trước và giữ trong RAM.
+- Server HTTP cục bộ phục vụ các ảnh đó với độ trễ và tỉ lệ lỗi cấu hình được
+  (cố định theo đường dẫn + seed nên mỗi lần chạy giống hệt nhau).
+- Cây thư mục `imagecrawler` giả: imagecrawler.log và domain/<domain>.txt.
+"""
+import os
+import time
+import random
+import hashlib
+import threading
+from io import BytesIO
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from PIL import Image, ImageDraw
+
+PRODUCT_SUFFIX = "-shirt.jpg"
+DESIGN_BOX = (0.25, 0.2, 0.5, 0.55)  # x, y, w, h theo tỉ lệ kích thước ảnh
+
+
+def design_coords(width, height):
+    x, y, w, h = DESIGN_BOX
+    return {"x": int(width * x), "y": int(height * y), "w": int(width * w), "h": int(height * h)}
+
+
+def render_product_image(name, width, height, seed=0):
+    """Ảnh áo giả: nền trơn, design gồm vài hình khối màu ngẫu nhiên (khác nhau theo tên để pHash không trùng)."""
+    rng = random.Random(f"{seed}:{name}")
+    is_white = rng.random() < 0.5
+    background = (255, 255, 255) if is_white else (0, 0, 0)
+    img = Image.new("RGB", (width, height), background)
+    draw = ImageDraw.Draw(img)
+    box = design_coords(width, height)
+    left, top = box["x"] + box["w"] // 10, box["y"] + box["h"] // 10
+    right, bottom = box["x"] + box["w"] * 9 // 10, box["y"] + box["h"] * 9 // 10
+    for _ in range(rng.randint(6, 14)):
+        x0, x1 = sorted(rng.randint(left, right) for _ in range(2))
+        y0, y1 = sorted(rng.randint(top, bottom) for _ in range(2))
+        color = tuple(rng.randint(40, 215) for _ in range(3))
+        shape = rng.choice((draw.rectangle, draw.ellipse))
+        shape([x0, y0, x1 + 1, y1 + 1], fill=color)
+    buffer = BytesIO()
+    img.save(buffer, format="JPEG", quality=90)
+    return buffer.getvalue()
+
+
+def build_image_set(domains, images_per_domain, width, height, seed=0):
+    """{'/<domain>/<name>': bytes JPEG} cho toàn bộ URL của benchmark."""
+    images = {}
+    for domain in domains:
+        for index in range(images_per_domain):
+            name = f"bench-design-{index:04d}{PRODUCT_SUFFIX}"
+            images[f"/{domain}/{name}"] = render_product_image(f"{domain}/{name}", width, height, seed)
+    return images
+
+
+# --- SERVER HTTP ---
+
+class FixtureServer:
+    """
+    Server ảnh cục bộ chạy ở luồng nền.
+    latency_ms/jitter_ms: độ trễ trước khi trả lời; error_rate: tỉ lệ URL luôn trả 503.
+    """
+
+    def __init__(self, images, latency_ms=0, jitter_ms=0, error_rate=0.0, seed=0):
+        self.images = images
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.seed = seed
+        self.request_count = 0
+        self.error_count = 0
+        self._lock = threading.Lock()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                server._handle(self)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self._httpd.daemon_threads = True
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+
+    @property
+    def base_url(self):
+        host, port = self._httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def _fails(self, path):
+        digest = hashlib.sha1(f"{self.seed}:{path}".encode("utf-8")).digest()
+        return int.from_bytes(digest[:4], "big") / 2 ** 32 < self.error_rate
+
+    def _handle(self, request):
+        path = request.path.split("?", 1)[0]
+        delay = self.latency_ms + (random.uniform(-self.jitter_ms, self.jitter_ms) if self.jitter_ms else 0)
+        if delay > 0:
+            time.sleep(delay / 1000)
+        data = self.images.get(path)
+        failed = data is None or self._fails(path)
+        with self._lock:
+            self.request_count += 1
+            self.error_count += failed
+        if failed:
+            request.send_response(404 if data is None else 503)
+            request.send_header("Content-Length", "0")
+            request.end_headers()
+            return
+        request.send_response(200)
+        request.send_header("Content-Type", "image/jpeg")
+        request.send_header("Content-Length", str(len(data)))
+        request.end_headers()
+        request.wfile.write(data)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+
+# --- CÂY IMAGECRAWLER GIẢ ---
+
+def write_crawler_tree(crawler_dir, base_url, images):
+    """Ghi domain/<domain>.txt và imagecrawler.log đúng định dạng ktbimage đang đọc."""
+    urls_by_domain = {}
+    for path in images:
+        domain = path.strip("/").split("/", 1)[0]
+        urls_by_domain.setdefault(domain, []).append(f"{base_url}{path}")
+
+    domain_dir = os.path.join(crawler_dir, "domain")
+    os.makedirs(domain_dir, exist_ok=True)
+    for domain, urls in urls_by_domain.items():
+        with open(os.path.join(domain_dir, f"{domain}.txt"), "w", encoding="utf-8") as f:
+            f.write("\n".join(urls) + "\n")
+    with open(os.path.join(crawler_dir, "imagecrawler.log"), "w", encoding="utf-8") as f:
+        for domain, urls in urls_by_domain.items():
+            f.write(f"{domain}: {len(urls)} New Images\n")
+    return urls_by_domain
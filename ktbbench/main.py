@@ -0,0 +1,252 @@
+# ktbbench/main.py
+"""
+Benchmark end-to-end cho ktbimage, không gọi tới store thật.
+1. Sinh ảnh sản phẩm giả và phục vụ qua server HTTP cục bộ (độ trễ / tỉ lệ lỗi cấu hình được).
+2. Tạo cây `imagecrawler` giả (log + domain/*.txt) cạnh một BẢN SAO của dự án trong thư mục tạm,
+   với config benchmark (domain giả dùng các mockup set thật).
+3. Chạy ktbimage.main trong bản sao (ktbbench/runner.py), git/Telegram bị tắt.
+4. Báo cáo ảnh/giây, output/giây, độ trễ p50/p95 mỗi ảnh, RSS đỉnh; so sánh với baseline.
+Cách dùng: python -m ktbbench.main [--images 40 --domains 3 --latency-ms 50 ...] [--save-baseline]
+"""
+import os
+import sys
+import json
+import shutil
+import zipfile
+import argparse
+import tempfile
+import platform
+import subprocess
+from datetime import datetime
+import pytz
+
+from ktbbench.fixtures import (
+    PRODUCT_SUFFIX,
+    build_image_set,
+    design_coords,
+    write_crawler_tree,
+    FixtureServer
+)
+
+# --- Cấu hình đường dẫn ---
+TOOL_DIR = os.path.dirname(os.path.abspath(__file__))
+PROJECT_ROOT = os.path.dirname(TOOL_DIR)
+CONFIG_FILE = os.path.join(PROJECT_ROOT, "config.json")
+MOCKUP_DIR = os.path.join(PROJECT_ROOT, "mockup")
+BASELINE_FILE = os.path.join(TOOL_DIR, "baseline.json")
+RESULTS_DIR = os.path.join(PROJECT_ROOT, ".bench")
+
+# Không copy lịch sử git, bí mật, output cũ và trạng thái của các lần chạy thật sang bản sao
+COPY_IGNORE = shutil.ignore_patterns(
+    ".git", ".env", "__pycache__", "OutputImage", "InputImage", "Deferred", "*.log",
+    ".publish", ".outbox", ".metrics", ".dedup", ".crawler_index", ".output_index", ".bench", ".profile", ".events", ".spool", "Preview"
+)
+
+# Chỉ số so sánh với baseline: (tên, True nếu càng lớn càng tốt)
+COMPARED_METRICS = [
+    ("images_per_sec", True), ("outputs_per_sec", True),
+    ("latency_p50", False), ("latency_p95", False), ("peak_rss_mb", False),
+]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark end-to-end cho ktbimage với server ảnh cục bộ.")
+    parser.add_argument("--domains", type=int, default=3, help="Số domain giả")
+    parser.add_argument("--images", type=int, default=40, help="Số ảnh mỗi domain")
+    parser.add_argument("--size", default="1200x1500", help="Kích thước ảnh sản phẩm, dạng RONGxCAO")
+    parser.add_argument("--latency-ms", type=float, default=50, help="Độ trễ trung bình của server (ms)")
+    parser.add_argument("--jitter-ms", type=float, default=20, help="Dao động độ trễ (± ms)")
+    parser.add_argument("--error-rate", type=float, default=0.02, help="Tỉ lệ URL trả lỗi 503 (0-1)")
+    parser.add_argument("--mockups", default="", help="Các mockup set dùng cho domain giả, cách nhau bởi dấu phẩy (mặc định: 2 set đầu tiên có đủ file)")
+    parser.add_argument("--workers", type=int, help="Ghi đè ktbimage_scheduler.max_workers")
+    parser.add_argument("--seed", type=int, default=0, help="Seed sinh ảnh và chọn URL lỗi")
+    parser.add_argument("--baseline", default=BASELINE_FILE, help="File baseline để so sánh")
+    parser.add_argument("--save-baseline", action="store_true", help="Ghi kết quả lần này làm baseline")
+    parser.add_argument("--max-regression", type=float, help="Thoát với mã 1 nếu chỉ số nào kém hơn baseline quá N%%")
+    parser.add_argument("--keep", action="store_true", help="Giữ lại thư mục tạm (bản sao dự án, output, log)")
+    parser.add_argument("--verbose", action="store_true", help="In log của ktbimage ra console")
+    return parser.parse_args()
+
+
+# --- CHUẨN BỊ ---
+
+def usable_mockup_sets(mockup_sets_config):
+    """Các mockup set có đủ file ảnh cho cả nền trắng và đen."""
+    usable = []
+    for name, mockup_config in mockup_sets_config.items():
+        files = []
+        for color_key in ("white", "black"):
+            value = mockup_config.get(color_key)
+            files += [option.get("file") for option in value] if isinstance(value, list) else [value]
+        if files and all(f and os.path.exists(os.path.join(MOCKUP_DIR, f)) for f in files):
+            usable.append(name)
+    return usable
+
+
+def build_bench_config(configs, domains, mockup_names, width, height, workers=None):
+    bench_config = json.loads(json.dumps(configs))
+    defaults = bench_config.setdefault("defaults", {})
+    defaults.setdefault("ktbimage_scheduler", {})["time_budget_minutes"] = 0
+    if workers:
+        defaults["ktbimage_scheduler"]["max_workers"] = workers
+    defaults.setdefault("output_index", {})["persistent"] = False
+    bench_config["domains"] = {
+        domain: {"rules": [{
+            "pattern": PRODUCT_SUFFIX, "action": "generate",
+            "mockup_sets_to_use": mockup_names, "coords": design_coords(width, height)
+        }]}
+        for domain in domains
+    }
+    return bench_config
+
+
+def count_outputs(output_dir):
+    """Số ảnh output: số file trong các zip và trong các thư mục output."""
+    total = 0
+    if not os.path.isdir(output_dir):
+        return 0
+    for entry in os.listdir(output_dir):
+        path = os.path.join(output_dir, entry)
+        if entry.endswith(".zip"):
+            with zipfile.ZipFile(path) as zf:
+                total += len(zf.namelist())
+        elif os.path.isdir(path):
+            total += len(os.listdir(path))
+    return total
+
+
+def percentile(values, pct):
+    """Percentile kiểu nearest-rank."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(1, -(-len(ordered) * pct // 100))
+    return ordered[int(rank) - 1]
+
+
+# --- BÁO CÁO ---
+
+def compare_with_baseline(results, baseline, max_regression=None):
+    """In chênh lệch so với baseline; trả về danh sách chỉ số bị tụt quá max_regression%."""
+    if baseline.get("params") != results["params"]:
+        print("⚠️ Tham số benchmark khác baseline, so sánh chỉ mang tính tham khảo.")
+    regressions = []
+    print(f"\n--- So sánh với baseline ({baseline.get('timestamp', '?')}) ---")
+    for name, higher_is_better in COMPARED_METRICS:
+        old, new = baseline.get("metrics", {}).get(name), results["metrics"].get(name)
+        if not old or new is None:
+            continue
+        change = (new - old) / old * 100
+        worse_by = -change if higher_is_better else change
+        marker = "🔴" if max_regression is not None and worse_by > max_regression else ("🟢" if worse_by <= 0 else "🟡")
+        print(f"  {marker} {name:<16} {old:>10.3f} -> {new:>10.3f} ({change:+.1f}%)")
+        if max_regression is not None and worse_by > max_regression:
+            regressions.append(name)
+    return regressions
+
+
+def print_results(results):
+    metrics = results["metrics"]
+    print("\n--- 📊 KẾT QUẢ BENCHMARK ktbimage ---")
+    print(f"  URL: {metrics['urls']} | tải lỗi: {metrics['failed_downloads']} | output: {metrics['outputs']}")
+    print(f"  Thời gian: {metrics['wall_seconds']:.2f}s")
+    print(f"  Ảnh/giây: {metrics['images_per_sec']:.3f} | Output/giây: {metrics['outputs_per_sec']:.3f}")
+    if metrics["latency_p50"] is not None:
+        print(f"  Độ trễ mỗi ảnh: p50 {metrics['latency_p50']:.3f}s | p95 {metrics['latency_p95']:.3f}s")
+    print(f"  RSS đỉnh: {metrics['peak_rss_mb']:.0f} MB")
+
+
+# --- HÀM MAIN ---
+
+def main():
+    args = parse_args()
+    width, height = (int(v) for v in args.size.lower().split("x"))
+    with open(CONFIG_FILE, "r", encoding="utf-8") as f:
+        configs = json.load(f)
+
+    available = usable_mockup_sets(configs.get("mockup_sets", {}))
+    mockup_names = [m.strip() for m in args.mockups.split(",") if m.strip()] or available[:2]
+    missing = [m for m in mockup_names if m not in available]
+    if not mockup_names or missing:
+        print(f"❌ Lỗi: Mockup set không dùng được: {missing or 'không có set nào đủ file'}."); sys.exit(2)
+
+    domains = [f"bench{index}.test" for index in range(args.domains)]
+    print(f"🧪 Sinh {args.domains * args.images} ảnh {width}x{height} cho {args.domains} domain, mockup: {', '.join(mockup_names)}")
+    images = build_image_set(domains, args.images, width, height, args.seed)
+
+    workspace = tempfile.mkdtemp(prefix="ktbbench-")
+    project_copy = os.path.join(workspace, os.path.basename(PROJECT_ROOT))
+    crawler_dir = os.path.join(workspace, "imagecrawler")
+    server = FixtureServer(images, args.latency_ms, args.jitter_ms, args.error_rate, args.seed).start()
+    try:
+        print(f"📁 Bản sao dự án: {project_copy}")
+        shutil.copytree(PROJECT_ROOT, project_copy, ignore=COPY_IGNORE)
+        with open(os.path.join(project_copy, "config.json"), "w", encoding="utf-8") as f:
+            json.dump(build_bench_config(configs, domains, mockup_names, width, height, args.workers), f, ensure_ascii=False, indent=2)
+        write_crawler_tree(crawler_dir, server.base_url, images)
+
+        stats_path = os.path.join(workspace, "stats.json")
+        run_log_path = os.path.join(workspace, "ktbimage.out")
+        print(f"🚀 Chạy ktbimage (server {server.base_url}, trễ {args.latency_ms:.0f}±{args.jitter_ms:.0f}ms, lỗi {args.error_rate:.0%})...")
+        env = dict(os.environ, PYTHONUTF8="1")
+        env.pop("TELEGRAM_BOT_TOKEN", None)
+        with open(run_log_path, "w", encoding="utf-8") as run_log:
+            completed = subprocess.run(
+                [sys.executable, "-m", "ktbbench.runner", stats_path], cwd=project_copy, env=env,
+                stdout=None if args.verbose else run_log, stderr=subprocess.STDOUT
+            )
+        if completed.returncode != 0 or not os.path.exists(stats_path):
+            print(f"❌ ktbimage kết thúc với mã {completed.returncode}. Xem log: {run_log_path}")
+            args.keep = True
+            sys.exit(1)
+
+        with open(stats_path, "r", encoding="utf-8") as f:
+            stats = json.load(f)
+        outputs = count_outputs(os.path.join(project_copy, "ktbimage", "OutputImage"))
+        wall = stats["wall_seconds"]
+        results = {
+            "timestamp": datetime.now(pytz.timezone('Asia/Ho_Chi_Minh')).strftime('%Y-%m-%d %H:%M:%S'),
+            "params": {
+                "domains": args.domains, "images": args.images, "size": f"{width}x{height}",
+                "latency_ms": args.latency_ms, "jitter_ms": args.jitter_ms, "error_rate": args.error_rate,
+                "mockups": mockup_names, "workers": args.workers, "seed": args.seed,
+            },
+            "environment": {"python": platform.python_version(), "platform": platform.platform(), "cpus": os.cpu_count()},
+            "metrics": {
+                "urls": len(images), "failed_downloads": stats["failed_downloads"], "outputs": outputs,
+                "wall_seconds": wall,
+                "images_per_sec": stats["downloads"] / wall if wall else 0.0,
+                "outputs_per_sec": outputs / wall if wall else 0.0,
+                "latency_p50": percentile(stats["latencies"], 50),
+                "latency_p95": percentile(stats["latencies"], 95),
+                "peak_rss_mb": stats["peak_rss_mb"],
+            },
+        }
+    finally:
+        server.stop()
+        if args.keep:
+            print(f"📁 Giữ lại thư mục benchmark: {workspace}")
+        else:
+            shutil.rmtree(workspace, ignore_errors=True)
+
+    print_results(results)
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    result_path = os.path.join(RESULTS_DIR, f"ktbimage.{datetime.now().strftime('%Y%m%d_%H%M%S')}.json")
+    with open(result_path, "w", encoding="utf-8") as f:
+        json.dump(results, f, ensure_ascii=False, indent=2)
+    print(f"💾 Đã lưu kết quả: {result_path}")
+
+    regressions = []
+    if os.path.exists(args.baseline):
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            regressions = compare_with_baseline(results, json.load(f), args.max_regression)
+    if args.save_baseline:
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+        print(f"📌 Đã ghi baseline: {args.baseline}")
+    if regressions:
+        print(f"❌ Tụt hiệu năng quá {args.max_regression}%: {', '.join(regressions)}"); sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
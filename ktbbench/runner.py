@@ -0,0 +1,96 @@
+# ktbbench/runner.py
+"""
+Chạy ktbimage.main trong bản sao dự án do ktbbench/main.py tạo ra và ghi số đo ra file JSON.
+- Độ trễ mỗi ảnh: từ lúc bắt đầu tải ảnh tới lúc bắt đầu ảnh kế tiếp của cùng domain
+  (hoặc lúc domain kết thúc), tức là gồm tải + tách nền + ghép mockup + encode.
+- Git publish và Telegram bị thay bằng bản rỗng: benchmark không được commit/push hay gửi tin.
+Cách dùng (cwd = thư mục gốc bản sao): python -m ktbbench.runner <stats.json>
+"""
+import sys
+import json
+import time
+import threading
+
+import ktbimage.main as ktbimage_main
+from utils.memory_governor import PeakTracker
+
+
+class _NullPublisher:
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def publish(self, *args, **kwargs):
+        pass
+
+    def close(self):
+        pass
+
+    def flush(self):
+        pass
+
+
+class _ImageClock:
+    """Ghi thời điểm bắt đầu từng ảnh theo luồng (mỗi domain chạy tuần tự trong một luồng)."""
+
+    def __init__(self):
+        self.latencies = []
+        self.downloads = 0
+        self.failed_downloads = 0
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def _close_current(self, now):
+        started = getattr(self._local, "started", None)
+        if started is not None:
+            with self._lock:
+                self.latencies.append(now - started)
+        self._local.started = None
+
+    def wrap_download(self, download):
+        def timed_download(*args, **kwargs):
+            now = time.perf_counter()
+            self._close_current(now)
+            self._local.started = now
+            image = download(*args, **kwargs)
+            with self._lock:
+                self.downloads += 1
+                self.failed_downloads += image is None
+            return image
+        return timed_download
+
+    def wrap_domain(self, process_domain):
+        def timed_domain(*args, **kwargs):
+            try:
+                return process_domain(*args, **kwargs)
+            finally:
+                self._close_current(time.perf_counter())
+        return timed_domain
+
+
+def main():
+    stats_path = sys.argv[1]
+    clock = _ImageClock()
+    ktbimage_main.download_image = clock.wrap_download(ktbimage_main.download_image)
+    ktbimage_main.process_domain = clock.wrap_domain(ktbimage_main.process_domain)
+    ktbimage_main.OutputPublisher = _NullPublisher
+    ktbimage_main.send_telegram_log_locally = lambda: None
+    ktbimage_main.send_telegram_summary = lambda *args, **kwargs: None
+
+    tracker = PeakTracker().start()
+    started = time.perf_counter()
+    ktbimage_main.main()
+    wall_seconds = time.perf_counter() - started
+    tracker.stop()
+
+    with open(stats_path, "w", encoding="utf-8") as f:
+        json.dump({
+            "wall_seconds": wall_seconds,
+            "latencies": clock.latencies,
+            "downloads": clock.downloads,
+            "failed_downloads": clock.failed_downloads,
+            "peak_rss_mb": tracker.peak_mb,
+        }, f)
+
+
+if __name__ == "__main__":
+    main()
@@ -6,26 +6,33 @@ import random
 from datetime import datetime
 import pytz
 from PIL import Image
-from io import BytesIO
 from dotenv import load_dotenv
 
 # Import các hàm từ module dùng chung
 from utils.image_processing import (
     remove_background,
     remove_background_advanced,
-    trim_transparent_background,
-    apply_mockup,
-    add_watermark,
-    rotate_image,
-    crop_by_coords
+    resolve_bg_profile,
+    plan_bg_tiling,
+    DesignGeometry,
+    crop_by_coords,
+    ImageBuffer
 )
 from utils.file_io import (
     load_config,
-    create_exif_data,
     update_total_image_count,
     find_mockup_image,
     send_telegram_summary
 )
+from utils.memory_governor import MemoryGovernor, estimate_bg_removal_bytes
+from utils.asset_store import AssetStore
+from utils.profiler import ImageProfiler
+from utils.event_log import EventLog, read_events, say, DEBUG, WARNING
+from utils.metrics_exporter import PipelineMetrics
+from utils.output_encoder import OutputRenderer, print_size_distribution
+from utils.metadata import MetadataBuilder
+from utils.output_index import OutputIndex
+from utils.preview import preview_and_confirm, preview_scale, preview_refine_size, scale_box, downscale, add_mockup_tiles
 
 # --- Cấu hình đường dẫn ---
 TOOL_DIR = os.path.dirname(os.path.abspath(__file__))
@@ -41,6 +48,7 @@ FONT_FILE = os.path.join(PROJECT_ROOT, "fonts", "verdanab.ttf")
 # Đường dẫn riêng của tool
 INPUT_DIR = os.path.join(TOOL_DIR, "InputImage")
 OUTPUT_DIR = os.path.join(TOOL_DIR, "OutputImage")
+PREVIEW_DIR = os.path.join(TOOL_DIR, "Preview")
 TOTAL_IMAGE_FILE = os.path.join(PROJECT_ROOT, "TotalImage.txt")
 
 # --- CÁC HÀM HỖ TRỢ RIÊNG CỦA TOOL NÀY ---
@@ -111,6 +119,34 @@ def cleanup_input_directory(directory, processed_files_list):
     else:
         print("  -> 💾 Đã giữ lại các file trong InputImage.")
 
+def render_preview(sheet, preview, images, crop_coords, angle, color_threshold, bg_profile, selected_mockups, mockup_cache, asset_store):
+    """Chạy vài ảnh đầu qua đúng các bước của lần chạy thật ở độ phân giải thấp và ghép vào mọi mockup đã chọn."""
+    for image_filename in images[:preview["images"]]:
+        with Image.open(os.path.join(INPUT_DIR, image_filename)) as img:
+            full_width = img.width
+            scale = preview_scale((crop_coords['w'], crop_coords['h']) if crop_coords else img.size, preview["max_side"])
+            # File JPEG lớn: giải mã thẳng ở cỡ nhỏ (theo bội 1/2, 1/4, 1/8), tọa độ crop được quy đổi theo
+            img.draft(img.mode, (max(1, round(img.width * scale)), max(1, round(img.height * scale))))
+            draft_scale = img.width / full_width
+            img_rgba = ImageBuffer.from_pil(img)
+
+        processed_img = crop_by_coords(img_rgba, scale_box(crop_coords, draft_scale)) if crop_coords else img_rgba
+        if not processed_img:
+            print(f"  - ⚠️ [{image_filename}] Lỗi khi crop."); continue
+        try:
+            pixel = processed_img.getpixel((1, processed_img.height - 2))
+            is_white = sum(pixel[:3]) / 3 > color_threshold
+        except IndexError:
+            is_white = True
+
+        refine_size = preview_refine_size(bg_profile["refine_size"], scale, preview["max_side"])
+        bg_removed = remove_background_advanced(downscale(processed_img, scale / draft_scale), refine_size=refine_size, sharpen=bg_profile["sharpen"], keying=bg_profile["keying"])
+        design_geometry = DesignGeometry.from_image(bg_removed, angle)
+        if design_geometry is None:
+            print(f"  - ⚠️ [{image_filename}] Ảnh trống sau khi xử lý."); continue
+        sheet.new_row(image_filename)
+        add_mockup_tiles(sheet, design_geometry, is_white, mockup_cache, selected_mockups, asset_store, MOCKUP_DIR, WATERMARK_DIR, FONT_FILE)
+
 # --- HÀM MAIN CHÍNH ---
 def main():
     print("🚀 Bắt đầu quy trình của KTB-CREATOR...")
@@ -124,137 +160,173 @@ def main():
     defaults = configs.get("defaults", {})
     mockup_sets_config = configs.get("mockup_sets", {})
     exif_defaults = defaults.get("exif_defaults", {})
+    metadata_builder = MetadataBuilder(exif_defaults, defaults.get("metadata", {}))
     output_format = defaults.get("global_output_format", "webp")
     color_threshold = defaults.get("color_detection_threshold", 128)
+    governor = MemoryGovernor(defaults.get("memory_budget_mb"))
+    asset_store = AssetStore(defaults.get("shared_assets", True))
+    profiler = ImageProfiler.from_argv("ktbcreator")
+    events = EventLog.from_argv("ktbcreator", defaults.get("event_log"))
+    metrics = PipelineMetrics.for_tool("ktbcreator", defaults.get("metrics_export"))
+    events.add_listener(metrics.observe)
+    output_index = OutputIndex.from_config("ktbcreator", defaults.get("output_index"))
+    output_renderer = OutputRenderer(
+        output_index, asset_store, metadata_builder, "WEBP" if output_format == "webp" else "JPEG", f".{output_format}",
+        WATERMARK_DIR, FONT_FILE
+    )
+    bg_profile_name, bg_profile = resolve_bg_profile(defaults, "ktbcreator")
+    print(f"🧪 Hồ sơ tách nền: {bg_profile_name}")
     
     images_to_process = [f for f in os.listdir(INPUT_DIR) if os.path.isfile(os.path.join(INPUT_DIR, f)) and not f.startswith('.')]
     if not images_to_process:
         print("✅ Không có ảnh mới để xử lý."); return
 
-    crop_coords, global_angle, selected_mockups = get_creator_inputs(mockup_sets_config)
-
-    # --- LOGIC MỚI: CHỌN NGẪU NHIÊN VÀ CACHE MOCKUP (Hỗ trợ cả config cũ và mới) ---
-    print("\n🎲 Đang chọn ngẫu nhiên 1 phiên bản cho mỗi mockup set...")
-    mockup_cache = {}
-    for name in selected_mockups:
-        mockup_config = mockup_sets_config.get(name)
-        if not mockup_config: continue
-
-        # Logic thông minh cho mockup TRẮNG
-        white_value = mockup_config.get("white")
-        selected_white = None
-        if isinstance(white_value, list) and white_value:
-            selected_white = random.choice(white_value)
-            print(f"  - Mockup '{name}' (trắng): đã chọn file ngẫu nhiên '{selected_white['file']}'")
-        elif isinstance(white_value, str): # Hỗ trợ cấu trúc cũ
-            selected_white = {"file": white_value, "coords": mockup_config.get("coords")}
-            print(f"  - Mockup '{name}' (trắng): sử dụng file config cũ '{selected_white['file']}'")
-
-        # Logic thông minh cho mockup ĐEN
-        black_value = mockup_config.get("black")
-        selected_black = None
-        if isinstance(black_value, list) and black_value:
-            selected_black = random.choice(black_value)
-            print(f"  - Mockup '{name}' (đen): đã chọn file ngẫu nhiên '{selected_black['file']}'")
-        elif isinstance(black_value, str): # Hỗ trợ cấu trúc cũ
-            selected_black = {"file": black_value, "coords": mockup_config.get("coords")}
-            print(f"  - Mockup '{name}' (đen): sử dụng file config cũ '{selected_black['file']}'")
-
-        mockup_cache[name] = {
-            "white_data": selected_white, "black_data": selected_black,
-            "watermark_text": mockup_config.get("watermark_text"),
-            "title_prefix_to_add": mockup_config.get("title_prefix_to_add", ""),
-            "title_suffix_to_add": mockup_config.get("title_suffix_to_add", "")
-        }
-    print("-" * 50)
+    # Nhập cài đặt -> (tuỳ chọn) xem trước vài ảnh đầu ở độ phân giải thấp -> nhập lại nếu chưa đúng
+    while True:
+        crop_coords, global_angle, selected_mockups = get_creator_inputs(mockup_sets_config)
+
+        # --- LOGIC MỚI: CHỌN NGẪU NHIÊN VÀ CACHE MOCKUP (Hỗ trợ cả config cũ và mới) ---
+        print("\n🎲 Đang chọn ngẫu nhiên 1 phiên bản cho mỗi mockup set...")
+        mockup_cache = {}
+        for name in selected_mockups:
+            mockup_config = mockup_sets_config.get(name)
+            if not mockup_config: continue
+
+            # Logic thông minh cho mockup TRẮNG
+            white_value = mockup_config.get("white")
+            selected_white = None
+            if isinstance(white_value, list) and white_value:
+                selected_white = random.choice(white_value)
+                print(f"  - Mockup '{name}' (trắng): đã chọn file ngẫu nhiên '{selected_white['file']}'")
+            elif isinstance(white_value, str): # Hỗ trợ cấu trúc cũ
+                selected_white = {"file": white_value, "coords": mockup_config.get("coords")}
+                print(f"  - Mockup '{name}' (trắng): sử dụng file config cũ '{selected_white['file']}'")
+
+            # Logic thông minh cho mockup ĐEN
+            black_value = mockup_config.get("black")
+            selected_black = None
+            if isinstance(black_value, list) and black_value:
+                selected_black = random.choice(black_value)
+                print(f"  - Mockup '{name}' (đen): đã chọn file ngẫu nhiên '{selected_black['file']}'")
+            elif isinstance(black_value, str): # Hỗ trợ cấu trúc cũ
+                selected_black = {"file": black_value, "coords": mockup_config.get("coords")}
+                print(f"  - Mockup '{name}' (đen): sử dụng file config cũ '{selected_black['file']}'")
+
+            mockup_cache[name] = {
+                "white_data": selected_white, "black_data": selected_black,
+                "watermark_text": mockup_config.get("watermark_text"),
+                "title_prefix_to_add": mockup_config.get("title_prefix_to_add", ""),
+                "title_suffix_to_add": mockup_config.get("title_suffix_to_add", ""),
+                "variants": mockup_config.get("variants"),
+                "encoding": mockup_config.get("encoding", defaults.get("output_encoding"))
+            }
+        print("-" * 50)
+
+        render = lambda sheet, preview: render_preview(sheet, preview, images_to_process, crop_coords, global_angle, color_threshold,
+                                                       bg_profile, selected_mockups, mockup_cache, asset_store)
+        if preview_and_confirm(render, PREVIEW_DIR, "ktbcreator", defaults.get("preview"), FONT_FILE):
+            break
     
     images_for_output = {}
+    designs_for_output = {}  # số design theo mockup (tên thư mục), khác số file khi có variants
     total_processed_this_run = {}
     run_timestamp = datetime.now(pytz.timezone('Asia/Ho_Chi_Minh')).strftime('%Y%m%d_%H%M%S')
 
     for image_filename in images_to_process:
-        print(f"\n--- 🖼️  Đang xử lý: {image_filename} ---")
-        try:
-            with Image.open(os.path.join(INPUT_DIR, image_filename)) as img:
-                img_rgba = img.convert("RGBA")
-
-                if crop_coords:
-                    processed_img = crop_by_coords(img_rgba, crop_coords)
-                    if not processed_img:
-                        print("  - ⚠️ Lỗi khi crop, bỏ qua ảnh này."); continue
-                else:
-                    processed_img = img_rgba
-
-                try:
-                    pixel = processed_img.getpixel((1, processed_img.height - 2))
-                    is_white = sum(pixel[:3]) / 3 > color_threshold
-                except IndexError:
-                    is_white = True
+        say(f"\n--- 🖼️  Đang xử lý: {image_filename} ---", DEBUG)
+        image_path = os.path.join(INPUT_DIR, image_filename)
+        with governor.track_peak(image_filename), profiler.image(image_filename, source=image_path), \
+                events.image(image_filename, image_path, profiler=profiler, bg_profile=bg_profile_name) as record:
+            try:
+                with Image.open(os.path.join(INPUT_DIR, image_filename)) as img:
+                    img_rgba = ImageBuffer.from_pil(img)
+
+                    if crop_coords:
+                        processed_img = crop_by_coords(img_rgba, crop_coords)
+                        if not processed_img:
+                            record.skip("crop_failed", "Lỗi khi crop, bỏ qua ảnh này."); continue
+                    else:
+                        processed_img = img_rgba
+
+                    try:
+                        pixel = processed_img.getpixel((1, processed_img.height - 2))
+                        is_white = sum(pixel[:3]) / 3 > color_threshold
+                    except IndexError:
+                        is_white = True
+                    record.set(color="white" if is_white else "black")
                 
-                # bg_removed = remove_background(processed_img)
-                bg_removed = remove_background_advanced(processed_img)
+                    # bg_removed = remove_background(processed_img)
+                    img_w, img_h = processed_img.size
+                    # File in 6000-10000px: tách nền theo dải song song, bộ nhớ tạm tỉ lệ với dải
+                    tiling = plan_bg_tiling(img_w, img_h, defaults.get("bg_tiling"))
+                    if tiling:
+                        record.set(bg_tile_rows=tiling["tile_rows"])
+                    refine_size = governor.plan_refine_size(img_w, img_h, bg_profile["refine_size"], tiling)
+                    with governor.reserve(estimate_bg_removal_bytes(img_w, img_h, refine_size, tiling), image_filename), record.stage("bg_removal"):
+                        bg_removed = remove_background_advanced(processed_img, refine_size=refine_size, sharpen=bg_profile["sharpen"], keying=bg_profile["keying"], tiling=tiling)
 
-                final_design = rotate_image(bg_removed, global_angle)
-                trimmed_img = trim_transparent_background(final_design)
-                if not trimmed_img:
-                    print("  - ⚠️ Cảnh báo: Ảnh trống sau khi xử lý, bỏ qua."); continue
+                    # Xoay + trim + resize vào khung được gộp thành một phép affine, lấy mẫu một lần cho mỗi kích thước khung
+                    design_geometry = DesignGeometry.from_image(bg_removed, global_angle)
+                    if design_geometry is None:
+                        record.skip("empty_design", "Ảnh trống sau khi xử lý, bỏ qua."); continue
 
-                for mockup_name in selected_mockups:
-                    cached_data = mockup_cache.get(mockup_name)
-                    if not cached_data: continue
+                    for mockup_name in selected_mockups:
+                        cached_data = mockup_cache.get(mockup_name)
+                        if not cached_data: continue
                     
-                    print(f"  - Áp dụng mockup: '{mockup_name}'")
+                        say(f"  - Áp dụng mockup: '{mockup_name}'", DEBUG)
                     
-                    mockup_data_to_use = cached_data['white_data'] if is_white else cached_data['black_data']
-                    if not mockup_data_to_use:
-                        print(f"    - ⚠️ Cảnh báo: Không có tùy chọn mockup cho màu này. Bỏ qua."); continue
+                        mockup_data_to_use = cached_data['white_data'] if is_white else cached_data['black_data']
+                        if not mockup_data_to_use:
+                            say(f"    - ⚠️ Cảnh báo: Không có tùy chọn mockup cho màu này ({mockup_name}). Bỏ qua.", WARNING); continue
 
-                    mockup_filename = mockup_data_to_use.get('file')
-                    mockup_coords = mockup_data_to_use.get('coords')
+                        mockup_filename = mockup_data_to_use.get('file')
+                        mockup_coords = mockup_data_to_use.get('coords')
 
-                    if not mockup_filename or not mockup_coords:
-                        print(f"    - ⚠️ Cảnh báo: Cấu hình mockup cho '{mockup_name}' bị lỗi. Bỏ qua."); continue
+                        if not mockup_filename or not mockup_coords:
+                            say(f"    - ⚠️ Cảnh báo: Cấu hình mockup cho '{mockup_name}' bị lỗi. Bỏ qua.", WARNING); continue
 
-                    mockup_path = os.path.join(MOCKUP_DIR, mockup_filename)
-                    if not os.path.exists(mockup_path):
-                        print(f"    - ⚠️ Cảnh báo: Không tìm thấy file ảnh mockup '{mockup_filename}'. Bỏ qua."); continue
+                        mockup_path = os.path.join(MOCKUP_DIR, mockup_filename)
+                        if not os.path.exists(mockup_path):
+                            say(f"    - ⚠️ Cảnh báo: Không tìm thấy file ảnh mockup '{mockup_filename}'. Bỏ qua.", WARNING); continue
                     
-                    with Image.open(mockup_path) as mockup_img:
-                        final_mockup = apply_mockup(trimmed_img, mockup_img, mockup_coords)
-                        watermark_desc = cached_data.get("watermark_text")
-                        final_mockup_with_wm = add_watermark(final_mockup, watermark_desc, WATERMARK_DIR, FONT_FILE)
-                        
+                        # Tiêu đề của output (OutputRenderer giữ chỗ tên file trước khi render)
                         prefix = cached_data.get("title_prefix_to_add", "")
                         suffix = cached_data.get("title_suffix_to_add", "")
                         base_name = os.path.splitext(image_filename)[0].replace('-', ' ').replace('_', ' ')
-                        
+                    
                         final_filename_base = f"{prefix} {base_name} {suffix}".strip().replace('  ', ' ')
-                        ext = f".{output_format}"
-                        
+                        ext = output_renderer.ext
+                    
                         MAX_FILENAME_LENGTH = 120
                         if len(final_filename_base) + len(ext) > MAX_FILENAME_LENGTH:
                             allowed_base_length = MAX_FILENAME_LENGTH - len(ext)
                             final_filename_base = final_filename_base[:allowed_base_length]
-                        
-                        final_filename = f"{final_filename_base}{ext}"
-
-                        image_to_save = final_mockup_with_wm.convert('RGB')
-                        exif_bytes = create_exif_data(mockup_name, final_filename, exif_defaults)
-                        
-                        img_byte_arr = BytesIO()
-                        save_format = "WEBP" if output_format == "webp" else "JPEG"
-                        image_to_save.save(img_byte_arr, format=save_format, quality=90, exif=exif_bytes)
-                        
-                        images_for_output.setdefault(mockup_name, []).append((final_filename, img_byte_arr.getvalue()))
+                    
+                        output_scope = mockup_name
+
+                        final_filename, encoded_files, identical_to = output_renderer.render(
+                            record, design_geometry, mockup_name, mockup_path, mockup_coords, final_filename_base, image_filename,
+                            output_scope, cached_data.get("variants"), cached_data.get("encoding"), cached_data.get("watermark_text")
+                        )
+                        if encoded_files is None:
+                            continue
+
+                        images_for_output.setdefault(mockup_name, []).extend(encoded_files)
+                        designs_for_output[mockup_name] = designs_for_output.get(mockup_name, 0) + 1
                         total_processed_this_run[mockup_name] = total_processed_this_run.get(mockup_name, 0) + 1
         
-        except Exception as e:
-            print(f"❌ Lỗi nghiêm trọng khi xử lý file {image_filename}: {e}")
+            except Exception as e:
+                record.fail(f"Lỗi nghiêm trọng khi xử lý file {image_filename}: {e}")
+
+    events.close()
+    metrics.write_textfile()
+    print_size_distribution(read_events(events.path))
 
     if images_for_output:
         print("\n--- 💾 Bắt đầu lưu ảnh vào các thư mục ---")
         for mockup_name, image_list in images_for_output.items():
-            output_subdir_name = f"{mockup_name}.{run_timestamp}.{len(image_list)}"
+            output_subdir_name = f"{mockup_name}.{run_timestamp}.{designs_for_output[mockup_name]}"
             output_path = os.path.join(OUTPUT_DIR, output_subdir_name)
             os.makedirs(output_path, exist_ok=True)
             print(f"  - Đang tạo và lưu {len(image_list)} ảnh vào: {output_path}")
@@ -262,6 +334,10 @@ def main():
                 with open(os.path.join(output_path, filename), 'wb') as f:
                     f.write(data)
 
+    output_index.close()
+    profiler.close()
+    asset_store.close()
+
     if images_to_process:
         cleanup_input_directory(INPUT_DIR, images_to_process)
 
@@ -3,27 +3,24 @@
 import os
 import json
 import re
+import time
+import argparse
+from contextlib import nullcontext
 from datetime import datetime
 import pytz
-from io import BytesIO
 import zipfile
 from dotenv import load_dotenv
-import requests
-import subprocess
 import random
-from PIL import Image
 
 # Import các hàm từ module dùng chung
 from utils.image_processing import (
     download_image,
     erase_areas,
     crop_by_coords,
-    rotate_image,
     remove_background,
     remove_background_advanced,
-    trim_transparent_background,
-    apply_mockup,
-    add_watermark,
+    resolve_bg_profile,
+    DesignGeometry,
     determine_color_from_sample_area
 )
 from utils.file_io import (
@@ -31,12 +28,24 @@ from utils.file_io import (
     clean_title,
     pre_clean_filename,
     should_globally_skip,
-    _convert_to_gps,
-    create_exif_data,
     update_total_image_count,
     find_mockup_image,
     send_telegram_summary
 )
+from utils.publisher import OutputPublisher, RunManifest
+from utils.notifier import enqueue_telegram_message
+from utils.memory_governor import MemoryGovernor, PeakTracker, estimate_bg_removal_bytes
+from utils.dedup_index import DedupIndex, phash, DEFAULT_MAX_DISTANCE
+from utils.output_index import OutputIndex
+from utils.asset_store import AssetStore
+from utils.download_spool import DownloadSpool
+from utils.profiler import ImageProfiler
+from utils.event_log import EventLog, read_events, say, DEBUG, WARNING, ERROR
+from utils.metrics_exporter import PipelineMetrics
+from utils.output_encoder import OutputRenderer, size_distribution, format_size_distribution
+from utils.metadata import MetadataBuilder
+from utils.crawler_input import CrawlerInput
+from utils.scheduler import RunDeadline, DeferredQueue, merge_url_lists, run_jobs
 
 # --- Cấu hình đường dẫn ---
 TOOL_DIR = os.path.dirname(os.path.abspath(__file__))
@@ -59,6 +68,11 @@ FONT_FILE = os.path.join(PROJECT_ROOT, "fonts", "verdanab.ttf")
 OUTPUT_DIR = os.path.join(TOOL_DIR, "OutputImage")
 TOTAL_IMAGE_FILE = os.path.join(PROJECT_ROOT, "TotalImage.txt")
 GENERATE_LOG_FILE = os.path.join(TOOL_DIR, "generate.log")
+MEMORY_LOG_FILE = os.path.join(TOOL_DIR, "memory.log")
+DEFERRED_DIR = os.path.join(TOOL_DIR, "Deferred")
+
+# Lý do skip (trong sự kiện 'image') -> dòng tương ứng của generate.log; các lý do khác tính là Action/Error
+SKIP_REASON_COUNTERS = {"global": 'skipped_global', "no_rule": 'skipped_no_rule', "duplicate": 'skipped_duplicate'}
 
 # Tải biến môi trường từ file .env ở thư mục gốc
 load_dotenv(dotenv_path=os.path.join(PROJECT_ROOT, '.env'))
@@ -76,42 +90,51 @@ def cleanup_old_zips():
             except Exception as e:
                 print(f"   - Lỗi khi xóa {filename}: {e}")
 
-def commit_and_push_changes_locally():
-    print("🚀 Bắt đầu quá trình commit và push...")
-    try:
-        os.chdir(PROJECT_ROOT)
-        subprocess.run(['git', 'add', '.'], check=True)
-        status_output = subprocess.run(['git', 'status', '--porcelain'], capture_output=True, text=True).stdout.strip()
-        if not status_output:
-            print("✅ Không có thay đổi mới để commit.")
-            return False
-        commit_message = f"Update via ktbimage tool - {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}"
-        subprocess.run(['git', 'commit', '-m', commit_message], check=True)
-        current_branch = subprocess.run(['git', 'rev-parse', '--abbrev-ref', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
-        print(f"   - Commit thành công. Bắt đầu push lên nhánh '{current_branch}'...")
-        subprocess.run(['git', 'push', 'origin', current_branch], check=True)
-        print("✅ Push thành công.")
-        return True
-    except (subprocess.CalledProcessError, FileNotFoundError) as e:
-        print(f"❌ Lỗi trong quá trình Git: {e}")
-        return False
-
 def send_telegram_log_locally():
-    token, chat_id = os.getenv("TELEGRAM_BOT_TOKEN"), os.getenv("TELEGRAM_CHAT_ID")
-    if not token or not chat_id:
-        print("⚠️ Cảnh báo: Không tìm thấy biến môi trường Telegram. Bỏ qua việc gửi log.")
-        return
+    """Đưa nội dung generate.log vào outbox Telegram (worker nền sẽ gửi)."""
     try:
         with open(GENERATE_LOG_FILE, "r", encoding="utf-8") as f:
-            log_content = f.read() + "\nPush successful (from PC)."
-        print("✈️  Đang gửi log tới Telegram...")
-        requests.post(f"https://api.telegram.org/bot{token}/sendMessage", data={'chat_id': chat_id, 'text': log_content}, timeout=10)
-        print("✅ Gửi log tới Telegram thành công.")
-    except Exception as e:
-        print(f"❌ Lỗi khi gửi log tới Telegram: {e}")
-
-def write_log(urls_summary):
-    """Ghi log chi tiết, bao gồm các loại skip khác nhau."""
+            log_content = f.read() + "\nOutputs queued for push (from PC)."
+    except OSError as e:
+        print(f"❌ Lỗi khi đọc log để gửi Telegram: {e}"); return
+    print("✈️  Đang đưa log vào outbox Telegram...")
+    enqueue_telegram_message(log_content, chat_id_env="TELEGRAM_CHAT_ID")
+
+def summarize_events(run_events):
+    """Dựng số liệu từng domain (cho generate.log, memory.log, TotalImage) từ các sự kiện của lần chạy."""
+    urls_summary, finished_domains = {}, set()
+    for event in run_events:
+        domain = event.get("domain")
+        if domain is None:
+            continue
+        counts = urls_summary.setdefault(domain, {
+            'processed_by_mockup': {}, 'skipped_global': 0, 'skipped_no_rule': 0, 'skipped_by_rule': 0,
+            'skipped_duplicate': 0, 'reused_identical': 0, 'deferred': 0, 'skip_file_generated': None,
+            'total_to_process': 0, 'memory_peaks': [], 'process_peak_mb': None
+        })
+        if event["event"] == "domain":
+            finished_domains.add(domain)
+            counts['deferred'] = event.get("deferred", 0)
+            counts['skip_file_generated'] = event.get("skip_file")
+            counts['total_to_process'] = event.get("total_to_process", 0)
+            counts['memory_peaks'] = event.get("memory_peaks", [])
+            counts['process_peak_mb'] = event.get("process_peak_mb")
+        elif event["event"] == "image":
+            if event["status"] == "skipped":
+                counts[SKIP_REASON_COUNTERS.get(event.get("skip_reason"), 'skipped_by_rule')] += 1
+            elif event["status"] == "error":
+                counts['skipped_by_rule'] += 1
+            for output in event.get("outputs", []):
+                if output.get("identical_to"):
+                    counts['reused_identical'] += 1
+                    if output["file"] == output["identical_to"]:
+                        continue  # cùng nguồn render lại: không có file mới
+                counts['processed_by_mockup'][output["mockup"]] = counts['processed_by_mockup'].get(output["mockup"], 0) + 1
+    # Domain không có sự kiện 'domain' (không có rule hoặc worker lỗi) không được báo cáo
+    return {domain: counts for domain, counts in urls_summary.items() if domain in finished_domains}
+
+def write_log(urls_summary, size_stats=None):
+    """Ghi log chi tiết, bao gồm các loại skip khác nhau và phân bố kích thước output theo mockup set."""
     with open(GENERATE_LOG_FILE, "w", encoding="utf-8") as f:
         f.write(f"--- Summary of Last Generation ---\n")
         f.write(f"Timestamp: {datetime.now(pytz.timezone('Asia/Ho_Chi_Minh')).strftime('%Y-%m-%d %H:%M:%S')} +07\n\n")
@@ -126,101 +149,128 @@ def write_log(urls_summary):
                 f.write(f"  - Skipped (Global): {counts['skipped_global']} images\n")
                 f.write(f"  - Skipped (No Rule): {counts['skipped_no_rule']} images\n")
                 f.write(f"  - Skipped (Action/Error): {counts['skipped_by_rule']} images\n")
+                if counts.get('skipped_duplicate'):
+                    f.write(f"  - Skipped (Duplicate): {counts['skipped_duplicate']} images\n")
+                if counts.get('reused_identical'):
+                    f.write(f"  - Reused Encode (Identical Output): {counts['reused_identical']} images\n")
+                if counts.get('deferred'):
+                    f.write(f"  - Deferred (Time Budget): {counts['deferred']} URLs\n")
                 if counts.get('skip_file_generated'):
                     f.write(f"  - Skip File -> ktbimg: {counts['skip_file_generated']}\n")
+                if counts.get('memory_peaks'):
+                    peak_name, peak_mb = max(counts['memory_peaks'], key=lambda item: item[1])
+                    f.write(f"  - Peak RSS: {peak_mb:.0f} MB ({peak_name})\n")
+                elif counts.get('process_peak_mb'):
+                    f.write(f"  - Peak RSS (process-wide, concurrent domains): {counts['process_peak_mb']:.0f} MB\n")
                 f.write(f"  - Total Processed URLs: {counts['total_to_process']}\n\n")
+        if size_stats:
+            f.write("Output Sizes:\n")
+            f.write("\n".join(format_size_distribution(size_stats)) + "\n")
     print(f"✅ Generation summary saved to {GENERATE_LOG_FILE}")
 
-
-# --- HÀM MAIN CHÍNH (PHIÊN BẢN HOÀN CHỈNH CUỐI CÙNG) ---
-def main():
-    configs = load_config(CONFIG_FILE)
-    if not configs: return
-    
-    defaults = configs.get("defaults", {})
-    output_mode = defaults.get("ktbimage_output_mode", "zip")
+def write_memory_log(urls_summary):
+    """
+    Ghi RSS đỉnh của từng ảnh trong lần chạy (chi tiết cho generate.log).
+    Khi nhiều domain chạy song song, RSS là của cả process nên chỉ ghi một dòng cho mỗi domain.
+    """
+    with open(MEMORY_LOG_FILE, "w", encoding="utf-8") as f:
+        f.write("--- Peak RSS per image ---\n")
+        f.write(f"Timestamp: {datetime.now(pytz.timezone('Asia/Ho_Chi_Minh')).strftime('%Y-%m-%d %H:%M:%S')} +07\n\n")
+        for domain, counts in sorted(urls_summary.items()):
+            for filename, peak_mb in counts.get('memory_peaks', []):
+                f.write(f"{domain}\t{filename}\t{peak_mb:.1f} MB\n")
+            if not counts.get('memory_peaks') and counts.get('process_peak_mb'):
+                f.write(f"{domain}\t(process-wide, concurrent domains)\t{counts['process_peak_mb']:.1f} MB\n")
+
+
+# --- XỬ LÝ MỘT DOMAIN (CHẠY TRONG WORKER CỦA SCHEDULER) ---
+def process_domain(domain, urls_to_process, run_context, deadline):
+    """
+    Xử lý toàn bộ URL của một domain (chạy trong một worker của scheduler).
+    Mỗi URL được ghi thành một sự kiện 'image', cuối domain là một sự kiện 'domain'
+    (generate.log được dựng lại từ các sự kiện này). Trả về danh sách URL bị hoãn:
+    khi hết thời gian của lần chạy, các URL chưa xử lý được trả về để xử lý lần sau.
+    """
+    defaults = run_context["defaults"]
+    output_mode = run_context["output_mode"]
+    domains_configs = run_context["domains_configs"]
+    mockup_sets_config = run_context["mockup_sets_config"]
+    output_renderer = run_context["output_renderer"]
+    title_clean_keywords = run_context["title_clean_keywords"]
+    global_skip_keywords = run_context["global_skip_keywords"]
+    publisher = run_context["publisher"]
+    governor = run_context["governor"]
+    asset_store = run_context["asset_store"]
+    dedup_index = run_context["dedup_index"]
+    profiler = run_context["profiler"]
+    events = run_context["events"]
+    download_spool = run_context["download_spool"]
+
+    say(f"\n==================== Bắt đầu xử lý {len(urls_to_process)} ảnh mới từ domain: {domain} ====================")
+    asset_store.refresh()  # nạp lại mockup nào đã bị sửa trong lúc chạy
     
-    print(f"🚀 Bắt đầu quy trình tự động của KTB-IMAGE (Chế độ Output mặc định: {output_mode.upper()})")
-
-    if not os.path.exists(OUTPUT_DIR): os.makedirs(OUTPUT_DIR)
+    domain_config = domains_configs.get(domain, {})
+    output_mode_domain = domain_config.get("output_mode", output_mode)
+    domain_rules = sorted(domain_config.get("rules", []), key=lambda x: len(x.get('pattern', '')), reverse=True)
     
-    #cleanup_old_zips()
+    say(f"  - Chế độ output cho domain này: {output_mode_domain.upper()}", DEBUG)
 
-    domains_configs = configs.get("domains", {})
-    mockup_sets_config = configs.get("mockup_sets", {})
-    exif_defaults = defaults.get("exif_defaults", {})
-    title_clean_keywords = defaults.get("title_clean_keywords", [])
-    global_skip_keywords = defaults.get("global_skip_keywords", [])
-
-    try:
-        with open(CRAWLER_LOG_FILE, 'r', encoding='utf-8') as f:
-            log_content = f.read()
-    except FileNotFoundError:
-        print(f"❌ Lỗi: Không tìm thấy file log tại '{CRAWLER_LOG_FILE}'."); return
-
-    domains_to_process = {p[0].strip(): int(p[1].split()[0]) for l in log_content.splitlines() if "New Images" in l for p in [l.split(":")] if int(p[1].split()[0]) > 0}
+    if not domain_rules:
+        say(f"  - ⚠️ Cảnh báo: Không tìm thấy quy tắc ('rules') cho domain '{domain}'. Bỏ qua.", WARNING); return []
     
-    if not domains_to_process:
-        print("✅ Không có ảnh mới nào được tìm thấy trong log. Kết thúc."); return
-
-    print(f"🔎 Tìm thấy {len(domains_to_process)} domain có ảnh mới.")
-    urls_summary = {}
-    total_processed_this_run = {}
-
-    for domain, new_count in domains_to_process.items():
-        print(f"\n==================== Bắt đầu xử lý {new_count} ảnh mới từ domain: {domain} ====================")
-        
-        domain_config = domains_configs.get(domain, {})
-        output_mode_domain = domain_config.get("output_mode", output_mode)
-        domain_rules = sorted(domain_config.get("rules", []), key=lambda x: len(x.get('pattern', '')), reverse=True)
+    images_for_domain = {}
+    designs_for_domain = {}  # số design theo mockup (tên zip/thư mục), khác số file khi có variants
+    pending_designs = []  # [(design_id, outputs)] chờ zip/thư mục của domain ghi xong
+    skipped_urls_for_domain = []
+    consecutive_error_count, ERROR_THRESHOLD = 0, 5
+    deferred_urls = []
+    # Nhiều worker: RSS của process gồm cả ảnh của domain khác, nên chỉ đo đỉnh cho cả domain thay vì từng ảnh
+    per_image_peaks = run_context["per_image_peaks"]
+    domain_peak = None if per_image_peaks else PeakTracker().start()
+
+    for url_index, url in enumerate(urls_to_process):
+        if deadline.expired():
+            deferred_urls = urls_to_process[url_index:]
+            say(f"  - ⏰ Hết thời gian của lần chạy: hoãn {len(deferred_urls)} URL còn lại của {domain} sang lần sau.", WARNING)
+            break
+
+        filename = os.path.basename(url)
+        label = f"[{domain}] {filename}"
+        say(f"\n--- [{domain}] Đang xử lý: {filename} ---", DEBUG)
         
-        print(f"  - Chế độ output cho domain này: {output_mode_domain.upper()}")
-
-        if not domain_rules:
-            print(f"  - ⚠️ Cảnh báo: Không tìm thấy quy tắc ('rules') cho domain '{domain}'. Bỏ qua."); continue
+        if should_globally_skip(filename, global_skip_keywords):
+            events.skipped(label, url, "global", "Chứa từ khóa skip toàn cục.", domain=domain)
+            continue
         
-        try:
-            with open(os.path.join(CRAWLER_DOMAIN_DIR, f"{domain}.txt"), 'r', encoding='utf-8') as f:
-                urls_to_process = f.read().splitlines()[:new_count]
-        except FileNotFoundError:
-            print(f"  - ❌ Lỗi: Không tìm thấy file URL cho domain {domain}. Bỏ qua."); continue
+        matched_rule = next((r for r in domain_rules if r.get("pattern", "") in filename), None)
         
-        images_for_domain = {}
-        skipped_urls_for_domain = []
-        processed_by_mockup = {}
-        skipped_global_count, skipped_no_rule_count, skipped_by_rule_count = 0, 0, 0
-        consecutive_error_count, ERROR_THRESHOLD = 0, 5
-
-        for url in urls_to_process:
-            filename = os.path.basename(url)
-            print(f"\n--- Đang xử lý: {filename} ---")
-            
-            if should_globally_skip(filename, global_skip_keywords):
-                skipped_global_count += 1
-                continue
-            
-            matched_rule = next((r for r in domain_rules if r.get("pattern", "") in filename), None)
-            
-            if not matched_rule:
-                print("  - ⏩ Bỏ qua: Không có quy tắc phù hợp."); skipped_urls_for_domain.append(url); skipped_no_rule_count += 1; continue
-            if matched_rule.get("action") == "skip":
-                print("  - ⏩ Bỏ qua: Quy tắc có action là 'skip'."); skipped_urls_for_domain.append(url); skipped_by_rule_count += 1; continue
-
+        if not matched_rule:
+            events.skipped(label, url, "no_rule", "Không có quy tắc phù hợp.", domain=domain)
+            skipped_urls_for_domain.append(url); continue
+        if matched_rule.get("action") == "skip":
+            events.skipped(label, url, "rule_action", "Quy tắc có action là 'skip'.", domain=domain, rule=matched_rule.get("pattern"))
+            skipped_urls_for_domain.append(url); continue
+
+        with governor.track_peak(f"{domain}/{filename}") if per_image_peaks else nullcontext(), profiler.image(f"{domain}/{filename}", source=url, rule=matched_rule.get("pattern")), \
+                events.image(label, url, profiler=profiler, domain=domain, rule=matched_rule.get("pattern")) as record:
+            img = None
             try:
-                img = download_image(url)
+                with record.stage("download"):
+                    img = download_image(url, as_buffer=True, keep_source=download_spool is not None)
                 if not img:
+                    record.skip("download_failed", "Không tải được ảnh.")
                     skipped_urls_for_domain.append(url);
                     consecutive_error_count += 1
-                    skipped_by_rule_count += 1
                     if consecutive_error_count >= ERROR_THRESHOLD:
-                        print(f"  - ❌ Lỗi: Đã có {consecutive_error_count} lỗi tải ảnh liên tiếp. Bỏ qua các URL còn lại của domain {domain}.")
+                        say(f"  - ❌ Lỗi: Đã có {consecutive_error_count} lỗi tải ảnh liên tiếp. Bỏ qua các URL còn lại của domain {domain}.", ERROR)
                         break
                     continue
                 consecutive_error_count = 0
-                
+                record.set(download_bytes=img.info.get("download_bytes"))
+            
                 sample_coords = matched_rule.get("color_sample_coords")
                 is_white = True
-                
+            
                 if sample_coords:
                     is_white = determine_color_from_sample_area(img, sample_coords)
                 else:
@@ -233,14 +283,10 @@ def main():
                                 is_white = sum(pixel[:3]) / 3 > 128
                             except IndexError:
                                 is_white = True
-                
+            
                 background_color = (255, 255, 255) if is_white else (0, 0, 0)
-                print(f"  - Màu nền được xác định là: {'Trắng' if is_white else 'Đen'}")
-
-                erase_zones = matched_rule.get("erase_zones")
-                if erase_zones:
-                    print("  - Tẩy watermark bằng màu nền...")
-                    img = erase_areas(img, erase_zones, background_color)
+                record.set(color="white" if is_white else "black")
+                say(f"  - Màu nền được xác định là: {'Trắng' if is_white else 'Đen'}", DEBUG)
 
                 rect_coords = None
                 if is_white and "coords_white" in matched_rule: rect_coords = matched_rule["coords_white"]
@@ -248,148 +294,357 @@ def main():
                 else: rect_coords = matched_rule.get("coords")
 
                 if not rect_coords:
-                    print("  - ⏩ Bỏ qua: Không tìm thấy tọa độ phù hợp."); skipped_urls_for_domain.append(url); skipped_by_rule_count += 1; continue
-                
+                    record.skip("no_coords", "Không tìm thấy tọa độ phù hợp."); skipped_urls_for_domain.append(url); continue
+            
                 angle = matched_rule.get("angle", 0)
                 initial_crop = crop_by_coords(img, rect_coords)
                 if not initial_crop:
-                    skipped_urls_for_domain.append(url); continue
-                
+                    record.skip("crop_failed", "Không crop được ảnh."); skipped_urls_for_domain.append(url); continue
+            
                 if (matched_rule.get("skipWhite") and is_white) or (matched_rule.get("skipBlack") and not is_white):
-                    print("  - ⏩ Bỏ qua theo quy tắc skip màu."); skipped_urls_for_domain.append(url); skipped_by_rule_count += 1; continue
-                
-                bg_removed = remove_background_advanced(initial_crop)
-                final_design = rotate_image(bg_removed, angle)
-                trimmed_img = trim_transparent_background(final_design)
-                if not trimmed_img:
-                    print("  - ⚠️ Cảnh báo: Ảnh trống sau khi xử lý."); skipped_urls_for_domain.append(url); skipped_by_rule_count += 1; continue
-                
+                    record.skip("skip_color", "Bỏ qua theo quy tắc skip màu."); skipped_urls_for_domain.append(url); continue
+
+                # Tẩy watermark ngay trên vùng crop (view của ảnh tải về): chỉ phần zone nằm trong vùng crop
+                erase_zones = matched_rule.get("erase_zones")
+                if erase_zones:
+                    say("  - Tẩy watermark bằng màu nền...", DEBUG)
+                    erase_areas(initial_crop, erase_zones, background_color)
+
+                # Kiểm tra trùng design (pHash) TRƯỚC bước tách nền tốn kém. Chỉ bỏ qua khi design đã có output
+                # cho mọi mockup set của quy tắc này; thiếu set nào thì vẫn render riêng các set còn thiếu.
+                design_hash = None
+                covered_mockups = set()
+                if dedup_index:
+                    design_hash = phash(initial_crop)
+                    duplicate_of = dedup_index.lookup(design_hash, exclude_url=url)
+                    requested_mockups = set(matched_rule.get("mockup_sets_to_use", []))
+                    if duplicate_of and requested_mockups:
+                        covered_mockups = duplicate_of["covered"] & requested_mockups
+                    if covered_mockups:
+                        dedup_index.link_duplicate(duplicate_of, "ktbimage", domain, filename, url)
+                        record.set(duplicate_of=duplicate_of['filename'])
+                        duplicate_desc = f"'{duplicate_of['filename']}' ({duplicate_of['domain']}, lệch {duplicate_of['distance']} bit)"
+                        if covered_mockups == requested_mockups:
+                            record.skip("duplicate", f"Trùng design với {duplicate_desc}.")
+                            continue
+                        record.set(duplicate_mockups=sorted(covered_mockups))
+                        say(f"  - ♻️ Trùng design với {duplicate_desc}: đã có {', '.join(sorted(covered_mockups))}, chỉ render các mockup còn thiếu.", DEBUG)
+            
+                bg_profile_name, bg_profile = resolve_bg_profile(defaults, "ktbimage", domain_config, matched_rule)
+                record.set(bg_profile=bg_profile_name)
+                say(f"  - Hồ sơ tách nền: {bg_profile_name}", DEBUG)
+                crop_w, crop_h = initial_crop.size
+                refine_size = governor.plan_refine_size(crop_w, crop_h, bg_profile["refine_size"])
+                with governor.reserve(estimate_bg_removal_bytes(crop_w, crop_h, refine_size), filename), record.stage("bg_removal"):
+                    bg_removed = remove_background_advanced(initial_crop, refine_size=refine_size, sharpen=bg_profile["sharpen"], keying=bg_profile["keying"])
+                # Xoay + trim + resize vào khung được gộp thành một phép affine, lấy mẫu một lần cho mỗi kích thước khung
+                design_geometry = DesignGeometry.from_image(bg_removed, angle)
+                if design_geometry is None:
+                    record.skip("empty_design", "Ảnh trống sau khi xử lý."); skipped_urls_for_domain.append(url); continue
+            
                 mockup_names_to_use = matched_rule.get("mockup_sets_to_use", [])
                 if not mockup_names_to_use:
-                    print("  - ⏩ Bỏ qua: Quy tắc không chỉ định 'mockup_sets_to_use'."); skipped_urls_for_domain.append(url); skipped_by_rule_count += 1; continue
+                    record.skip("no_mockup_sets", "Quy tắc không chỉ định 'mockup_sets_to_use'."); skipped_urls_for_domain.append(url); continue
+
+                outputs_for_design = {}
 
                 for mockup_name in mockup_names_to_use:
+                    if mockup_name in covered_mockups:
+                        continue  # đã có output từ bản trùng
                     mockup_config = mockup_sets_config.get(mockup_name)
                     if not mockup_config: 
-                        print(f"  - ⚠️ Cảnh báo: Không tìm thấy config cho mockup '{mockup_name}'.")
+                        say(f"  - ⚠️ Cảnh báo: Không tìm thấy config cho mockup '{mockup_name}'.", WARNING)
                         continue
-                    
+                
                     # <<< KHỐI MÃ ĐƯỢC CẬP NHẬT ĐỂ SỬ DỤNG find_mockup_image ĐÚNG CÁCH >>>
-                    
+                
                     # 1. Gọi hàm find_mockup_image với `mockup_config` (dict) thay vì `mockup_name` (string)
                     #    Hàm sẽ trả về cả đường dẫn và tọa độ tương ứng.
                     mockup_path, mockup_coords = find_mockup_image(MOCKUP_DIR, mockup_config, is_white)
-                    
+                
                     # 2. Kiểm tra cả hai giá trị trả về
                     if not mockup_path or not mockup_coords:
                         # find_mockup_image đã tự in cảnh báo, nên ở đây chỉ cần bỏ qua
                         continue
-                    
-                    with Image.open(mockup_path) as mockup_img:
-                        # 3. Sử dụng `mockup_coords` lấy được từ hàm để áp dụng mockup
-                        #    Điều này đảm bảo tọa độ luôn đúng với file mockup được chọn ngẫu nhiên.
-                        final_mockup = apply_mockup(trimmed_img, mockup_img, mockup_coords)
-                        
-                        watermark_desc = mockup_config.get("watermark_text")
-                        final_mockup_with_wm = add_watermark(final_mockup, watermark_desc, WATERMARK_DIR, FONT_FILE)
-
-                    # <<< KẾT THÚC KHỐI MÃ CẬP NHẬT >>>
-
+                
                     base_filename = os.path.splitext(filename)[0]
                     pre_clean_pattern = matched_rule.get("pre_clean_regex")
                     if pre_clean_pattern:
-                        print(f"  - Áp dụng pre_clean_regex: '{pre_clean_pattern}'")
+                        say(f"  - Áp dụng pre_clean_regex: '{pre_clean_pattern}'", DEBUG)
                         base_filename = pre_clean_filename(base_filename, pre_clean_pattern)
-                    
+                
                     cleaned_title = clean_title(base_filename, title_clean_keywords)
                     prefix = mockup_config.get("title_prefix_to_add", "")
                     suffix = mockup_config.get("title_suffix_to_add", "")
                     final_filename_base = f"{prefix} {cleaned_title} {suffix}".strip().replace('  ', ' ')
-                    save_format, ext = ("WEBP", ".webp") if defaults.get("global_output_format", "webp") == "webp" else ("JPEG", ".jpg")
-                    final_filename = f"{final_filename_base}{ext}"
-                    
-                    image_to_save = final_mockup_with_wm.convert('RGB')
-                    exif_bytes = create_exif_data(mockup_name, final_filename, exif_defaults)
-                    
-                    img_byte_arr = BytesIO()
-                    image_to_save.save(img_byte_arr, format=save_format, quality=90, exif=exif_bytes)
-                    
-                    images_for_domain.setdefault(mockup_name, []).append((final_filename, img_byte_arr.getvalue()))
-                    processed_by_mockup[mockup_name] = processed_by_mockup.get(mockup_name, 0) + 1
-            
+
+                    # 3. Sử dụng `mockup_coords` lấy được từ hàm để áp dụng mockup
+                    #    Điều này đảm bảo tọa độ luôn đúng với file mockup được chọn ngẫu nhiên.
+                    final_filename, encoded_files, identical_to = output_renderer.render(
+                        record, design_geometry, mockup_name, mockup_path, mockup_coords, final_filename_base, url,
+                        f"{domain}/{mockup_name}", mockup_config.get("variants"),
+                        mockup_config.get("encoding", defaults.get("output_encoding")), mockup_config.get("watermark_text")
+                    )
+                    # <<< KẾT THÚC KHỐI MÃ CẬP NHẬT >>>
+                    if encoded_files is None:
+                        outputs_for_design[mockup_name] = identical_to
+                        continue
+
+                    images_for_domain.setdefault(mockup_name, []).extend(encoded_files)
+                    designs_for_domain[mockup_name] = designs_for_domain.get(mockup_name, 0) + 1
+                    outputs_for_design[mockup_name] = final_filename
+
+                # Chỉ đưa design vào chỉ mục khi đã render thành công ít nhất một mockup; mục ở trạng thái chờ
+                # và chỉ được chốt sau khi zip/thư mục chứa output của nó đã ghi xong
+                if dedup_index and design_hash is not None and outputs_for_design:
+                    design_id = dedup_index.add(design_hash, "ktbimage", domain, filename, url, outputs_for_design, pending=True)
+                    pending_designs.append((design_id, outputs_for_design))
+        
             except Exception as e:
-                print(f"  - ❌ Lỗi nghiêm trọng khi xử lý ảnh {url}: {e}")
+                record.fail(f"Lỗi nghiêm trọng khi xử lý ảnh {url}: {e}")
                 skipped_urls_for_domain.append(url)
-                skipped_by_rule_count += 1
-
-        # LƯU KẾT QUẢ CỦA DOMAIN
-        if images_for_domain:
-            if output_mode_domain == 'zip':
-                for mockup_name, image_list in images_for_domain.items():
-                    now = datetime.now(pytz.timezone('Asia/Ho_Chi_Minh'))
-                    
-                    # 1. Tạo tên file TẠM và tên file CUỐI CÙNG
-                    base_filename = f"{mockup_name}.{domain.split('.')[0]}.{now.strftime('%Y%m%d_%H%M%S')}.{len(image_list)}"
-                    zip_filename_final = f"{base_filename}.zip"
-                    zip_filename_tmp = f"{base_filename}.zip.tmp" # <-- File tạm
-                    
-                    zip_path_final = os.path.join(OUTPUT_DIR, zip_filename_final)
-                    zip_path_tmp = os.path.join(OUTPUT_DIR, zip_filename_tmp) # <-- Đường dẫn tạm
-                    
-                    print(f"📦 Đang tạo file zip TẠM THỜI: {zip_filename_tmp}")
-                    try:
-                        # 2. Ghi vào file TẠM
-                        with zipfile.ZipFile(zip_path_tmp, 'w') as zf:
-                            for filename, data in image_list: zf.writestr(filename, data)
-                        
-                        # 3. Đổi tên (thao tác nguyên tử)
-                        os.rename(zip_path_tmp, zip_path_final)
-                        print(f"✅ Đã hoàn thành và đổi tên file: {zip_filename_final}")
+            finally:
+                # URL đã tải nhưng bị đẩy sang file skip: giữ bytes gốc trong spool để ktbimg khỏi tải lại
+                if download_spool is not None and img is not None and skipped_urls_for_domain[-1:] == [url]:
+                    if download_spool.put(url, img.info.get("source_bytes"), domain=domain):
+                        record.set(spooled=True)
+
+    if domain_peak:
+        domain_peak.stop()
+
+    # LƯU KẾT QUẢ CỦA DOMAIN
+    domain_manifest = RunManifest("ktbimage")
+    written_mockups = set()
+    if images_for_domain:
+        if output_mode_domain == 'zip':
+            for mockup_name, image_list in images_for_domain.items():
+                now = datetime.now(pytz.timezone('Asia/Ho_Chi_Minh'))
+                
+                # 1. Tạo tên file TẠM và tên file CUỐI CÙNG
+                base_filename = f"{mockup_name}.{domain.split('.')[0]}.{now.strftime('%Y%m%d_%H%M%S')}.{designs_for_domain[mockup_name]}"
+                zip_filename_final = f"{base_filename}.zip"
+                zip_filename_tmp = f"{base_filename}.zip.tmp" # <-- File tạm
+                
+                zip_path_final = os.path.join(OUTPUT_DIR, zip_filename_final)
+                zip_path_tmp = os.path.join(OUTPUT_DIR, zip_filename_tmp) # <-- Đường dẫn tạm
+                
+                say(f"📦 Đang tạo file zip TẠM THỜI: {zip_filename_tmp}", DEBUG)
+                try:
+                    # 2. Ghi vào file TẠM
+                    with zipfile.ZipFile(zip_path_tmp, 'w') as zf:
+                        for filename, data in image_list: zf.writestr(filename, data)
                     
-                    except Exception as e:
-                        print(f"❌ Lỗi khi tạo file zip {zip_filename_tmp}: {e}")
-                        # Dọn dẹp file tạm nếu có lỗi
-                        if os.path.exists(zip_path_tmp):
-                            os.remove(zip_path_tmp)
-            elif output_mode_domain == 'folder':
-                for mockup_name, image_list in images_for_domain.items():
-                    now = datetime.now(pytz.timezone('Asia/Ho_Chi_Minh'))
-                    folder_name = f"{mockup_name}.{domain.split('.')[0]}.{now.strftime('%Y%m%d_%H%M%S')}.{len(image_list)}"
-                    folder_path = os.path.join(OUTPUT_DIR, folder_name)
+                    # 3. Đổi tên (thao tác nguyên tử)
+                    os.rename(zip_path_tmp, zip_path_final)
+                    domain_manifest.add(zip_path_final)
+                    written_mockups.add(mockup_name)
+                    say(f"✅ Đã hoàn thành và đổi tên file: {zip_filename_final}")
+                
+                except Exception as e:
+                    say(f"❌ Lỗi khi tạo file zip {zip_filename_tmp}: {e}", ERROR)
+                    # Dọn dẹp file tạm nếu có lỗi
+                    if os.path.exists(zip_path_tmp):
+                        os.remove(zip_path_tmp)
+        elif output_mode_domain == 'folder':
+            for mockup_name, image_list in images_for_domain.items():
+                now = datetime.now(pytz.timezone('Asia/Ho_Chi_Minh'))
+                folder_name = f"{mockup_name}.{domain.split('.')[0]}.{now.strftime('%Y%m%d_%H%M%S')}.{designs_for_domain[mockup_name]}"
+                folder_path = os.path.join(OUTPUT_DIR, folder_name)
+                say(f"📁 Đang tạo thư mục và lưu ảnh: {folder_path}")
+                try:
                     os.makedirs(folder_path, exist_ok=True)
-                    print(f"📁 Đang tạo thư mục và lưu ảnh: {folder_path}")
                     for filename, data in image_list:
                         with open(os.path.join(folder_path, filename), 'wb') as f: f.write(data)
+                        domain_manifest.add(os.path.join(folder_path, filename))
+                    written_mockups.add(mockup_name)
+                except OSError as e:
+                    say(f"❌ Lỗi khi ghi thư mục {folder_name}: {e}", ERROR)
+
+    # Bytes giữ lại để dùng cho ảnh giống hệt chỉ cần trong domain này
+    output_renderer.output_index.forget_contents(f"{domain}/")
+
+    # Chốt các design chờ trong chỉ mục trùng: chỉ giữ output đã thực sự ghi ra
+    for design_id, outputs in pending_designs:
+        written_outputs = {name: output for name, output in outputs.items() if name in written_mockups}
+        if written_outputs:
+            dedup_index.commit(design_id, written_outputs)
+        else:
+            dedup_index.discard([design_id])
+
+    # GHI FILE SKIP
+    skip_file_name = None
+    if skipped_urls_for_domain:
+        if not os.path.exists(KTBIMG_INPUT_DIR): os.makedirs(KTBIMG_INPUT_DIR)
+        timestamp = datetime.now(pytz.timezone('Asia/Ho_Chi_Minh')).strftime('%Y%m%d%H%M%S')
+        skip_file_name = f"{domain}.{len(skipped_urls_for_domain)}.{timestamp}.txt"
+        with open(os.path.join(KTBIMG_INPUT_DIR, skip_file_name), 'w', encoding='utf-8') as f:
+            f.write('\n'.join(skipped_urls_for_domain))
+        domain_manifest.add(os.path.join(KTBIMG_INPUT_DIR, skip_file_name))
+        say(f"📝 Đã tạo file skip '{skip_file_name}' và đẩy vào Input của KTBIMG.")
+    
+    # Đẩy output của domain này sang publisher (git chạy ở luồng nền)
+    publisher.publish(domain_manifest, label="ktbimage tool")
 
-        # GHI FILE SKIP
-        skip_file_name = None
-        if skipped_urls_for_domain:
-            if not os.path.exists(KTBIMG_INPUT_DIR): os.makedirs(KTBIMG_INPUT_DIR)
-            timestamp = datetime.now(pytz.timezone('Asia/Ho_Chi_Minh')).strftime('%Y%m%d%H%M%S')
-            skip_file_name = f"{domain}.{len(skipped_urls_for_domain)}.{timestamp}.txt"
-            with open(os.path.join(KTBIMG_INPUT_DIR, skip_file_name), 'w', encoding='utf-8') as f:
-                f.write('\n'.join(skipped_urls_for_domain))
-            print(f"📝 Đã tạo file skip '{skip_file_name}' và đẩy vào Input của KTBIMG.")
-        
-        # CẬP NHẬT BÁO CÁO
-        urls_summary[domain] = {
-            'processed_by_mockup': processed_by_mockup, 'skipped_global': skipped_global_count,
-            'skipped_no_rule': skipped_no_rule_count, 'skipped_by_rule': skipped_by_rule_count,
-            'skip_file_generated': skip_file_name, 'total_to_process': new_count
-        }
-        for mockup, count in processed_by_mockup.items():
-            total_processed_this_run[mockup] = total_processed_this_run.get(mockup, 0) + count
+    # BÁO CÁO CỦA DOMAIN (số liệu từng ảnh đã nằm trong các sự kiện 'image')
+    events.event(
+        "domain", domain=domain, output_mode=output_mode_domain, total_to_process=len(urls_to_process),
+        deferred=len(deferred_urls), skip_file=skip_file_name,
+        memory_peaks=[[label.split('/', 1)[1], peak] for label, peak in governor.peaks if label.startswith(f"{domain}/")],
+        process_peak_mb=round(domain_peak.peak_mb, 1) if domain_peak else None
+    )
+    return deferred_urls
+
+
+# --- HÀM MAIN CHÍNH (PHIÊN BẢN HOÀN CHỈNH CUỐI CÙNG) ---
+def main():
+    configs = load_config(CONFIG_FILE)
+    if not configs: return
+    
+    defaults = configs.get("defaults", {})
+    output_mode = defaults.get("ktbimage_output_mode", "zip")
+    
+    print(f"🚀 Bắt đầu quy trình tự động của KTB-IMAGE (Chế độ Output mặc định: {output_mode.upper()})")
+
+    if not os.path.exists(OUTPUT_DIR): os.makedirs(OUTPUT_DIR)
+    
+    #cleanup_old_zips()
+
+    domains_configs = configs.get("domains", {})
+    mockup_sets_config = configs.get("mockup_sets", {})
+    exif_defaults = defaults.get("exif_defaults", {})
+    title_clean_keywords = defaults.get("title_clean_keywords", [])
+    global_skip_keywords = defaults.get("global_skip_keywords", [])
+
+    # Log của crawler được parse tăng dần (chỉ mục offset lưu giữa các lần chạy), file URL chỉ đọc các dòng đầu
+    crawler_input = CrawlerInput()
+    try:
+        domains_to_process = crawler_input.new_image_counts(CRAWLER_LOG_FILE)
+    except FileNotFoundError:
+        print(f"❌ Lỗi: Không tìm thấy file log tại '{CRAWLER_LOG_FILE}'."); return
+    
+    deferred_queue = DeferredQueue(DEFERRED_DIR)
+    if not domains_to_process and not deferred_queue.domains():
+        crawler_input.save()
+        print("✅ Không có ảnh mới nào được tìm thấy trong log. Kết thúc."); return
 
-    # CÁC BƯỚC CUỐI CÙNG
-    write_log(urls_summary)
-    update_total_image_count(TOTAL_IMAGE_FILE, total_processed_this_run, "ktbimage")
-    print("\n✅ Hoàn thành xử lý và ghi log.")
+    print(f"🔎 Tìm thấy {len(domains_to_process)} domain có ảnh mới.")
+    scheduler_config = defaults.get("ktbimage_scheduler", {})
+    max_workers = scheduler_config.get("max_workers", 1)
+    profiler = ImageProfiler.from_argv("ktbimage")
+    if profiler.enabled and max_workers > 1:
+        # cProfile/tracemalloc đo theo process: chạy tuần tự để số liệu từng ảnh không lẫn vào nhau
+        print(f"🔬 Chế độ profile: chạy tuần tự thay vì {max_workers} worker.")
+        max_workers = 1
+    time_budget_minutes = scheduler_config.get("time_budget_minutes", 0)
+
+    # URL của mỗi domain = URL bị hoãn từ lần trước (xử lý trước) + URL mới trong log
+    domain_order = list(domains_to_process) + [d for d in deferred_queue.domains() if d not in domains_to_process]
+    jobs = {}
+    for domain in domain_order:
+        new_urls = []
+        if domain in domains_to_process:
+            try:
+                new_urls = crawler_input.read_lines(os.path.join(CRAWLER_DOMAIN_DIR, f"{domain}.txt"), domains_to_process[domain])
+            except FileNotFoundError:
+                print(f"  - ❌ Lỗi: Không tìm thấy file URL cho domain {domain}. Bỏ qua.")
+        urls = merge_url_lists(deferred_queue.load(domain), new_urls)
+        if urls:
+            jobs[domain] = urls
+    crawler_input.save()
+
+    if not jobs:
+        print("✅ Không có URL nào cần xử lý. Kết thúc."); return
+
+    events = EventLog.from_argv("ktbimage", defaults.get("event_log"))
+    metrics = PipelineMetrics.for_tool("ktbimage", defaults.get("metrics_export"))
+    events.add_listener(metrics.observe)
+    total_processed_this_run = {}
+    publisher = OutputPublisher(PROJECT_ROOT, "ktbimage")
+    # Luồng publish không phải daemon: luôn close() kể cả khi lần chạy lỗi, để process (và chế độ --watch) không bị treo
+    try:
+        governor = MemoryGovernor(defaults.get("memory_budget_mb"))
+        asset_store = AssetStore(defaults.get("shared_assets", True))
+        dedup_config = defaults.get("dedup", {})
+        dedup_index = DedupIndex(max_distance=dedup_config.get("max_distance", DEFAULT_MAX_DISTANCE)) if dedup_config.get("enabled", True) else None
+        output_index = OutputIndex.from_config("ktbimage", defaults.get("output_index"))
+        download_spool = DownloadSpool.from_config(defaults.get("download_spool"))
+        if download_spool: download_spool.prune()
+        save_format, ext = ("WEBP", ".webp") if defaults.get("global_output_format", "webp") == "webp" else ("JPEG", ".jpg")
+        run_context = {
+            "defaults": defaults, "output_mode": output_mode, "domains_configs": domains_configs,
+            "mockup_sets_config": mockup_sets_config,
+            "output_renderer": OutputRenderer(
+            output_index, asset_store, MetadataBuilder(exif_defaults, defaults.get("metadata", {})),
+            save_format, ext, WATERMARK_DIR, FONT_FILE
+        ),
+            "title_clean_keywords": title_clean_keywords, "global_skip_keywords": global_skip_keywords,
+            "publisher": publisher, "governor": governor, "asset_store": asset_store, "dedup_index": dedup_index,
+            "profiler": profiler, "events": events, "download_spool": download_spool,
+            "per_image_peaks": max_workers == 1
+        }
 
-    commit_and_push_changes_locally()
+        deadline = RunDeadline(time_budget_minutes * 60)
+        print(f"🗓️  Lập lịch {len(jobs)} domain với {max_workers} worker"
+              + (f", giới hạn {time_budget_minutes} phút." if time_budget_minutes else "."))
+        results = run_jobs(
+            jobs, lambda domain, urls: process_domain(domain, urls, run_context, deadline),
+            max_workers=max_workers, priority_of=lambda domain: domains_configs.get(domain, {}).get("priority", 0)
+        )
+
+        for domain in jobs:
+            deferred_urls = results.get(domain)
+            if deferred_urls is None:
+                continue  # worker lỗi: giữ nguyên hàng đợi hoãn của domain này
+            deferred_queue.save(domain, deferred_urls)
+
+        # Báo cáo được dựng lại từ file sự kiện của lần chạy này
+        events.flush()
+        run_events = list(read_events(events.path))
+        urls_summary = summarize_events(run_events)
+        for summary in urls_summary.values():
+            for mockup, count in summary['processed_by_mockup'].items():
+                total_processed_this_run[mockup] = total_processed_this_run.get(mockup, 0) + count
+
+        # CÁC BƯỚC CUỐI CÙNG
+        if dedup_index: dedup_index.close()
+        output_index.close()
+        if download_spool: download_spool.close()
+        asset_store.close()
+        profiler.close()
+        events.close()
+        metrics.write_textfile()
+        write_log(urls_summary, size_distribution(run_events))
+        write_memory_log(urls_summary)
+        domain_counts = {domain: counts['processed_by_mockup'] for domain, counts in urls_summary.items()}
+        update_total_image_count(TOTAL_IMAGE_FILE, total_processed_this_run, "ktbimage", domain_counts=domain_counts)
+        print("\n✅ Hoàn thành xử lý và ghi log.")
+
+        publisher.publish([GENERATE_LOG_FILE, TOTAL_IMAGE_FILE], label="ktbimage tool")
+    finally:
+        publisher.close()
     send_telegram_log_locally()
     send_telegram_summary("ktbimage", TOTAL_IMAGE_FILE, total_processed_this_run)
 
     print("\n🎉 Quy trình đã hoàn tất! 🎉")
 
+def parse_run_args(argv=None):
+    """--watch PHÚT: chế độ chạy lâu, lặp lại quy trình sau mỗi khoảng thời gian (metrics HTTP giữ nguyên)."""
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument("--watch", type=float, default=0)
+    args, _ = parser.parse_known_args(argv)
+    return args
+
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    watch_minutes = parse_run_args().watch
+    if not watch_minutes:
+        main()
+    else:
+        print(f"👀 Chế độ chạy liên tục: lặp lại mỗi {watch_minutes:g} phút (Ctrl+C để dừng).")
+        # Mở /metrics ngay từ đầu, kể cả khi các lần chạy đầu không có ảnh mới
+        PipelineMetrics.for_tool("ktbimage", (load_config(CONFIG_FILE) or {}).get("defaults", {}).get("metrics_export"))
+        while True:
+            try:
+                main()
+            except Exception as e:
+                print(f"❌ Lỗi trong lần chạy: {e}")
+            time.sleep(watch_minutes * 60)
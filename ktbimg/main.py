@@ -4,31 +4,37 @@ import os
 import json
 from datetime import datetime
 import pytz
-from io import BytesIO
-from PIL import Image
 from dotenv import load_dotenv
 import random
 
 # Import các hàm từ module dùng chung
 from utils.image_processing import (
     download_image,
+    load_image_bytes,
     erase_areas,
     crop_by_coords,
-    rotate_image,
     remove_background,
     remove_background_advanced,
-    trim_transparent_background,
-    apply_mockup,
-    add_watermark
+    resolve_bg_profile,
+    DesignGeometry
 )
 from utils.file_io import (
     load_config,
     clean_title,
-    create_exif_data,
     update_total_image_count,
     find_mockup_image,
     send_telegram_summary
 )
+from utils.memory_governor import MemoryGovernor, estimate_bg_removal_bytes
+from utils.asset_store import AssetStore
+from utils.download_spool import DownloadSpool
+from utils.preview import preview_and_confirm, preview_scale, preview_refine_size, downscale, add_mockup_tiles
+from utils.profiler import ImageProfiler
+from utils.event_log import EventLog, read_events, say, DEBUG, WARNING, ERROR
+from utils.metrics_exporter import PipelineMetrics
+from utils.output_encoder import OutputRenderer, print_size_distribution
+from utils.metadata import MetadataBuilder
+from utils.output_index import OutputIndex
 
 # --- Cấu hình đường dẫn ---
 TOOL_DIR = os.path.dirname(os.path.abspath(__file__))
@@ -40,6 +46,7 @@ WATERMARK_DIR = os.path.join(PROJECT_ROOT, "watermark")
 FONT_FILE = os.path.join(PROJECT_ROOT, "fonts", "verdanab.ttf")
 INPUT_DIR = os.path.join(TOOL_DIR, "InputImage")
 OUTPUT_DIR = os.path.join(TOOL_DIR, "OutputImage")
+PREVIEW_DIR = os.path.join(TOOL_DIR, "Preview")
 TOTAL_IMAGE_FILE = os.path.join(PROJECT_ROOT, "TotalImage.txt")
 
 # --- CÁC HÀM HỖ TRỢ RIÊNG CỦA TOOL NÀY ---
@@ -86,6 +93,38 @@ def get_user_inputs(available_mockups):
     print("-" * 50)
     return pattern, crop_coords, angle, skip_white, skip_black, selected_mockups, erase_zones
 
+def render_preview(sheet, preview, urls, crop_coords, angle, skip_white, skip_black, erase_zones, bg_profile,
+                   selected_mockups, mockup_cache, asset_store, download_spool):
+    """Chạy vài URL đầu qua đúng các bước của lần chạy thật ở độ phân giải thấp và ghép vào mọi mockup đã chọn."""
+    for url in urls[:preview["images"]]:
+        filename = os.path.basename(url)
+        spooled_data = download_spool.get(url) if download_spool else None
+        img = load_image_bytes(spooled_data, as_buffer=True) if spooled_data else download_image(url, timeout=10, as_buffer=True, keep_source=download_spool is not None)
+        if not img:
+            print(f"  - ⚠️ [{filename}] Không tải được ảnh."); continue
+        if download_spool and not spooled_data:
+            download_spool.put(url, img.info.get("source_bytes"), tool="ktbimg")  # lần chạy thật sẽ lấy lại từ spool
+        initial_crop = crop_by_coords(img, crop_coords)
+        if not initial_crop:
+            print(f"  - ⚠️ [{filename}] Không crop được ảnh."); continue
+        try:
+            pixel = initial_crop.getpixel((1, initial_crop.height - 2))
+            is_white = sum(pixel[:3]) / 3 > 128
+        except IndexError: is_white = True
+        if (skip_white and is_white) or (skip_black and not is_white):
+            print(f"  - [{filename}] Sẽ bị bỏ qua theo tùy chọn skip màu."); continue
+        if erase_zones:
+            erase_areas(initial_crop, erase_zones, (255, 255, 255) if is_white else (0, 0, 0))
+
+        scale = preview_scale(initial_crop.size, preview["max_side"])
+        refine_size = preview_refine_size(bg_profile["refine_size"], scale, preview["max_side"])
+        bg_removed = remove_background_advanced(downscale(initial_crop, scale), refine_size=refine_size, sharpen=bg_profile["sharpen"], keying=bg_profile["keying"])
+        design_geometry = DesignGeometry.from_image(bg_removed, angle)
+        if design_geometry is None:
+            print(f"  - ⚠️ [{filename}] Ảnh trống sau khi xử lý."); continue
+        sheet.new_row(filename)
+        add_mockup_tiles(sheet, design_geometry, is_white, mockup_cache, selected_mockups, asset_store, MOCKUP_DIR, WATERMARK_DIR, FONT_FILE)
+
 # --- HÀM MAIN CHÍNH ---
 def main():
     print("🚀 Bắt đầu quy trình tương tác của KTB-IMG...")
@@ -99,8 +138,22 @@ def main():
     defaults = configs.get("defaults", {})
     mockup_sets_config = configs.get("mockup_sets", {})
     exif_defaults = defaults.get("exif_defaults", {})
+    metadata_builder = MetadataBuilder(exif_defaults, defaults.get("metadata", {}))
     output_format = defaults.get("global_output_format", "webp")
     title_clean_keywords = defaults.get("title_clean_keywords", [])
+    governor = MemoryGovernor(defaults.get("memory_budget_mb"))
+    asset_store = AssetStore(defaults.get("shared_assets", True))
+    profiler = ImageProfiler.from_argv("ktbimg")
+    events = EventLog.from_argv("ktbimg", defaults.get("event_log"))
+    metrics = PipelineMetrics.for_tool("ktbimg", defaults.get("metrics_export"))
+    events.add_listener(metrics.observe)
+    output_index = OutputIndex.from_config("ktbimg", defaults.get("output_index"))
+    output_renderer = OutputRenderer(
+        output_index, asset_store, metadata_builder, "WEBP" if output_format == "webp" else "JPEG", f".{output_format}",
+        WATERMARK_DIR, FONT_FILE
+    )
+    # Ảnh gốc ktbimage đã tải cho các URL trong file skip: đọc từ spool trước, thiếu/hết hạn mới tải qua mạng
+    download_spool = DownloadSpool.from_config(defaults.get("download_spool"))
 
     input_files = [f for f in os.listdir(INPUT_DIR) if f.endswith('.txt')]
     if not input_files:
@@ -109,7 +162,9 @@ def main():
     total_processed_this_run = {}
 
     for txt_filename in input_files:
+        events.flush()  # in hết log của file trước rồi mới hỏi người dùng
         print(f"\n==================== BẮT ĐẦU XỬ LÝ FILE: {txt_filename} ====================")
+        asset_store.refresh()  # nạp lại mockup nào đã bị sửa giữa các file
 
         try:
             with open(os.path.join(INPUT_DIR, txt_filename), 'r', encoding='utf-8') as f:
@@ -120,50 +175,65 @@ def main():
         if not all_urls:
             print("  - ⚠️  File txt trống, bỏ qua."); continue
 
-        pattern, crop_coords, angle, skip_white, skip_black, selected_mockups, erase_zones = get_user_inputs(mockup_sets_config)
-        
-        # <<< THAY ĐỔI: LOGIC CHỌN MOCKUP NGẪU NHIÊN CHO MỖI LẦN CHẠY FILE TXT >>>
-        print("\n🎲 Đang chọn ngẫu nhiên 1 phiên bản cho mỗi mockup set đã chọn...")
-        mockup_cache = {}
-        for name in selected_mockups:
-            mockup_config = mockup_sets_config.get(name)
-            if not mockup_config: continue
-
-            # Logic thông minh cho mockup TRẮNG
-            white_value = mockup_config.get("white")
-            selected_white = None
-            if isinstance(white_value, list) and white_value:
-                selected_white = random.choice(white_value)
-                print(f"  - Mockup '{name}' (trắng): đã chọn file ngẫu nhiên '{selected_white['file']}'")
-            elif isinstance(white_value, str): # Hỗ trợ cấu trúc cũ
-                selected_white = {"file": white_value, "coords": mockup_config.get("coords")}
-                print(f"  - Mockup '{name}' (trắng): sử dụng file config cũ '{selected_white['file']}'")
-
-            # Logic thông minh cho mockup ĐEN
-            black_value = mockup_config.get("black")
-            selected_black = None
-            if isinstance(black_value, list) and black_value:
-                selected_black = random.choice(black_value)
-                print(f"  - Mockup '{name}' (đen): đã chọn file ngẫu nhiên '{selected_black['file']}'")
-            elif isinstance(black_value, str): # Hỗ trợ cấu trúc cũ
-                selected_black = {"file": black_value, "coords": mockup_config.get("coords")}
-                print(f"  - Mockup '{name}' (đen): sử dụng file config cũ '{selected_black['file']}'")
-            
-            mockup_cache[name] = {
-                "white_data": selected_white, "black_data": selected_black,
-                "watermark_text": mockup_config.get("watermark_text"),
-                "title_prefix_to_add": mockup_config.get("title_prefix_to_add", ""),
-                "title_suffix_to_add": mockup_config.get("title_suffix_to_add", "")
-            }
-        print("-" * 50)
-        # <<< KẾT THÚC THAY ĐỔI >>>
-        
-        urls_to_process = [url for url in all_urls if not pattern or pattern in os.path.basename(url)]
+        # File skip từ ktbimage có dạng '<domain>.<số lượng>.<timestamp>.txt' -> dùng hồ sơ tách nền của domain nếu có
+        source_domain = os.path.splitext(txt_filename)[0].rsplit('.', 2)[0]
+        bg_profile_name, bg_profile = resolve_bg_profile(defaults, "ktbimg", configs.get("domains", {}).get(source_domain))
+
+        # Nhập cài đặt -> (tuỳ chọn) xem trước vài ảnh đầu ở độ phân giải thấp -> nhập lại nếu chưa đúng
+        while True:
+            pattern, crop_coords, angle, skip_white, skip_black, selected_mockups, erase_zones = get_user_inputs(mockup_sets_config)
+            print(f"  - Hồ sơ tách nền: {bg_profile_name}")
+
+            # <<< THAY ĐỔI: LOGIC CHỌN MOCKUP NGẪU NHIÊN CHO MỖI LẦN CHẠY FILE TXT >>>
+            print("\n🎲 Đang chọn ngẫu nhiên 1 phiên bản cho mỗi mockup set đã chọn...")
+            mockup_cache = {}
+            for name in selected_mockups:
+                mockup_config = mockup_sets_config.get(name)
+                if not mockup_config: continue
+
+                # Logic thông minh cho mockup TRẮNG
+                white_value = mockup_config.get("white")
+                selected_white = None
+                if isinstance(white_value, list) and white_value:
+                    selected_white = random.choice(white_value)
+                    print(f"  - Mockup '{name}' (trắng): đã chọn file ngẫu nhiên '{selected_white['file']}'")
+                elif isinstance(white_value, str): # Hỗ trợ cấu trúc cũ
+                    selected_white = {"file": white_value, "coords": mockup_config.get("coords")}
+                    print(f"  - Mockup '{name}' (trắng): sử dụng file config cũ '{selected_white['file']}'")
+
+                # Logic thông minh cho mockup ĐEN
+                black_value = mockup_config.get("black")
+                selected_black = None
+                if isinstance(black_value, list) and black_value:
+                    selected_black = random.choice(black_value)
+                    print(f"  - Mockup '{name}' (đen): đã chọn file ngẫu nhiên '{selected_black['file']}'")
+                elif isinstance(black_value, str): # Hỗ trợ cấu trúc cũ
+                    selected_black = {"file": black_value, "coords": mockup_config.get("coords")}
+                    print(f"  - Mockup '{name}' (đen): sử dụng file config cũ '{selected_black['file']}'")
+
+                mockup_cache[name] = {
+                    "white_data": selected_white, "black_data": selected_black,
+                    "watermark_text": mockup_config.get("watermark_text"),
+                    "title_prefix_to_add": mockup_config.get("title_prefix_to_add", ""),
+                    "title_suffix_to_add": mockup_config.get("title_suffix_to_add", ""),
+                    "variants": mockup_config.get("variants"),
+                    "encoding": mockup_config.get("encoding", defaults.get("output_encoding"))
+                }
+            print("-" * 50)
+            # <<< KẾT THÚC THAY ĐỔI >>>
+
+            urls_to_process = [url for url in all_urls if not pattern or pattern in os.path.basename(url)]
+            render = lambda sheet, preview: render_preview(sheet, preview, urls_to_process, crop_coords, angle, skip_white, skip_black, erase_zones,
+                                                           bg_profile, selected_mockups, mockup_cache, asset_store, download_spool)
+            if not urls_to_process or preview_and_confirm(render, PREVIEW_DIR, os.path.splitext(txt_filename)[0], defaults.get("preview"), FONT_FILE):
+                break
+
         if not urls_to_process:
             print(f"  - ⚠️ Không có URL nào trong file khớp với pattern '{pattern}'."); continue
         
         print(f"🔎 Tìm thấy {len(urls_to_process)} URL hợp lệ, bắt đầu xử lý...")
         images_for_output = {}
+        designs_for_output = {}  # số design theo mockup (tên thư mục), khác số file khi có variants
         run_timestamp = datetime.now(pytz.timezone('Asia/Ho_Chi_Minh')).strftime('%Y%m%d_%H%M%S')
 
         consecutive_error_count = 0
@@ -171,101 +241,117 @@ def main():
 
         for url in urls_to_process:
             filename = os.path.basename(url)
-            print(f"\n--- 🖼️  Đang xử lý: {filename} ---")
+            say(f"\n--- 🖼️  Đang xử lý: {filename} ---", DEBUG)
             
-            try:
-                img = download_image(url, timeout=10)
-                if not img:
-                    consecutive_error_count += 1
-                    if consecutive_error_count >= ERROR_THRESHOLD:
-                        print(f"  - ❌ Lỗi: Đã có {consecutive_error_count} lỗi. Dừng xử lý file '{txt_filename}'."); break
-                    continue
-                consecutive_error_count = 0
-
+            with governor.track_peak(filename), profiler.image(filename, source=url, rule=txt_filename), \
+                    events.image(filename, url, profiler=profiler, domain=source_domain, input_file=txt_filename, bg_profile=bg_profile_name) as record:
                 try:
-                    temp_crop_for_color = crop_by_coords(img, crop_coords)
-                    if temp_crop_for_color:
-                        pixel = temp_crop_for_color.getpixel((1, temp_crop_for_color.height - 2))
-                        is_white = sum(pixel[:3]) / 3 > 128
-                    else: is_white = True
-                except (TypeError, IndexError): is_white = True
-                
-                background_color = (255, 255, 255) if is_white else (0, 0, 0)
-                print(f"  - Màu nền được xác định là: {'Trắng' if is_white else 'Đen'}")
+                    with record.stage("download"):
+                        img, spooled_data = None, download_spool.get(url) if download_spool else None
+                        if spooled_data:
+                            try:
+                                img = load_image_bytes(spooled_data, as_buffer=True)
+                                record.set(spool_hit=True, spool_bytes=len(spooled_data))
+                            except Exception as e:
+                                say(f"  - ⚠️ Ảnh trong spool bị lỗi, tải lại qua mạng: {e}", WARNING)
+                        if img is None:
+                            img = download_image(url, timeout=10, as_buffer=True)
+                    if not img:
+                        record.skip("download_failed", "Không tải được ảnh.")
+                        consecutive_error_count += 1
+                        if consecutive_error_count >= ERROR_THRESHOLD:
+                            say(f"  - ❌ Lỗi: Đã có {consecutive_error_count} lỗi. Dừng xử lý file '{txt_filename}'.", ERROR); break
+                        continue
+                    consecutive_error_count = 0
+                    if "download_bytes" in img.info:
+                        record.set(download_bytes=img.info["download_bytes"])
 
-                if erase_zones:
-                    img = erase_areas(img, erase_zones, background_color)
+                    try:
+                        temp_crop_for_color = crop_by_coords(img, crop_coords)
+                        if temp_crop_for_color:
+                            pixel = temp_crop_for_color.getpixel((1, temp_crop_for_color.height - 2))
+                            is_white = sum(pixel[:3]) / 3 > 128
+                        else: is_white = True
+                    except (TypeError, IndexError): is_white = True
                 
-                initial_crop = crop_by_coords(img, crop_coords)
-                if not initial_crop: continue
+                    background_color = (255, 255, 255) if is_white else (0, 0, 0)
+                    record.set(color="white" if is_white else "black")
+                    say(f"  - Màu nền được xác định là: {'Trắng' if is_white else 'Đen'}", DEBUG)
+
+                    initial_crop = crop_by_coords(img, crop_coords)
+                    if not initial_crop:
+                        record.skip("crop_failed", "Không crop được ảnh."); continue
                 
-                if (skip_white and is_white) or (skip_black and not is_white):
-                    print(f"  - ⏩ Bỏ qua theo tùy chọn skip màu."); continue
+                    if (skip_white and is_white) or (skip_black and not is_white):
+                        record.skip("skip_color", "Bỏ qua theo tùy chọn skip màu."); continue
+
+                    # Tẩy watermark ngay trên vùng crop (view của ảnh tải về): chỉ phần zone nằm trong vùng crop
+                    if erase_zones:
+                        erase_areas(initial_crop, erase_zones, background_color)
                     
-                bg_removed = remove_background_advanced(initial_crop)
-                final_design = rotate_image(bg_removed, angle)
-                trimmed_img = trim_transparent_background(final_design)
-                if not trimmed_img:
-                    print("  - ⚠️ Cảnh báo: Ảnh trống sau khi xử lý."); continue
-
-                for mockup_name in selected_mockups:
-                    # <<< THAY ĐỔI: LẤY DỮ LIỆU TỪ CACHE ĐÃ CHỌN NGẪU NHIÊN >>>
-                    cached_data = mockup_cache.get(mockup_name)
-                    if not cached_data: continue
+                    crop_w, crop_h = initial_crop.size
+                    refine_size = governor.plan_refine_size(crop_w, crop_h, bg_profile["refine_size"])
+                    with governor.reserve(estimate_bg_removal_bytes(crop_w, crop_h, refine_size), filename), record.stage("bg_removal"):
+                        bg_removed = remove_background_advanced(initial_crop, refine_size=refine_size, sharpen=bg_profile["sharpen"], keying=bg_profile["keying"])
+                    # Xoay + trim + resize vào khung được gộp thành một phép affine, lấy mẫu một lần cho mỗi kích thước khung
+                    design_geometry = DesignGeometry.from_image(bg_removed, angle)
+                    if design_geometry is None:
+                        record.skip("empty_design", "Ảnh trống sau khi xử lý."); continue
+
+                    for mockup_name in selected_mockups:
+                        # <<< THAY ĐỔI: LẤY DỮ LIỆU TỪ CACHE ĐÃ CHỌN NGẪU NHIÊN >>>
+                        cached_data = mockup_cache.get(mockup_name)
+                        if not cached_data: continue
                     
-                    mockup_data_to_use = cached_data['white_data'] if is_white else cached_data['black_data']
-                    if not mockup_data_to_use:
-                        print(f"    - ⚠️ Cảnh báo: Không có tùy chọn mockup cho màu này. Bỏ qua."); continue
-
-                    mockup_filename = mockup_data_to_use.get('file')
-                    mockup_coords = mockup_data_to_use.get('coords')
-                    if not mockup_filename or not mockup_coords:
-                        print(f"    - ⚠️ Cảnh báo: Cấu hình mockup cho '{mockup_name}' bị lỗi. Bỏ qua."); continue
+                        mockup_data_to_use = cached_data['white_data'] if is_white else cached_data['black_data']
+                        if not mockup_data_to_use:
+                            say(f"    - ⚠️ Cảnh báo: Không có tùy chọn mockup cho màu này ({mockup_name}). Bỏ qua.", WARNING); continue
+
+                        mockup_filename = mockup_data_to_use.get('file')
+                        mockup_coords = mockup_data_to_use.get('coords')
+                        if not mockup_filename or not mockup_coords:
+                            say(f"    - ⚠️ Cảnh báo: Cấu hình mockup cho '{mockup_name}' bị lỗi. Bỏ qua.", WARNING); continue
                     
-                    mockup_path = os.path.join(MOCKUP_DIR, mockup_filename)
-                    if not os.path.exists(mockup_path):
-                        print(f"    - ⚠️ Cảnh báo: Không tìm thấy file ảnh mockup '{mockup_filename}'. Bỏ qua."); continue
-                    # <<< KẾT THÚC THAY ĐỔI >>>
-
-                    with Image.open(mockup_path) as mockup_img:
-                        final_mockup = apply_mockup(trimmed_img, mockup_img, mockup_coords)
-                        
-                        watermark_desc = cached_data.get("watermark_text")
-                        final_mockup_with_wm = add_watermark(final_mockup, watermark_desc, WATERMARK_DIR, FONT_FILE)
-                        
+                        mockup_path = os.path.join(MOCKUP_DIR, mockup_filename)
+                        if not os.path.exists(mockup_path):
+                            say(f"    - ⚠️ Cảnh báo: Không tìm thấy file ảnh mockup '{mockup_filename}'. Bỏ qua.", WARNING); continue
+                        # <<< KẾT THÚC THAY ĐỔI >>>
+
+                        # Tiêu đề của output (OutputRenderer giữ chỗ tên file trước khi render)
                         base_filename = os.path.splitext(filename)[0]
                         cleaned_title = clean_title(base_filename, title_clean_keywords)
                         prefix = cached_data.get("title_prefix_to_add", "")
                         suffix = cached_data.get("title_suffix_to_add", "")
-                        
+                    
                         final_filename_base = f"{prefix} {cleaned_title} {suffix}".strip().replace('  ', ' ')
-                        ext = f".{output_format}"
-                        final_filename = f"{final_filename_base}{ext}"
-
-                        image_to_save = final_mockup_with_wm.convert('RGB')
-                        exif_bytes = create_exif_data(mockup_name, final_filename, exif_defaults)
-                        
-                        img_byte_arr = BytesIO()
-                        save_format = "WEBP" if output_format == "webp" else "JPEG"
-                        image_to_save.save(img_byte_arr, format=save_format, quality=90, exif=exif_bytes)
-                        
-                        images_for_output.setdefault(mockup_name, []).append((final_filename, img_byte_arr.getvalue()))
+                        output_scope = f"{source_domain}/{mockup_name}"
+
+                        final_filename, encoded_files, identical_to = output_renderer.render(
+                            record, design_geometry, mockup_name, mockup_path, mockup_coords, final_filename_base, url,
+                            output_scope, cached_data.get("variants"), cached_data.get("encoding"), cached_data.get("watermark_text")
+                        )
+                        if encoded_files is None:
+                            continue
+
+                        images_for_output.setdefault(mockup_name, []).extend(encoded_files)
+                        designs_for_output[mockup_name] = designs_for_output.get(mockup_name, 0) + 1
                         total_processed_this_run.setdefault(mockup_name, 0)
                         total_processed_this_run[mockup_name] += 1
-                        print(f"    -> Đã xử lý cho mockup: '{mockup_name}'")
+                        say(f"    -> Đã xử lý cho mockup: '{mockup_name}'", DEBUG)
 
-            except Exception as e:
-                print(f"❌ Lỗi nghiêm trọng khi xử lý file {filename}: {e}")
-                consecutive_error_count += 1
-                if consecutive_error_count >= ERROR_THRESHOLD:
-                    print(f"  - ❌ Lỗi: Đã có {consecutive_error_count} lỗi nghiêm trọng. Dừng xử lý file '{txt_filename}'.")
-                    break
+                except Exception as e:
+                    record.fail(f"Lỗi nghiêm trọng khi xử lý file {filename}: {e}")
+                    consecutive_error_count += 1
+                    if consecutive_error_count >= ERROR_THRESHOLD:
+                        say(f"  - ❌ Lỗi: Đã có {consecutive_error_count} lỗi nghiêm trọng. Dừng xử lý file '{txt_filename}'.", ERROR)
+                        break
 
         # --- LƯU KẾT QUẢ CHO FILE .TXT HIỆN TẠI ---
+        events.flush()
         if images_for_output:
             print(f"\n--- 💾 Bắt đầu lưu ảnh từ file {txt_filename} ---")
             for mockup_name, image_list in images_for_output.items():
-                output_subdir_name = f"{mockup_name}.{run_timestamp}.{len(image_list)}"
+                output_subdir_name = f"{mockup_name}.{run_timestamp}.{designs_for_output[mockup_name]}"
                 output_path = os.path.join(OUTPUT_DIR, output_subdir_name)
                 os.makedirs(output_path, exist_ok=True)
                 
@@ -280,11 +366,20 @@ def main():
             try:
                 os.remove(os.path.join(INPUT_DIR, txt_filename))
                 print(f"  -> ✅ Đã xóa file '{txt_filename}'.")
+                if download_spool: download_spool.discard(all_urls)
             except OSError as e:
                 print(f"  -> ❌ Lỗi khi xóa file: {e}")
         else:
             print(f"  -> 💾 Đã giữ lại file '{txt_filename}'.")
 
+    output_index.close()
+    if download_spool: download_spool.close()
+    profiler.close()
+    asset_store.close()
+    events.close()
+    metrics.write_textfile()
+    print_size_distribution(read_events(events.path))
+
     # --- CẬP NHẬT FILE ĐẾM TỔNG SAU KHI XONG HẾT ---
     if total_processed_this_run:
         update_total_image_count(TOTAL_IMAGE_FILE, total_processed_this_run, "ktbimg")
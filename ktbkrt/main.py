@@ -6,24 +6,29 @@ import random
 from datetime import datetime
 import pytz
 from PIL import Image, ImageFilter, ImageFont
-from io import BytesIO
 from dotenv import load_dotenv
 
 # Import các hàm từ module dùng chung
 from utils.image_processing import (
-    stylize_image,
+    StylizeEngine,
     add_hashtag_text,
     trim_transparent_background,
-    add_watermark,
     determine_mockup_color
 )
 from utils.file_io import (
     load_config,
-    create_exif_data,
     update_total_image_count,
     find_mockup_image,
     send_telegram_summary
 )
+from utils.asset_store import AssetStore
+from utils.profiler import ImageProfiler
+from utils.event_log import EventLog, read_events, say, DEBUG, WARNING
+from utils.metrics_exporter import PipelineMetrics
+from utils.output_encoder import OutputRenderer, print_size_distribution
+from utils.metadata import MetadataBuilder
+from utils.output_index import OutputIndex
+from utils.preview import preview_and_confirm, preview_scale, downscale, add_mockup_tiles
 
 # --- Cấu hình đường dẫn ---
 TOOL_DIR = os.path.dirname(os.path.abspath(__file__))
@@ -40,6 +45,7 @@ FONTS_DIR = os.path.join(PROJECT_ROOT, "fonts")
 # Đường dẫn riêng của tool
 INPUT_DIR = os.path.join(TOOL_DIR, "InputImage")
 OUTPUT_DIR = os.path.join(TOOL_DIR, "OutputImage")
+PREVIEW_DIR = os.path.join(TOOL_DIR, "Preview")
 TOTAL_IMAGE_FILE = os.path.join(PROJECT_ROOT, "TotalImage.txt")
 
 # --- CÁC HÀM HỖ TRỢ RIÊNG CỦA TOOL NÀY ---
@@ -49,10 +55,11 @@ def get_krt_inputs(available_mockups):
     print("-" * 50)
     
     try:
-        level_str = input("▶️ Nhập mức độ giảm màu (Posterize) (1-8, Enter = 3): ")
-        posterize_level = int(level_str) if level_str else 3
+        level_str = input("▶️ Nhập mức độ giảm màu (Posterize) (1-8, nhiều mức cách nhau bởi dấu phẩy, Enter = 3): ")
+        posterize_levels = [int(l.strip()) for l in level_str.split(',') if l.strip()] if level_str else [3]
     except ValueError:
-        posterize_level = 3
+        posterize_levels = [3]
+    posterize_levels = list(dict.fromkeys(posterize_levels)) or [3]
 
     try:
         feather_str = input("▶️ Nhập tỷ lệ làm mờ viền (0.01-0.5, Enter = 0.07): ")
@@ -89,7 +96,7 @@ def get_krt_inputs(available_mockups):
             print("Lỗi: Vui lòng chỉ nhập các số hợp lệ.")
 
     print("-" * 50)
-    return posterize_level, feather_margin, blur_factor, add_text, selected_mockups
+    return posterize_levels, feather_margin, blur_factor, add_text, selected_mockups
 
 def cleanup_input_directory(directory, processed_files_list):
     """Hỏi và xóa các file đã xử lý trong thư mục Input."""
@@ -107,6 +114,25 @@ def cleanup_input_directory(directory, processed_files_list):
     else:
         print("  -> 💾 Đã giữ lại các file trong InputImage.")
 
+def render_preview(sheet, preview, images, posterize_levels, feather_margin, blur_factor, add_text, selected_mockups, mockup_cache, asset_store):
+    """Chạy vài ảnh đầu (mọi mức posterize) qua đúng các bước của lần chạy thật ở độ phân giải thấp và ghép vào mọi mockup đã chọn."""
+    for image_filename in images[:preview["images"]]:
+        with Image.open(os.path.join(INPUT_DIR, image_filename)) as img:
+            img.draft(img.mode, (preview["max_side"], preview["max_side"]))  # JPEG lớn: giải mã thẳng ở cỡ nhỏ
+            input_img = img.convert("RGBA")
+        input_img = downscale(input_img, preview_scale(input_img.size, preview["max_side"]))
+
+        use_black_mockup = determine_mockup_color(input_img)
+        stylize_engine = StylizeEngine(input_img)
+        for posterize_level in posterize_levels:
+            stylized_img = stylize_engine.render(posterize_level, feather_margin, blur_factor)
+            final_design = add_hashtag_text(stylized_img, image_filename, FONTS_DIR, stylized_img.width, use_black_mockup) if add_text else stylized_img
+            final_design_trimmed = trim_transparent_background(final_design)
+            if not final_design_trimmed:
+                print(f"  - ⚠️ [{image_filename}] Ảnh trống sau khi xử lý (posterize {posterize_level})."); continue
+            sheet.new_row(f"{image_filename} p{posterize_level}")
+            add_mockup_tiles(sheet, final_design_trimmed.convert('RGBa'), not use_black_mockup, mockup_cache, selected_mockups, asset_store, MOCKUP_DIR, WATERMARK_DIR, FONT_FILE)
+
 # --- HÀM MAIN CHÍNH ---
 def main():
     print("🚀 Bắt đầu quy trình sáng tạo của KTB-KRT...")
@@ -120,145 +146,166 @@ def main():
     defaults = configs.get("defaults", {})
     mockup_sets_config = configs.get("mockup_sets", {})
     exif_defaults = defaults.get("exif_defaults", {})
+    metadata_builder = MetadataBuilder(exif_defaults, defaults.get("metadata", {}))
     output_format = defaults.get("global_output_format", "webp")
+    asset_store = AssetStore(defaults.get("shared_assets", True))
+    profiler = ImageProfiler.from_argv("ktbkrt")
+    events = EventLog.from_argv("ktbkrt", defaults.get("event_log"))
+    metrics = PipelineMetrics.for_tool("ktbkrt", defaults.get("metrics_export"))
+    events.add_listener(metrics.observe)
+    output_index = OutputIndex.from_config("ktbkrt", defaults.get("output_index"))
+    output_renderer = OutputRenderer(
+        output_index, asset_store, metadata_builder, "WEBP" if output_format == "webp" else "JPEG", f".{output_format}",
+        WATERMARK_DIR, FONT_FILE
+    )
     
     images_to_process = [f for f in os.listdir(INPUT_DIR) if os.path.isfile(os.path.join(INPUT_DIR, f)) and not f.startswith('.')]
     if not images_to_process:
         print("✅ Không có ảnh mới trong InputImage để xử lý."); return
 
-    posterize_level, feather_margin, blur_factor, add_text, selected_mockups = get_krt_inputs(mockup_sets_config)
-
-    # <<< THAY ĐỔI: LOGIC CHỌN MOCKUP NGẪU NHIÊN CHO MỖI LẦN CHẠY >>>
-    print("\n🎲 Đang chọn ngẫu nhiên 1 phiên bản cho mỗi mockup set đã chọn...")
-    mockup_cache = {}
-    for name in selected_mockups:
-        mockup_config = mockup_sets_config.get(name)
-        if not mockup_config: continue
-
-        # Logic thông minh cho mockup TRẮNG
-        white_value = mockup_config.get("white")
-        selected_white = None
-        if isinstance(white_value, list) and white_value:
-            selected_white = random.choice(white_value)
-            print(f"  - Mockup '{name}' (trắng): đã chọn file ngẫu nhiên '{selected_white['file']}'")
-        elif isinstance(white_value, str): # Hỗ trợ cấu trúc cũ
-            selected_white = {"file": white_value, "coords": mockup_config.get("coords")}
-            print(f"  - Mockup '{name}' (trắng): sử dụng file config cũ '{selected_white['file']}'")
-
-        # Logic thông minh cho mockup ĐEN
-        black_value = mockup_config.get("black")
-        selected_black = None
-        if isinstance(black_value, list) and black_value:
-            selected_black = random.choice(black_value)
-            print(f"  - Mockup '{name}' (đen): đã chọn file ngẫu nhiên '{selected_black['file']}'")
-        elif isinstance(black_value, str): # Hỗ trợ cấu trúc cũ
-            selected_black = {"file": black_value, "coords": mockup_config.get("coords")}
-            print(f"  - Mockup '{name}' (đen): sử dụng file config cũ '{selected_black['file']}'")
-        
-        mockup_cache[name] = {
-            "white_data": selected_white,
-            "black_data": selected_black,
-            "watermark_text": mockup_config.get("watermark_text"),
-            "title_prefix_to_add": mockup_config.get("title_prefix_to_add", ""),
-            "title_suffix_to_add": mockup_config.get("title_suffix_to_add", "")
-        }
-    print("-" * 50)
+    # Nhập cài đặt -> (tuỳ chọn) xem trước vài ảnh đầu ở độ phân giải thấp -> nhập lại nếu chưa đúng
+    while True:
+        posterize_levels, feather_margin, blur_factor, add_text, selected_mockups = get_krt_inputs(mockup_sets_config)
+
+        # <<< THAY ĐỔI: LOGIC CHỌN MOCKUP NGẪU NHIÊN CHO MỖI LẦN CHẠY >>>
+        print("\n🎲 Đang chọn ngẫu nhiên 1 phiên bản cho mỗi mockup set đã chọn...")
+        mockup_cache = {}
+        for name in selected_mockups:
+            mockup_config = mockup_sets_config.get(name)
+            if not mockup_config: continue
+
+            # Logic thông minh cho mockup TRẮNG
+            white_value = mockup_config.get("white")
+            selected_white = None
+            if isinstance(white_value, list) and white_value:
+                selected_white = random.choice(white_value)
+                print(f"  - Mockup '{name}' (trắng): đã chọn file ngẫu nhiên '{selected_white['file']}'")
+            elif isinstance(white_value, str): # Hỗ trợ cấu trúc cũ
+                selected_white = {"file": white_value, "coords": mockup_config.get("coords")}
+                print(f"  - Mockup '{name}' (trắng): sử dụng file config cũ '{selected_white['file']}'")
+
+            # Logic thông minh cho mockup ĐEN
+            black_value = mockup_config.get("black")
+            selected_black = None
+            if isinstance(black_value, list) and black_value:
+                selected_black = random.choice(black_value)
+                print(f"  - Mockup '{name}' (đen): đã chọn file ngẫu nhiên '{selected_black['file']}'")
+            elif isinstance(black_value, str): # Hỗ trợ cấu trúc cũ
+                selected_black = {"file": black_value, "coords": mockup_config.get("coords")}
+                print(f"  - Mockup '{name}' (đen): sử dụng file config cũ '{selected_black['file']}'")
+
+            mockup_cache[name] = {
+                "white_data": selected_white,
+                "black_data": selected_black,
+                "watermark_text": mockup_config.get("watermark_text"),
+                "title_prefix_to_add": mockup_config.get("title_prefix_to_add", ""),
+                "title_suffix_to_add": mockup_config.get("title_suffix_to_add", ""),
+                "variants": mockup_config.get("variants"),
+                "encoding": mockup_config.get("encoding", defaults.get("output_encoding"))
+            }
+        print("-" * 50)
+
+        render = lambda sheet, preview: render_preview(sheet, preview, images_to_process, posterize_levels, feather_margin, blur_factor,
+                                                       add_text, selected_mockups, mockup_cache, asset_store)
+        if preview_and_confirm(render, PREVIEW_DIR, "ktbkrt", defaults.get("preview"), FONT_FILE):
+            break
     
     print(f"🔎 Tìm thấy {len(images_to_process)} ảnh, sẽ áp dụng {len(selected_mockups)} mockup đã chọn.")
     images_for_output = {}
+    designs_for_output = {}  # số design theo mockup (tên thư mục), khác số file khi có variants
     total_processed_this_run = {}
     run_timestamp = datetime.now(pytz.timezone('Asia/Ho_Chi_Minh')).strftime('%Y%m%d_%H%M%S')
 
     for image_filename in images_to_process:
-        print(f"\n--- 🎨  Đang sáng tạo từ: {image_filename} ---")
+        say(f"\n--- 🎨  Đang sáng tạo từ: {image_filename} ---", DEBUG)
+        image_path = os.path.join(INPUT_DIR, image_filename)
         try:
-            with Image.open(os.path.join(INPUT_DIR, image_filename)) as img:
+            with profiler.image(image_filename, source=image_path), \
+                    events.image(image_filename, image_path, profiler=profiler, posterize_levels=posterize_levels) as record, \
+                    Image.open(image_path) as img:
                 input_img = img.convert("RGBA")
                 
                 use_black_mockup = determine_mockup_color(input_img)
-                print(f"  - Phân tích ảnh: Đề xuất dùng mockup {'ĐEN' if use_black_mockup else 'TRẮNG'}.")
+                record.set(color="black" if use_black_mockup else "white")
+                say(f"  - Phân tích ảnh: Đề xuất dùng mockup {'ĐEN' if use_black_mockup else 'TRẮNG'}.", DEBUG)
+
+                # Phần việc chung (lấy mẫu bảng màu, mặt nạ viền) được dùng lại cho mọi mức posterize
+                stylize_engine = StylizeEngine(input_img)
 
-                print(f"  - Stylizing ảnh (Posterize: {posterize_level}, Feather: {feather_margin}, BlurFactor: {blur_factor})...")
-                stylized_img = stylize_image(input_img, posterize_level, feather_margin, blur_factor)
+                for posterize_level in posterize_levels:
+                    say(f"  - Stylizing ảnh (Posterize: {posterize_level}, Feather: {feather_margin}, BlurFactor: {blur_factor})...", DEBUG)
+                    with record.stage("stylize"):
+                        stylized_img = stylize_engine.render(posterize_level, feather_margin, blur_factor)
                 
-                if add_text:
-                    print("  - Thêm text hashtag...")
-                    final_design = add_hashtag_text(stylized_img, image_filename, FONTS_DIR, stylized_img.width, use_black_mockup)
-                else:
-                    final_design = stylized_img
+                    if add_text:
+                        say("  - Thêm text hashtag...", DEBUG)
+                        with record.stage("hashtag"):
+                            final_design = add_hashtag_text(stylized_img, image_filename, FONTS_DIR, stylized_img.width, use_black_mockup)
+                    else:
+                        final_design = stylized_img
                 
-                final_design_trimmed = trim_transparent_background(final_design)
-                if not final_design_trimmed:
-                    print("  - ⚠️ Cảnh báo: Ảnh trống sau khi xử lý, bỏ qua."); continue
-
-                for mockup_name in selected_mockups:
-                    # <<< THAY ĐỔI: SỬ DỤNG MOCKUP TỪ CACHE >>>
-                    cached_data = mockup_cache.get(mockup_name)
-                    if not cached_data: continue
+                    final_design_trimmed = trim_transparent_background(final_design)
+                    if not final_design_trimmed:
+                        say(f"  - ⚠️ Cảnh báo: Ảnh trống sau khi xử lý (posterize {posterize_level}), bỏ qua.", WARNING); continue
+
+                    # Chuyển design sang dạng premultiplied một lần cho tất cả mockup
+                    design_premul = final_design_trimmed.convert('RGBa')
+
+                    for mockup_name in selected_mockups:
+                        # <<< THAY ĐỔI: SỬ DỤNG MOCKUP TỪ CACHE >>>
+                        cached_data = mockup_cache.get(mockup_name)
+                        if not cached_data: continue
                     
-                    print(f"  - Áp dụng mockup: '{mockup_name}'")
+                        say(f"  - Áp dụng mockup: '{mockup_name}'", DEBUG)
                     
-                    mockup_data_to_use = cached_data['white_data'] if not use_black_mockup else cached_data['black_data']
+                        mockup_data_to_use = cached_data['white_data'] if not use_black_mockup else cached_data['black_data']
                     
-                    if not mockup_data_to_use:
-                        print(f"    - ⚠️ Cảnh báo: Không có tùy chọn mockup cho màu này. Bỏ qua."); continue
+                        if not mockup_data_to_use:
+                            say(f"    - ⚠️ Cảnh báo: Không có tùy chọn mockup cho màu này ({mockup_name}). Bỏ qua.", WARNING); continue
 
-                    mockup_filename = mockup_data_to_use.get('file')
-                    mockup_coords = mockup_data_to_use.get('coords')
+                        mockup_filename = mockup_data_to_use.get('file')
+                        mockup_coords = mockup_data_to_use.get('coords')
 
-                    if not mockup_filename or not mockup_coords:
-                        print(f"    - ⚠️ Cảnh báo: Cấu hình file/coords cho mockup '{mockup_name}' bị lỗi. Bỏ qua."); continue
+                        if not mockup_filename or not mockup_coords:
+                            say(f"    - ⚠️ Cảnh báo: Cấu hình file/coords cho mockup '{mockup_name}' bị lỗi. Bỏ qua.", WARNING); continue
 
-                    mockup_path = os.path.join(MOCKUP_DIR, mockup_filename)
-                    if not os.path.exists(mockup_path):
-                        print(f"    - ⚠️ Cảnh báo: Không tìm thấy file ảnh mockup '{mockup_filename}'. Bỏ qua."); continue
-                    # <<< KẾT THÚC THAY ĐỔI >>>
+                        mockup_path = os.path.join(MOCKUP_DIR, mockup_filename)
+                        if not os.path.exists(mockup_path):
+                            say(f"    - ⚠️ Cảnh báo: Không tìm thấy file ảnh mockup '{mockup_filename}'. Bỏ qua.", WARNING); continue
+                        # <<< KẾT THÚC THAY ĐỔI >>>
                     
-                    with Image.open(mockup_path) as mockup_img:
-                        
-                        obj_w, obj_h = final_design_trimmed.size
-                        frame_w, frame_h = mockup_coords['w'], mockup_coords['h']
-                        
-                        scale_w, scale_h = frame_w / obj_w, frame_h / obj_h
-                        scale = min(scale_w, scale_h)
-
-                        final_w, final_h = int(obj_w * scale), int(obj_h * scale)
-                        resized_final_design = final_design_trimmed.resize((final_w, final_h), Image.Resampling.LANCZOS)
-                        
-                        if scale_w < scale_h: paste_x, paste_y = mockup_coords['x'], mockup_coords['y']
-                        else: paste_x, paste_y = mockup_coords['x'] + (frame_w - final_w) // 2, mockup_coords['y']
-                        
-                        final_mockup = mockup_img.copy().convert("RGBA")
-                        final_mockup.paste(resized_final_design, (paste_x, paste_y), resized_final_design)
-
-                        watermark_desc = cached_data.get("watermark_text")
-                        final_mockup_with_wm = add_watermark(final_mockup, watermark_desc, WATERMARK_DIR, FONT_FILE)
-                        
+                        # Tiêu đề của output (OutputRenderer giữ chỗ tên file trước khi render)
                         prefix = cached_data.get("title_prefix_to_add", "")
                         suffix = cached_data.get("title_suffix_to_add", "")
                         base_name = os.path.splitext(image_filename)[0].replace('-', ' ').replace('_', ' ')
-                        
+                        if len(posterize_levels) > 1:
+                            base_name = f"{base_name} p{posterize_level}"
+                    
                         final_filename_base = f"{prefix} {base_name} {suffix}".strip().replace('  ', ' ')
-                        ext = f".{output_format}"
-                        final_filename = f"{final_filename_base}{ext}"
-
-                        image_to_save = final_mockup_with_wm.convert('RGB')
-                        exif_bytes = create_exif_data(mockup_name, final_filename, exif_defaults)
-                        
-                        img_byte_arr = BytesIO()
-                        save_format = "WEBP" if output_format == "webp" else "JPEG"
-                        image_to_save.save(img_byte_arr, format=save_format, quality=90, exif=exif_bytes)
-                        
-                        images_for_output.setdefault(mockup_name, []).append((final_filename, img_byte_arr.getvalue()))
+                        output_scope = mockup_name
+
+                        final_filename, encoded_files, identical_to = output_renderer.render(
+                            record, design_premul, mockup_name, mockup_path, mockup_coords, final_filename_base, f"{image_filename}|p{posterize_level}",
+                            output_scope, cached_data.get("variants"), cached_data.get("encoding"), cached_data.get("watermark_text")
+                        )
+                        if encoded_files is None:
+                            continue
+
+                        images_for_output.setdefault(mockup_name, []).extend(encoded_files)
+                        designs_for_output[mockup_name] = designs_for_output.get(mockup_name, 0) + 1
                         total_processed_this_run[mockup_name] = total_processed_this_run.get(mockup_name, 0) + 1
         
-        except Exception as e:
-            print(f"❌ Lỗi nghiêm trọng khi xử lý file {image_filename}: {e}")
+        except Exception:
+            pass  # lỗi đã được events.image ghi vào sự kiện của ảnh và in ra console
+
+    events.close()
+    metrics.write_textfile()
+    print_size_distribution(read_events(events.path))
 
     if images_for_output:
         print("\n--- 💾 Bắt đầu lưu ảnh vào các thư mục ---")
         for mockup_name, image_list in images_for_output.items():
-            output_subdir_name = f"{mockup_name}.{run_timestamp}.{len(image_list)}"
+            output_subdir_name = f"{mockup_name}.{run_timestamp}.{designs_for_output[mockup_name]}"
             output_path = os.path.join(OUTPUT_DIR, output_subdir_name)
             os.makedirs(output_path, exist_ok=True)
             print(f"  - Đang tạo và lưu {len(image_list)} ảnh vào: {output_path}")
@@ -266,6 +313,10 @@ def main():
                 with open(os.path.join(output_path, filename), 'wb') as f:
                     f.write(data)
 
+    output_index.close()
+    profiler.close()
+    asset_store.close()
+
     if images_to_process:
         cleanup_input_directory(INPUT_DIR, images_to_process)
 
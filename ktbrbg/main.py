@@ -8,15 +8,19 @@ Script tự động xử lý ảnh cho tool KTBRBG. (Tối ưu từ v30)
 """
 
 import os
-import subprocess
-from datetime import datetime
+from contextlib import nullcontext
 from PIL import Image
 import numpy as np
 import cv2
 
 # Import các hàm dùng chung từ thư mục utils
 # Giả định script này được chạy từ thư mục gốc của ktbproject
-from utils.image_processing import remove_background_advanced, trim_transparent_background
+from utils.image_processing import remove_background_advanced, trim_transparent_background, plan_bg_tiling, ImageBuffer
+from utils.publisher import OutputPublisher
+from utils.memory_governor import MemoryGovernor, estimate_bg_removal_bytes, estimate_canvas_bytes
+from utils.profiler import ImageProfiler
+from utils.event_log import EventLog, say, DEBUG, WARNING
+from utils.metrics_exporter import PipelineMetrics
 
 # ==============================================================================
 # CẤU HÌNH DỰ ÁN KTBRBG
@@ -27,6 +31,7 @@ CANVAS_WIDTH = 4200
 CANVAS_HEIGHT = 4800
 TARGET_DPI = 300
 REFINE_TARGET_SIZE = 10000 # Độ phân giải mục tiêu để tinh chỉnh viền
+MEMORY_BUDGET_MB = 3072 # Ngân sách RSS cho mỗi ảnh (None = không giới hạn, chỉ đo RSS đỉnh)
 
 # ==============================================================================
 # HẾT PHẦN CẤU HÌNH
@@ -37,7 +42,7 @@ def create_hybrid_soft_mask(sharp_mask_cv, blur_ksize=15, erosion_ksize=5):
     - blur_ksize: Độ rộng và độ mềm của viền. Càng lớn càng mềm.
     - erosion_ksize: Độ dày của phần lõi đặc. Càng lớn lõi càng nhỏ.
     """
-    print(f"✨ Tạo mặt nạ lai (Blur: {blur_ksize}px, Erosion: {erosion_ksize}px)...")
+    say(f"✨ Tạo mặt nạ lai (Blur: {blur_ksize}px, Erosion: {erosion_ksize}px)...", DEBUG)
     
     # 1. Tạo mặt nạ viền mềm (như cũ)
     blur_kernel = (blur_ksize if blur_ksize % 2 != 0 else blur_ksize + 1, ) * 2
@@ -53,59 +58,52 @@ def create_hybrid_soft_mask(sharp_mask_cv, blur_ksize=15, erosion_ksize=5):
     
     return hybrid_mask
 
-def git_push_results():
-    """Tự động thêm, commit và push các kết quả lên GitHub."""
-    try:
-        print("\n" + "="*60)
-        print("🚀 Bắt đầu quá trình tự động push lên GitHub...")
-        current_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        commit_message = f"Auto-commit: Processed images via ktbrbg on {current_time}"
-
-        print("   1. Đang thêm các file vào staging area (git add .)...")
-        subprocess.run(["git", "add", "."], check=True, cwd="..") # Thêm cwd để chạy git từ thư mục gốc
-
-        print(f"   2. Đang commit với message: '{commit_message}'...")
-        subprocess.run(["git", "commit", "-m", commit_message], check=True, cwd="..")
-
-        print("   3. Đang đẩy các thay đổi lên remote repository (git push)...")
-        subprocess.run(["git", "push"], check=True, cwd="..")
-
-        print("✅ Push lên GitHub thành công!")
-        print("="*60)
-
-    except FileNotFoundError:
-        print("❌ LỖI: Lệnh 'git' không tồn tại. Hãy chắc chắn rằng bạn đã cài đặt Git.")
-    except subprocess.CalledProcessError as e:
-        print(f"❌ LỖI: Một lệnh Git đã thất bại (mã lỗi: {e.returncode}).")
-        print(f"   Lỗi chi tiết: {e.stderr}")
-    except Exception as e:
-        print(f"❌ Đã có lỗi không xác định xảy ra: {e}")
-
-def process_image(input_path, output_path, magicwand_tolerance):
+def git_push_results(output_files):
+    """Đưa đúng các file kết quả của lần chạy này vào hàng đợi publish (commit + push ở luồng nền)."""
+    print("\n" + "="*60)
+    print(f"🚀 Đưa {len(output_files)} file kết quả vào hàng đợi publish...")
+    project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    publisher = OutputPublisher(project_root, "ktbrbg")
+    publisher.publish(output_files, label="ktbrbg")
+    publisher.close()
+    print("="*60)
+
+def process_image(input_path, output_path, magicwand_tolerance, governor, record=None):
     """
     Quy trình xử lý ảnh chính, sử dụng kỹ thuật mặt nạ lai.
+    Bộ nhớ của bước tách nền và canvas được ước lượng trước qua `governor`.
+    `record` (từ EventLog.image) nhận thời gian từng giai đoạn, output hoặc lý do thất bại.
     """
-    print(f"🚀 Bắt đầu xử lý file: {os.path.basename(input_path)} với Tolerance = {magicwand_tolerance}")
+    stage = record.stage if record is not None else (lambda name: nullcontext())
+    say(f"🚀 Bắt đầu xử lý file: {os.path.basename(input_path)} với Tolerance = {magicwand_tolerance}", DEBUG)
     
     try:
-        original_image = Image.open(input_path).convert("RGBA")
+        with Image.open(input_path) as opened:
+            original_image = ImageBuffer.from_pil(opened)
     except Exception as e:
-        print(f"❌ Lỗi: Không thể đọc file ảnh {input_path}: {e}")
-        return
+        if record is not None:
+            record.fail(f"Không thể đọc file ảnh {input_path}: {e}")
+        return None
 
     # Bước 1 & 2: Tách nền và cắt gọn (giữ nguyên)
-    processed_design = remove_background_advanced(original_image, tolerance=magicwand_tolerance, refine_size=REFINE_TARGET_SIZE)
+    img_w, img_h = original_image.size
+    # File in rất lớn: tách nền theo dải song song (BG_TILING_DEFAULTS), bộ nhớ tạm tỉ lệ với dải
+    tiling = plan_bg_tiling(img_w, img_h)
+    refine_size = governor.plan_refine_size(img_w, img_h, REFINE_TARGET_SIZE, tiling)
+    stage_bytes = estimate_bg_removal_bytes(img_w, img_h, refine_size, tiling) + estimate_canvas_bytes(CANVAS_WIDTH, CANVAS_HEIGHT)
+    with governor.reserve(stage_bytes, os.path.basename(input_path)), stage("bg_removal"):
+        processed_design = remove_background_advanced(original_image, tolerance=magicwand_tolerance, refine_size=refine_size, tiling=tiling)
     trimmed_design = trim_transparent_background(processed_design)
     if not trimmed_design:
-        print("❌ Lỗi: Không tìm thấy đối tượng sau khi tách nền.")
-        return
-    print(f"✅ Tách nền và cắt gọn thành công.")
+        if record is not None:
+            record.skip("empty_design", "Không tìm thấy đối tượng sau khi tách nền.")
+        return None
+    say("✅ Tách nền và cắt gọn thành công.", DEBUG)
 
     # <<< BƯỚC MỚI: TẠO MẶT NẠ LAI VÀ ÁP DỤNG >>>
     try:
         rgb_channels = trimmed_design.convert("RGB")
-        sharp_alpha_channel = trimmed_design.split()[3]
-        sharp_alpha_cv = np.array(sharp_alpha_channel)
+        sharp_alpha_cv = np.ascontiguousarray(trimmed_design.pixels[:, :, 3])
         
         # Gọi hàm tạo mặt nạ lai mới
         hybrid_mask_cv = create_hybrid_soft_mask(
@@ -120,8 +118,8 @@ def process_image(input_path, output_path, magicwand_tolerance):
         final_design.putalpha(hybrid_mask_pil)
 
     except Exception as e:
-        print(f"⚠️ Cảnh báo: Lỗi khi tạo mặt nạ lai, sử dụng ảnh gốc. Lỗi: {e}")
-        final_design = trimmed_design
+        say(f"⚠️ Cảnh báo: Lỗi khi tạo mặt nạ lai, sử dụng ảnh gốc. Lỗi: {e}", WARNING)
+        final_design = trimmed_design.convert("RGBA")
 
     # --- Các bước còn lại sử dụng 'final_design' với viền mềm và lõi đặc ---
     
@@ -136,17 +134,21 @@ def process_image(input_path, output_path, magicwand_tolerance):
     else:
         target_h = CANVAS_HEIGHT
         target_w = int(target_h * img_aspect_ratio)
-    scaled_image = final_design.resize((target_w, target_h), Image.Resampling.LANCZOS)
-    print(f"✅ Scale ảnh. Kích thước mới: {target_w}x{target_h}px")
+    with stage("resize"):
+        scaled_image = final_design.resize((target_w, target_h), Image.Resampling.LANCZOS)
+    say(f"✅ Scale ảnh. Kích thước mới: {target_w}x{target_h}px", DEBUG)
 
     # Bước 5 & 6: Đặt vào khung và Lưu
     canvas = Image.new('RGBA', (CANVAS_WIDTH, CANVAS_HEIGHT), (0, 0, 0, 0))
     paste_x = (CANVAS_WIDTH - target_w) // 2
     paste_y = 0
     canvas.paste(scaled_image, (paste_x, paste_y), mask=scaled_image)
-    canvas.save(output_path, 'PNG', dpi=(TARGET_DPI, TARGET_DPI))
-    print(f"🎉 Hoàn thành! File đã được lưu tại: {output_path}")
-    print("-" * 50)
+    with stage("encode"):
+        canvas.save(output_path, 'PNG', dpi=(TARGET_DPI, TARGET_DPI))
+    if record is not None:
+        record.output(f"tol{magicwand_tolerance}", os.path.basename(output_path), size=os.path.getsize(output_path))
+    say(f"🎉 Hoàn thành! File đã được lưu tại: {output_path}", DEBUG)
+    return output_path
 
 def main():
     print("==========================================================")
@@ -169,11 +171,17 @@ def main():
     total_files = len(files)
     total_processes = total_files * len(tolerances_to_test)
     current_process = 0
+    output_files = []
+    governor = MemoryGovernor(MEMORY_BUDGET_MB)
+    profiler = ImageProfiler.from_argv("ktbrbg")
+    events = EventLog.from_argv("ktbrbg")
+    metrics = PipelineMetrics.for_tool("ktbrbg")
+    events.add_listener(metrics.observe)
     
     for image_file in files:
         for tolerance_value in tolerances_to_test:
             current_process += 1
-            print(f"\n🔄 XỬ LÝ LƯỢT {current_process}/{total_processes} 🔄")
+            say(f"\n🔄 XỬ LÝ LƯỢT {current_process}/{total_processes} 🔄", DEBUG)
             
             input_file_path = os.path.join(INPUT_FOLDER, image_file)
             filename, _ = os.path.splitext(image_file)
@@ -181,12 +189,21 @@ def main():
             output_filename = f"{filename}_tol{tolerance_value}_processed.png"
             output_file_path = os.path.join(OUTPUT_FOLDER, output_filename)
             
-            process_image(input_file_path, output_file_path, tolerance_value)
+            label = f"{image_file} (tol {tolerance_value})"
+            with governor.track_peak(label), \
+                    profiler.image(label, source=input_file_path, rule=f"tolerance {tolerance_value}"), \
+                    events.image(f"[{current_process}/{total_processes}] {label}", input_file_path, profiler=profiler, tolerance=tolerance_value) as record:
+                saved_path = process_image(input_file_path, output_file_path, tolerance_value, governor, record)
+            if saved_path:
+                output_files.append(saved_path)
             
+    profiler.close()
+    events.close()
+    metrics.write_textfile()
     print("\n========================================================")
     print(f"✅✅✅ ĐÃ XỬ LÝ XONG TOÀN BỘ {total_files} ẢNH! ✅✅✅")
     print("========================================================")
-    #git_push_results()
+    #git_push_results(output_files)
 
 if __name__ == "__main__":
     # Thay đổi thư mục làm việc hiện tại thành thư mục chứa file script
@@ -0,0 +1,195 @@
+# utils/asset_store.py
+"""
+Kho tài nguyên (mockup, watermark...) đã giải mã sẵn trong shared memory của hệ điều hành.
+- Mỗi file được giải mã MỘT lần vào một segment `multiprocessing.shared_memory`;
+  các tool khác đang chạy cùng lúc (ktbimage, ktbimg, ...) chỉ việc attach và đọc, không copy.
+- Tên segment sinh từ (đường dẫn, mtime, kích thước) nên khi file mockup thay đổi,
+  tên mới được dùng ngay; segment cũ được process tạo ra nó gỡ bỏ khi phát hiện (refresh).
+- Header của segment có cờ "ready": process tạo ghi pixel xong mới bật cờ, process attach chờ cờ này.
+"""
+import os
+import time
+import threading
+import struct
+import hashlib
+from contextlib import contextmanager
+from multiprocessing import shared_memory
+import numpy as np
+from PIL import Image
+
+from utils.event_log import say, WARNING
+
+HEADER_FORMAT = "<4sIIIII"  # magic, version, ready, height, width, channels
+HEADER_SIZE = 64
+MAGIC = b"KTBA"
+VERSION = 1
+READY_OFFSET = 8
+ATTACH_TIMEOUT = 30.0
+
+MODES_BY_CHANNELS = {1: "L", 3: "RGB", 4: "RGBA"}
+
+
+def asset_key(path):
+    """Tên segment cho phiên bản hiện tại của file (đổi khi file bị sửa/thay thế)."""
+    stat = os.stat(path)
+    raw = f"{os.path.abspath(path)}|{stat.st_mtime_ns}|{stat.st_size}".encode("utf-8")
+    return "ktb_" + hashlib.sha1(raw).hexdigest()[:16]
+
+
+def _untrack(shm):
+    """
+    Trên POSIX (Python < 3.13), resource_tracker gỡ segment khi process thoát,
+    kể cả với process chỉ attach. Bỏ đăng ký để không xoá segment của process khác.
+    """
+    if os.name == "nt":
+        return
+    try:
+        from multiprocessing import resource_tracker
+        resource_tracker.unregister(shm._name, "shared_memory")
+    except Exception:
+        pass
+
+
+def _decode(path):
+    with Image.open(path) as img:
+        has_alpha = img.mode in ("RGBA", "LA", "PA") or (img.mode == "P" and "transparency" in img.info)
+        target_mode = "RGBA" if has_alpha else ("L" if img.mode in ("L", "1") else "RGB")
+        return np.asarray(img.convert(target_mode))
+
+
+class _Segment:
+    def __init__(self, key, shm, array, owner):
+        self.key = key
+        self.shm = shm
+        self.array = array
+        self.owner = owner
+
+
+class AssetStore:
+    """
+    Cửa ngõ đọc tài nguyên dùng chung. Nếu shared memory không dùng được
+    (hoặc enabled=False) thì quay về Image.open như trước.
+    """
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self._segments = {}  # đường dẫn tuyệt đối -> _Segment
+        self._lock = threading.RLock()  # nhiều luồng (domain) có thể cùng xin một mockup
+
+    # --- TẠO / ATTACH ---
+
+    def _create(self, key, path):
+        pixels = _decode(path)
+        if pixels.ndim == 2:
+            pixels = pixels[:, :, None]
+        height, width, channels = pixels.shape
+        try:
+            shm = shared_memory.SharedMemory(name=key, create=True, size=HEADER_SIZE + pixels.nbytes)
+        except FileExistsError:
+            return None  # process khác vừa tạo xong trước, chuyển sang attach
+        struct.pack_into(HEADER_FORMAT, shm.buf, 0, MAGIC, VERSION, 0, height, width, channels)
+        array = np.ndarray((height, width, channels), dtype=np.uint8, buffer=shm.buf, offset=HEADER_SIZE)
+        array[...] = pixels
+        struct.pack_into("<I", shm.buf, READY_OFFSET, 1)  # bật cờ ready SAU khi ghi xong pixel
+        array.flags.writeable = False
+        return _Segment(key, shm, array, owner=True)
+
+    def _attach(self, key):
+        try:
+            shm = shared_memory.SharedMemory(name=key)
+        except FileNotFoundError:
+            return None
+        _untrack(shm)
+        deadline = time.time() + ATTACH_TIMEOUT
+        while True:
+            magic, version, ready, height, width, channels = struct.unpack_from(HEADER_FORMAT, shm.buf, 0)
+            if magic == MAGIC and version == VERSION and ready:
+                break
+            if time.time() > deadline:
+                shm.close()
+                raise TimeoutError(f"Segment '{key}' chưa sẵn sàng sau {ATTACH_TIMEOUT:.0f}s")
+            time.sleep(0.01)
+        array = np.ndarray((height, width, channels), dtype=np.uint8, buffer=shm.buf, offset=HEADER_SIZE)
+        array.flags.writeable = False
+        return _Segment(key, shm, array, owner=False)
+
+    def _segment_for(self, path):
+        path = os.path.abspath(path)
+        key = asset_key(path)
+        with self._lock:
+            segment = self._segments.get(path)
+            if segment and segment.key == key:
+                return segment
+            if segment:
+                self._release(path)  # file đã thay đổi: bỏ phiên bản cũ
+
+            for _ in range(3):
+                segment = self._attach(key) or self._create(key, path)
+                if segment:
+                    self._segments[path] = segment
+                    return segment
+        raise RuntimeError(f"Không thể tạo hoặc attach segment cho '{path}'")
+
+    def _release(self, path):
+        segment = self._segments.pop(path, None)
+        if not segment:
+            return
+        segment.array = None
+        if segment.owner:
+            try:
+                segment.shm.unlink()
+            except FileNotFoundError:
+                pass
+        try:
+            segment.shm.close()
+        except BufferError:
+            pass  # vẫn còn view đang dùng; vùng nhớ được giải phóng khi view cuối cùng bị thu hồi
+
+    # --- API ---
+
+    def get_array(self, path):
+        """View NumPy chỉ-đọc (H, W, C) uint8 của tài nguyên, không copy."""
+        segment = self._segment_for(path)
+        return segment.array[:, :, 0] if segment.array.shape[2] == 1 else segment.array
+
+    def get_image(self, path):
+        """Ảnh PIL chỉ-đọc dựng trực tiếp trên shared memory (Image.frombuffer, không copy)."""
+        array = self._segment_for(path).array
+        height, width, channels = array.shape
+        mode = MODES_BY_CHANNELS[channels]
+        return Image.frombuffer(mode, (width, height), array, "raw", mode, 0, 1)
+
+    @contextmanager
+    def open_image(self, path):
+        """
+        Thay thế cho `with Image.open(path) as img:`; dùng shared memory khi có thể.
+        Ảnh trả về chỉ-đọc: cần .copy()/.convert() trước khi sửa.
+        """
+        if not self.enabled:
+            with Image.open(path) as img:
+                yield img
+            return
+        try:
+            image = self.get_image(path)
+        except Exception as e:
+            say(f"  - ⚠️ Asset store không dùng được cho '{os.path.basename(path)}' ({e}), đọc file trực tiếp.", WARNING)
+            with Image.open(path) as img:
+                yield img
+            return
+        yield image
+
+    def refresh(self):
+        """Kiểm tra lại các file đã nạp; file nào đổi/mất thì gỡ phiên bản cũ (lần đọc sau tự nạp bản mới)."""
+        with self._lock:
+            for path, segment in list(self._segments.items()):
+                try:
+                    changed = asset_key(path) != segment.key
+                except FileNotFoundError:
+                    changed = True
+                if changed:
+                    self._release(path)
+
+    def close(self):
+        with self._lock:
+            for path in list(self._segments):
+                self._release(path)
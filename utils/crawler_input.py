@@ -0,0 +1,128 @@
+# utils/crawler_input.py
+"""
+Đọc dữ liệu đầu vào từ repo imagecrawler (imagecrawler.log và domain/<domain>.txt) với bộ nhớ giới hạn.
+- File URL: URL mới nằm ở đầu file, nên chỉ stream đúng số dòng đầu cần đọc, không nạp cả file
+  (không lưu chỉ mục: crawler chèn dòng mới lên đầu nên offset cũ không còn dùng được).
+- Log: vị trí đã parse tới và kết quả tạm được lưu giữa các lần chạy, lần sau chỉ parse phần mới
+  được ghi thêm; chỉ mục tự bỏ khi log bị ghi đè/cắt ngắn (kiểm tra kích thước + dấu vân tay phần đầu file).
+"""
+import os
+import json
+import hashlib
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+INDEX_FILE = os.path.join(PROJECT_ROOT, ".crawler_index", "offsets.json")
+
+HEAD_FINGERPRINT_BYTES = 4096
+NEW_IMAGES_MARKER = "New Images"
+
+
+def _head_fingerprint(f, length):
+    f.seek(0)
+    return hashlib.sha1(f.read(min(length, HEAD_FINGERPRINT_BYTES))).hexdigest()
+
+
+def _fingerprint_before(f, offset):
+    """Dấu vân tay của đoạn ngay trước `offset` (phát hiện log bị ghi đè nhưng phần đầu giống hệt)."""
+    start = max(0, offset - HEAD_FINGERPRINT_BYTES)
+    f.seek(start)
+    return hashlib.sha1(f.read(offset - start)).hexdigest()
+
+
+def _decode_line(raw):
+    return raw.decode("utf-8", errors="replace").rstrip("\r\n")
+
+
+def parse_new_images_line(line):
+    """'<domain>: <n> New Images ...' -> (domain, n); trả về None nếu không phải dòng tổng kết hợp lệ."""
+    if NEW_IMAGES_MARKER not in line:
+        return None
+    parts = line.split(":")
+    try:
+        return parts[0].strip(), int(parts[1].split()[0])
+    except (IndexError, ValueError):
+        return None
+
+
+class CrawlerInput:
+    """Chỉ mục offset dùng chung cho các file đầu vào của crawler; gọi save() khi kết thúc."""
+
+    def __init__(self, index_path=INDEX_FILE):
+        self.index_path = index_path
+        try:
+            with open(index_path, "r", encoding="utf-8") as f:
+                self._index = json.load(f)
+        except (OSError, ValueError):
+            self._index = {}
+        # Bỏ chỉ mục offset của file URL do phiên bản cũ ghi (không còn dùng)
+        self._index = {key: entry for key, entry in self._index.items() if "line_offsets" not in entry}
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.index_path), exist_ok=True)
+        tmp_path = f"{self.index_path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self._index, f, ensure_ascii=False)
+        os.replace(tmp_path, self.index_path)
+
+    def _entry(self, path, f):
+        """Lấy chỉ mục của file nếu vẫn còn hợp lệ (file chỉ được ghi thêm), nếu không thì tạo mới."""
+        key = os.path.abspath(path)
+        size = os.fstat(f.fileno()).st_size
+        entry = self._index.get(key)
+        if entry:
+            fingerprint_ok = entry["head"] == _head_fingerprint(f, entry["size"])
+            if fingerprint_ok and size >= entry["size"]:
+                entry["size"] = size
+                return entry
+        entry = {"size": size, "head": None}
+        self._index[key] = entry
+        return entry
+
+    # --- FILE URL: ĐỌC CÁC DÒNG ĐẦU ---
+
+    def read_lines(self, path, count):
+        """Trả về tối đa `count` dòng đầu của file (giống f.read().splitlines()[:count]), chỉ đọc phần cần thiết."""
+        lines = []
+        if count <= 0:
+            return lines
+        with open(path, "rb") as f:
+            for raw in f:
+                lines.append(_decode_line(raw))
+                if len(lines) >= count:
+                    break
+        return lines
+
+    # --- LOG CỦA CRAWLER: PARSE TĂNG DẦN ---
+
+    def new_image_counts(self, log_path):
+        """
+        Parse các dòng '<domain>: <n> New Images' của log, chỉ đọc phần mới ghi thêm kể từ lần trước.
+        Kết quả giống cách parse cả file: giá trị dương cuối cùng của mỗi domain, giữ thứ tự xuất hiện.
+        """
+        with open(log_path, "rb") as f:
+            entry = self._entry(log_path, f)
+            if entry.get("log_offset") and entry.get("tail") != _fingerprint_before(f, entry["log_offset"]):
+                entry = {"size": entry["size"], "head": None}
+                self._index[os.path.abspath(log_path)] = entry
+            counts = entry.setdefault("counts", {})
+            f.seek(entry.setdefault("log_offset", 0))
+
+            while True:
+                raw = f.readline()
+                if not raw or not raw.endswith(b"\n"):
+                    break  # dòng cuối chưa ghi xong: để lần sau parse
+                entry["log_offset"] = f.tell()
+                parsed = parse_new_images_line(_decode_line(raw))
+                if parsed and parsed[1] > 0:
+                    counts[parsed[0]] = parsed[1]
+
+            # Dòng cuối không có '\n' vẫn được tính cho lần chạy này nhưng không lưu offset
+            result = dict(counts)
+            if raw and not raw.endswith(b"\n"):
+                parsed = parse_new_images_line(_decode_line(raw))
+                if parsed and parsed[1] > 0:
+                    result[parsed[0]] = parsed[1]
+
+            entry["tail"] = _fingerprint_before(f, entry["log_offset"])
+            entry["head"] = _head_fingerprint(f, entry["size"])
+        return result
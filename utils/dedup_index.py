@@ -0,0 +1,215 @@
+# utils/dedup_index.py
+"""
+Chỉ mục perceptual hash (pHash) để phát hiện cùng một design bị crawl từ nhiều store/nhiều lần chạy.
+- Hash 64-bit được tính trên ảnh đã crop, TRƯỚC khi tách nền và ghép mockup.
+- Lưu trong SQLite (WAL); tra cứu Hamming nhanh bằng cách chia hash thành 8 band 8-bit:
+  hai hash cách nhau <= 7 bit chắc chắn trùng ít nhất một band (nguyên lý chuồng bồ câu),
+  nên chỉ cần so khoảng cách đầy đủ với các ứng viên trùng band.
+- Bản trùng được ghi lại (liên kết tới design gốc và các output đã tạo) thay vì render lại.
+- Design mới được ghi ở trạng thái chờ (pending, theo phiên chạy) cho tới khi zip/thư mục output của domain
+  đã ghi xong; chỉ phiên tạo ra nó mới thấy mục chờ, nên lần chạy lỗi giữa chừng không chặn design mãi mãi.
+"""
+import os
+import json
+import time
+import uuid
+import sqlite3
+import threading
+import cv2
+import numpy as np
+from PIL import Image
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEDUP_DB_FILE = os.path.join(PROJECT_ROOT, ".dedup", "phash.db")
+
+HASH_BITS = 64
+NUM_BANDS = 8
+BAND_BITS = HASH_BITS // NUM_BANDS
+MAX_SUPPORTED_DISTANCE = NUM_BANDS - 1
+DEFAULT_MAX_DISTANCE = 4
+STALE_PENDING_SECONDS = 24 * 3600  # mục chờ của phiên khác quá hạn này bị xoá khi mở chỉ mục
+
+
+# --- TÍNH HASH ---
+
+def phash(image_pil):
+    """pHash 64-bit: DCT của ảnh xám 32x32, so 8x8 hệ số tần số thấp với trung vị."""
+    small = image_pil.convert('L').resize((32, 32), Image.Resampling.BOX)
+    dct = cv2.dct(np.asarray(small, dtype=np.float32))
+    low = dct[:8, :8].flatten()
+    bits = low > np.median(low[1:])
+    value = 0
+    for bit in bits:
+        value = (value << 1) | int(bit)
+    return value
+
+
+def hamming_distance(a, b):
+    return bin(a ^ b).count("1")
+
+
+def _to_signed(value):
+    """SQLite chỉ lưu số nguyên có dấu 64-bit."""
+    return value - (1 << HASH_BITS) if value >= (1 << (HASH_BITS - 1)) else value
+
+
+def _to_unsigned(value):
+    return value + (1 << HASH_BITS) if value < 0 else value
+
+
+def _bands(value):
+    mask = (1 << BAND_BITS) - 1
+    return [(band, (value >> (band * BAND_BITS)) & mask) for band in range(NUM_BANDS)]
+
+
+# --- CHỈ MỤC ---
+
+class DedupIndex:
+    """
+    Chỉ mục pHash bền vững dùng chung cho mọi domain và mọi lần chạy.
+    max_distance: số bit khác nhau tối đa để coi là trùng (tối đa 7).
+    """
+
+    def __init__(self, db_path=DEDUP_DB_FILE, max_distance=DEFAULT_MAX_DISTANCE):
+        self.db_path = db_path
+        self.max_distance = max(0, min(int(max_distance), MAX_SUPPORTED_DISTANCE))
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        # Dùng chung một kết nối cho các luồng xử lý domain, tuần tự hoá bằng lock
+        self._conn = sqlite3.connect(db_path, timeout=30, check_same_thread=False)
+        self._lock = threading.Lock()
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        with self._conn:
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS designs (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    phash INTEGER NOT NULL,
+                    ts REAL NOT NULL,
+                    tool TEXT NOT NULL,
+                    domain TEXT,
+                    filename TEXT NOT NULL,
+                    url TEXT,
+                    outputs TEXT,
+                    pending TEXT
+                )
+            """)
+            columns = [row[1] for row in self._conn.execute("PRAGMA table_info(designs)")]
+            if "pending" not in columns:
+                self._conn.execute("ALTER TABLE designs ADD COLUMN pending TEXT")
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS bands (
+                    band INTEGER NOT NULL,
+                    value INTEGER NOT NULL,
+                    design_id INTEGER NOT NULL
+                )
+            """)
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_bands ON bands (band, value)")
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS duplicates (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    design_id INTEGER NOT NULL,
+                    ts REAL NOT NULL,
+                    tool TEXT NOT NULL,
+                    domain TEXT,
+                    filename TEXT NOT NULL,
+                    url TEXT,
+                    distance INTEGER NOT NULL
+                )
+            """)
+        self.session = uuid.uuid4().hex
+        self._drop_stale_pending()
+
+    def _drop_stale_pending(self):
+        """Xoá design chờ của các phiên cũ đã chết trước khi ghi xong output."""
+        with self._lock, self._conn:
+            stale = [row[0] for row in self._conn.execute(
+                "SELECT id FROM designs WHERE pending IS NOT NULL AND pending != ? AND ts < ?",
+                (self.session, time.time() - STALE_PENDING_SECONDS)
+            )]
+            self._delete_locked(stale)
+
+    def _delete_locked(self, design_ids):
+        if not design_ids:
+            return
+        placeholders = ",".join("?" * len(design_ids))
+        self._conn.execute(f"DELETE FROM duplicates WHERE design_id IN ({placeholders})", design_ids)
+        self._conn.execute(f"DELETE FROM bands WHERE design_id IN ({placeholders})", design_ids)
+        self._conn.execute(f"DELETE FROM designs WHERE id IN ({placeholders})", design_ids)
+
+    def lookup(self, hash_value, exclude_url=None):
+        """
+        Tìm design gần nhất trong phạm vi max_distance (bỏ qua mục chờ của phiên khác
+        và mục của chính `exclude_url`, để một ảnh không bị coi là trùng với chính nó).
+        Trả về dict {id, domain, filename, url, outputs, distance, covered} hoặc None;
+        covered = tập mockup set đã có output ở mọi design khớp (cùng design có thể đã render ở nhiều lần/nhiều store).
+        """
+        clauses = " OR ".join(["(band = ? AND value = ?)"] * NUM_BANDS)
+        params = [p for band in _bands(hash_value) for p in band] + [self.session]
+        url_clause = ""
+        if exclude_url is not None:
+            url_clause = "AND (d.url IS NULL OR d.url != ?)"
+            params.append(exclude_url)
+        with self._lock:
+            rows = self._conn.execute(f"""
+                SELECT d.id, d.phash, d.domain, d.filename, d.url, d.outputs
+                FROM designs d
+                WHERE d.id IN (SELECT design_id FROM bands WHERE {clauses})
+                  AND (d.pending IS NULL OR d.pending = ?) {url_clause}
+            """, params).fetchall()
+
+        best, covered = None, set()
+        for design_id, stored, domain, filename, url, outputs in rows:
+            distance = hamming_distance(hash_value, _to_unsigned(stored))
+            if distance > self.max_distance:
+                continue
+            outputs = json.loads(outputs) if outputs else {}
+            covered.update(outputs)
+            if best is None or distance < best["distance"]:
+                best = {
+                    "id": design_id, "domain": domain, "filename": filename, "url": url,
+                    "outputs": outputs, "distance": distance
+                }
+        if best is not None:
+            best["covered"] = covered
+        return best
+
+    def add(self, hash_value, tool_name, domain, filename, url=None, outputs=None, pending=False):
+        """
+        Ghi một design mới (sau khi đã render thành công) cùng các output của nó.
+        pending=True: mục chờ, chỉ phiên này thấy cho tới khi commit() (output đã ghi ra đĩa) hoặc discard().
+        """
+        with self._lock, self._conn:
+            cursor = self._conn.execute(
+                "INSERT INTO designs (phash, ts, tool, domain, filename, url, outputs, pending) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (_to_signed(hash_value), time.time(), tool_name, domain, filename, url,
+                 json.dumps(outputs or {}, ensure_ascii=False), self.session if pending else None)
+            )
+            design_id = cursor.lastrowid
+            self._conn.executemany(
+                "INSERT INTO bands (band, value, design_id) VALUES (?, ?, ?)",
+                [(band, value, design_id) for band, value in _bands(hash_value)]
+            )
+        return design_id
+
+    def commit(self, design_id, outputs):
+        """Chốt một design chờ với các output thực sự đã được ghi ra."""
+        with self._lock, self._conn:
+            self._conn.execute(
+                "UPDATE designs SET pending = NULL, outputs = ? WHERE id = ?",
+                (json.dumps(outputs, ensure_ascii=False), design_id)
+            )
+
+    def discard(self, design_ids):
+        """Bỏ các design chờ mà output không ghi được (cùng các liên kết trùng tới chúng)."""
+        with self._lock, self._conn:
+            self._delete_locked(list(design_ids))
+
+    def link_duplicate(self, match, tool_name, domain, filename, url=None):
+        """Ghi nhận một bản trùng, liên kết tới design gốc (không render lại)."""
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT INTO duplicates (design_id, ts, tool, domain, filename, url, distance) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (match["id"], time.time(), tool_name, domain, filename, url, match["distance"])
+            )
+
+    def close(self):
+        self._conn.close()
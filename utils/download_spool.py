@@ -0,0 +1,151 @@
+# utils/download_spool.py
+"""
+Spool ảnh gốc đã tải, để chuyển giao từ ktbimage sang ktbimg mà không phải tải lại.
+- ktbimage: URL đã tải về nhưng bị đẩy sang file skip (không có tọa độ, skip màu, lỗi...) được lưu
+  nguyên bytes gốc vào spool, khoá theo URL.
+- ktbimg: đọc spool trước, chỉ tải qua mạng khi không có mục hoặc mục đã hết hạn.
+- Manifest (SQLite, dùng chung giữa các process) ghi URL, file blob, số byte, domain và thời điểm lưu;
+  blob là file <sha1 của URL>.bin trong thư mục spool.
+- Giới hạn dung lượng (max_mb): vượt thì xoá mục cũ nhất; mục quá hạn (ttl_hours) bị xoá khi gặp hoặc khi dọn.
+"""
+import os
+import time
+import sqlite3
+import hashlib
+import threading
+
+from utils.event_log import say, DEBUG, WARNING
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SPOOL_DIR = os.path.join(PROJECT_ROOT, ".spool")
+DEFAULT_MAX_MB = 1024
+DEFAULT_TTL_HOURS = 48
+
+
+def _blob_name(url):
+    return f"{hashlib.sha1(url.encode('utf-8')).hexdigest()}.bin"
+
+
+class DownloadSpool:
+    """
+    Kho bytes ảnh gốc theo URL, có giới hạn dung lượng và thời hạn.
+    Dùng chung một kết nối cho các luồng xử lý domain, tuần tự hoá bằng lock.
+    """
+
+    def __init__(self, spool_dir=SPOOL_DIR, max_mb=DEFAULT_MAX_MB, ttl_hours=DEFAULT_TTL_HOURS):
+        self.spool_dir = spool_dir
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self.ttl_seconds = ttl_hours * 3600
+        os.makedirs(spool_dir, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(os.path.join(spool_dir, "manifest.db"), timeout=30, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        with self._conn:
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS entries (
+                    url TEXT PRIMARY KEY,
+                    blob TEXT NOT NULL,
+                    bytes INTEGER NOT NULL,
+                    domain TEXT,
+                    tool TEXT NOT NULL,
+                    ts REAL NOT NULL
+                )
+            """)
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_entries_ts ON entries (ts)")
+
+    @classmethod
+    def from_config(cls, config=None):
+        """config = defaults['download_spool']: {"enabled", "max_mb", "ttl_hours"}; tắt thì trả về None."""
+        config = config or {}
+        if not config.get("enabled", True):
+            return None
+        return cls(max_mb=config.get("max_mb", DEFAULT_MAX_MB), ttl_hours=config.get("ttl_hours", DEFAULT_TTL_HOURS))
+
+    def _remove_locked(self, urls_and_blobs):
+        for url, blob in urls_and_blobs:
+            self._conn.execute("DELETE FROM entries WHERE url = ?", (url,))
+            try:
+                os.remove(os.path.join(self.spool_dir, blob))
+            except FileNotFoundError:
+                pass
+
+    def put(self, url, data, domain=None, tool="ktbimage"):
+        """Lưu bytes gốc của `url` (ghi đè mục cũ). Trả về True nếu đã lưu."""
+        if not data or len(data) > self.max_bytes:
+            return False
+        blob = _blob_name(url)
+        path = os.path.join(self.spool_dir, blob)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            say(f"  - ⚠️ Không ghi được spool cho {url}: {e}", WARNING)
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return False
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO entries (url, blob, bytes, domain, tool, ts) VALUES (?, ?, ?, ?, ?, ?)",
+                (url, blob, len(data), domain, tool, time.time())
+            )
+            self._evict_locked()
+        return True
+
+    def get(self, url):
+        """Bytes gốc của `url`, hoặc None nếu không có, đã hết hạn hoặc file blob bị mất."""
+        with self._lock:
+            row = self._conn.execute("SELECT blob, bytes, ts FROM entries WHERE url = ?", (url,)).fetchone()
+            if row is None:
+                return None
+            blob, size, ts = row
+            if time.time() - ts > self.ttl_seconds:
+                with self._conn:
+                    self._remove_locked([(url, blob)])
+                return None
+            try:
+                with open(os.path.join(self.spool_dir, blob), "rb") as f:
+                    data = f.read()
+            except OSError:
+                data = None
+            if data is None or len(data) != size:
+                with self._conn:
+                    self._remove_locked([(url, blob)])
+                return None
+        return data
+
+    def discard(self, urls):
+        """Xoá các mục đã dùng xong (vd: file txt của ktbimg đã xử lý và bị xoá)."""
+        with self._lock, self._conn:
+            placeholders = ",".join("?" * len(urls))
+            rows = self._conn.execute(f"SELECT url, blob FROM entries WHERE url IN ({placeholders})", list(urls)).fetchall() if urls else []
+            self._remove_locked(rows)
+        return len(rows)
+
+    def _evict_locked(self):
+        """Xoá mục hết hạn, rồi xoá mục cũ nhất cho tới khi tổng dung lượng <= max_bytes."""
+        expired = self._conn.execute(
+            "SELECT url, blob FROM entries WHERE ts < ?", (time.time() - self.ttl_seconds,)
+        ).fetchall()
+        self._remove_locked(expired)
+        total = self._conn.execute("SELECT COALESCE(SUM(bytes), 0) FROM entries").fetchone()[0]
+        if total <= self.max_bytes:
+            return len(expired)
+        evicted = []
+        for url, blob, size in self._conn.execute("SELECT url, blob, bytes FROM entries ORDER BY ts").fetchall():
+            if total <= self.max_bytes:
+                break
+            evicted.append((url, blob))
+            total -= size
+        self._remove_locked(evicted)
+        say(f"  - 🧹 Spool vượt {self.max_bytes // (1024 * 1024)} MB: đã xoá {len(evicted)} ảnh cũ nhất.", DEBUG)
+        return len(expired) + len(evicted)
+
+    def prune(self):
+        """Dọn mục hết hạn / vượt dung lượng (gọi đầu mỗi lần chạy)."""
+        with self._lock, self._conn:
+            return self._evict_locked()
+
+    def close(self):
+        self._conn.close()
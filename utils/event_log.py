@@ -0,0 +1,296 @@
+# utils/event_log.py
+"""
+Nhật ký sự kiện có cấu trúc cho các tool, thay cho các print() trong vòng lặp xử lý ảnh.
+- Mỗi ảnh/URL là một sự kiện JSONL: rule, màu nền, thời gian từng giai đoạn, các output, lý do skip.
+- Sự kiện và dòng console đi qua một hàng đợi, luồng nền ghi theo lô (file có buffer, console ghi gộp)
+  nên vòng lặp không bị chặn bởi console (chậm trên Windows) hay ổ đĩa.
+- Console lọc theo mức verbosity: quiet (chỉ cảnh báo/lỗi), info (một dòng mỗi ảnh), debug (từng bước).
+- File nằm trong .events/<tool>.<thời gian>.<pid>.jsonl, giữ lại keep_runs lần chạy gần nhất của mỗi tool.
+Cách dùng trong code: say("...", DEBUG) thay cho print; events.image(...) bao quanh một ảnh.
+"""
+import os
+import sys
+import json
+import time
+import queue
+import atexit
+import argparse
+import threading
+from contextlib import contextmanager, nullcontext
+from datetime import datetime
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+EVENTS_DIR = os.path.join(PROJECT_ROOT, ".events")
+
+DEBUG, INFO, WARNING, ERROR = 10, 20, 30, 40
+VERBOSITY_LEVELS = {"debug": DEBUG, "info": INFO, "quiet": WARNING}
+LEVEL_NAMES = {DEBUG: "debug", INFO: "info", WARNING: "warning", ERROR: "error"}
+
+DEFAULT_VERBOSITY = "info"
+DEFAULT_KEEP_RUNS = 50
+FILE_BUFFER_BYTES = 256 * 1024
+FLUSH_INTERVAL_SECONDS = 2.0   # Sự kiện nằm trong buffer tối đa chừng này khi tool đang chạy
+MAX_BATCH = 500                # Số mục tối đa gộp trong một lần ghi
+
+_EVENT, _CONSOLE, _FLUSH, _STOP = "event", "console", "flush", "stop"
+
+_active_log = None
+
+
+def say(message, level=INFO):
+    """
+    Thay cho print() trong các đoạn code chạy theo từng ảnh.
+    Khi có EventLog đang mở: lọc theo verbosity và ghi qua luồng nền; nếu không thì print như cũ.
+    """
+    log = _active_log
+    if log is None:
+        print(message)
+    else:
+        log.console(message, level)
+
+
+def parse_event_log_args(argv=None):
+    """Đọc --verbosity quiet|info|debug từ dòng lệnh (bỏ qua các tham số khác)."""
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument("--verbosity", choices=sorted(VERBOSITY_LEVELS))
+    args, _ = parser.parse_known_args(sys.argv[1:] if argv is None else argv)
+    return args
+
+
+def read_events(path, event=None):
+    """Đọc lại các sự kiện của một lần chạy (lọc theo loại nếu có)."""
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue  # dòng cuối bị cắt dở khi tool bị dừng giữa chừng
+            if event is None or record.get("event") == event:
+                yield record
+
+
+def _prune_old_runs(events_dir, tool_name, keep_runs):
+    prefix = f"{tool_name}."
+    runs = sorted(name for name in os.listdir(events_dir) if name.startswith(prefix) and name.endswith(".jsonl"))
+    for name in runs[:max(0, len(runs) - keep_runs)]:
+        try:
+            os.remove(os.path.join(events_dir, name))
+        except OSError:
+            pass
+
+
+def _write_console(text):
+    try:
+        sys.stdout.write(text)
+    except UnicodeEncodeError:
+        # Console Windows không phải UTF-8: thay ký tự không in được thay vì làm hỏng lần chạy
+        encoding = sys.stdout.encoding or "ascii"
+        sys.stdout.write(text.encode(encoding, errors="replace").decode(encoding))
+    sys.stdout.flush()
+
+
+class _ImageEvent:
+    """Gom thông tin của một ảnh, ghi thành một sự kiện 'image' khi ảnh xử lý xong."""
+
+    def __init__(self, log, label, source, profiler, fields):
+        self.label = label
+        self.fields = dict(fields)
+        self.stages_ms = {}
+        self.outputs = []
+        self.status = None
+        self.message = None
+        self._log = log
+        self._source = source
+        self._profiler = profiler
+        self._started = time.perf_counter()
+
+    def set(self, **fields):
+        """Bổ sung thông tin cho sự kiện (rule, color, bg_profile...)."""
+        self.fields.update(fields)
+
+    @contextmanager
+    def stage(self, name):
+        """Đo thời gian một giai đoạn (cộng dồn nếu lặp lại); đồng thời là giai đoạn của profiler nếu có."""
+        started = time.perf_counter()
+        try:
+            with self._profiler.stage(name) if self._profiler is not None else nullcontext():
+                yield
+        finally:
+            self.stages_ms[name] = self.stages_ms.get(name, 0.0) + (time.perf_counter() - started) * 1000
+
+    def output(self, mockup, filename, size=None, identical_to=None, **fields):
+        """
+        Ghi nhận một output; identical_to = tên output cũ giống hệt (không encode lại, dùng lại bytes của nó).
+        fields: thông tin encode thêm (quality, max_bytes, files của các biến thể...).
+        """
+        entry = {"mockup": mockup, "file": filename}
+        if size is not None:
+            entry["bytes"] = size
+        if identical_to:
+            entry["identical_to"] = identical_to
+        entry.update(fields)
+        self.outputs.append(entry)
+
+    def skip(self, reason, message=None):
+        """Đánh dấu ảnh bị bỏ qua; reason là mã ngắn để thống kê, message để hiển thị."""
+        self.status, self.fields["skip_reason"], self.message = "skipped", reason, message
+
+    def fail(self, error):
+        self.status, self.fields["error"], self.message = "error", str(error), str(error)
+
+    def _finish(self):
+        total_ms = (time.perf_counter() - self._started) * 1000
+        status = self.status or ("processed" if self.outputs else "no_output")
+        record = {"label": self.label, "source": self._source, "status": status}
+        record.update(self.fields)
+        record["stages_ms"] = {name: round(ms, 1) for name, ms in self.stages_ms.items()}
+        record["total_ms"] = round(total_ms, 1)
+        record["outputs"] = self.outputs
+        self._log.event("image", **record)
+
+        if status == "processed":
+            rendered = sum(1 for entry in self.outputs if not entry.get("identical_to"))
+            self._log.console(f"  ✅ {self.label}: {rendered}/{len(self.outputs)} output ({total_ms / 1000:.2f}s)", INFO)
+        elif status == "skipped":
+            self._log.console(f"  ⏩ {self.label}: {self.message or self.fields['skip_reason']}", INFO)
+        elif status == "error":
+            self._log.console(f"  ❌ {self.label}: {self.message}", ERROR)
+        else:
+            self._log.console(f"  ⚠️ {self.label}: không tạo được output nào.", WARNING)
+
+
+class EventLog:
+    """Ghi sự kiện JSONL và console qua một luồng nền; dùng chung cho mọi tool qua EventLog.from_argv(...)."""
+
+    def __init__(self, tool_name, verbosity=DEFAULT_VERBOSITY, events_dir=EVENTS_DIR, keep_runs=DEFAULT_KEEP_RUNS):
+        global _active_log
+        self.tool_name = tool_name
+        self.console_level = VERBOSITY_LEVELS.get(verbosity, INFO)
+        os.makedirs(events_dir, exist_ok=True)
+        _prune_old_runs(events_dir, tool_name, max(1, keep_runs) - 1)
+        self.path = os.path.join(events_dir, f"{tool_name}.{datetime.now().strftime('%Y%m%d_%H%M%S')}.{os.getpid()}.jsonl")
+        self._file = open(self.path, "a", encoding="utf-8", buffering=FILE_BUFFER_BYTES)
+        self._queue = queue.SimpleQueue()
+        self._listeners = []
+        self._closed = False
+        self._started = time.time()
+        self._thread = threading.Thread(target=self._run, name=f"event-log-{tool_name}", daemon=True)
+        self._thread.start()
+        _active_log = self
+        atexit.register(self.close)
+        self.event("run_start", verbosity=verbosity, argv=sys.argv[1:])
+
+    @classmethod
+    def from_argv(cls, tool_name, config=None, argv=None):
+        """config = defaults['event_log'] trong config.json; --verbosity trên dòng lệnh được ưu tiên."""
+        config = config or {}
+        args = parse_event_log_args(argv)
+        verbosity = args.verbosity or config.get("verbosity", DEFAULT_VERBOSITY)
+        return cls(tool_name, verbosity=verbosity, keep_runs=config.get("keep_runs", DEFAULT_KEEP_RUNS))
+
+    # --- API ---
+
+    def event(self, kind, **fields):
+        """Ghi một sự kiện; fields phải serialize được bằng JSON và không bị sửa sau khi gọi."""
+        if self._closed:
+            return
+        self._queue.put((_EVENT, {"event": kind, "ts": time.time(), "tool": self.tool_name, **fields}))
+
+    def console(self, message, level=INFO):
+        if self._closed:
+            print(message)
+            return
+        if level >= WARNING:
+            self.event("message", level=LEVEL_NAMES.get(level, "warning"), message=message.strip())
+        if level >= self.console_level:
+            self._queue.put((_CONSOLE, message))
+
+    @contextmanager
+    def image(self, label, source=None, profiler=None, **fields):
+        """Bao một ảnh/URL; trả về đối tượng để gắn thông tin, đo giai đoạn, ghi output hoặc skip."""
+        record = _ImageEvent(self, label, source, profiler, fields)
+        try:
+            yield record
+        except BaseException as e:
+            if record.status is None:
+                record.fail(e)
+            raise
+        finally:
+            record._finish()
+
+    def skipped(self, label, source, reason, message=None, **fields):
+        """Ghi nhanh một ảnh bị bỏ qua trước khi bắt đầu xử lý."""
+        with self.image(label, source, **fields) as record:
+            record.skip(reason, message)
+
+    def add_listener(self, callback):
+        """
+        Đăng ký hàm nhận từng sự kiện (vd: bộ đếm metrics). Hàm được gọi trên luồng ghi nền,
+        sau khi sự kiện đã vào file, nên không làm chậm vòng lặp xử lý ảnh.
+        """
+        self._listeners.append(callback)
+
+    def flush(self):
+        """Chờ luồng nền ghi hết những gì đã gửi (gọi trước input() hoặc trước khi đọc lại file sự kiện)."""
+        if self._closed:
+            return
+        done = threading.Event()
+        self._queue.put((_FLUSH, done))
+        done.wait()
+
+    def close(self):
+        global _active_log
+        if self._closed:
+            return
+        self.event("run_end", duration_s=round(time.time() - self._started, 3))
+        self._closed = True
+        self._queue.put((_STOP, None))
+        self._thread.join()
+        if _active_log is self:
+            _active_log = None
+
+    # --- LUỒNG GHI NỀN ---
+
+    def _run(self):
+        while True:
+            try:
+                batch = [self._queue.get(timeout=FLUSH_INTERVAL_SECONDS)]
+            except queue.Empty:
+                self._file.flush()
+                continue
+            while len(batch) < MAX_BATCH:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            console_lines, waiters, stop = [], [], False
+            for kind, payload in batch:
+                if kind == _EVENT:
+                    self._file.write(json.dumps(payload, ensure_ascii=False, default=str) + "\n")
+                    for callback in self._listeners:
+                        try:
+                            callback(payload)
+                        except Exception as e:
+                            console_lines.append(f"  - ⚠️ Lỗi khi xử lý sự kiện '{payload.get('event')}': {e}")
+                elif kind == _CONSOLE:
+                    console_lines.append(payload)
+                elif kind == _FLUSH:
+                    waiters.append(payload)
+                else:
+                    stop = True
+            if console_lines:
+                try:
+                    _write_console("\n".join(console_lines) + "\n")
+                except (OSError, ValueError):
+                    pass  # console đã đóng: vẫn tiếp tục ghi file sự kiện
+            if waiters or stop:
+                self._file.flush()
+                for done in waiters:
+                    done.set()
+            if stop:
+                self._file.close()
+                return
@@ -2,11 +2,18 @@
 import os
 import json
 import re
-import piexif
-from datetime import datetime, timedelta
+from datetime import datetime
 import random
-import requests
 import pytz
+from utils.notifier import enqueue_telegram_message
+from utils.event_log import say, DEBUG, WARNING
+from utils.metrics_store import (
+    METRICS_DB_FILE,
+    record_counts,
+    daily_totals,
+    import_legacy_total_file,
+    render_total_image_view
+)
 
 # --- CÁC HÀM ĐỌC/GHI FILE VÀ CONFIG ---
 
@@ -23,63 +30,35 @@ def load_config(config_path): # <--- Nhận vào config_path
         print(f"Lỗi: File '{config_path}' không phải là file JSON hợp lệ.")
         return {}
 
-def update_total_image_count(filepath, new_counts, tool_name):
+def update_total_image_count(filepath, new_counts, tool_name, domain_counts=None, db_path=METRICS_DB_FILE):
     """
-    Đọc, cập nhật và ghi lại file TotalImage.txt với logic reset theo ngày.
+    Ghi số ảnh của lần chạy này vào kho số liệu append-only, sau đó render lại
+    view TotalImage.txt (reset theo ngày, GMT+7) từ kho.
+    - new_counts: {mockup: số ảnh} của cả lần chạy.
+    - domain_counts: (tùy chọn) {domain: {mockup: số ảnh}} để lưu chi tiết theo domain.
     """
     print(f"📊 Bắt đầu cập nhật file thống kê: {os.path.basename(filepath)}...")
-    
-    # Lấy ngày hiện tại theo múi giờ GMT+7
-    gmt7 = pytz.timezone('Asia/Ho_Chi_Minh')
-    today_str = datetime.now(gmt7).strftime('%Y-%m-%d')
-    
-    totals = {}
-    last_update_date = None
 
-    # --- ĐỌC DỮ LIỆU CŨ VÀ KIỂM TRA NGÀY ---
-    try:
-        with open(filepath, 'r', encoding='utf-8') as f:
-            # Đọc dòng đầu tiên để lấy timestamp
-            first_line = f.readline().strip()
-            if "Timestamp:" in first_line:
-                # Trích xuất ngày từ timestamp, ví dụ: '2025-10-03'
-                last_update_date = first_line.split()[1]
+    # Lần đầu chuyển sang kho mới: giữ lại số đếm trong ngày từ file cũ
+    if import_legacy_total_file(filepath, db_path=db_path):
+        print("   - Đã nhập số liệu trong ngày từ TotalImage.txt cũ vào kho số liệu.")
 
-            # Đọc phần còn lại của file để lấy dữ liệu
-            for line in f:
-                if ':' in line:
-                    key, count = line.strip().split(':', 1)
-                    totals[key.strip()] = int(count.strip())
-    except FileNotFoundError:
-        print("   - Không tìm thấy file TotalImage.txt, sẽ tạo file mới cho ngày hôm nay.")
-    except Exception as e:
-        print(f"   - Lỗi khi đọc file TotalImage.txt: {e}. Sẽ tạo file mới.")
-
-    # --- QUYẾT ĐỊNH RESET HAY CỘNG DỒN ---
-    if today_str != last_update_date:
-        print(f"   - Phát hiện ngày mới ({today_str}). Dữ liệu sẽ được reset.")
-        totals = {} # Xóa toàn bộ dữ liệu cũ
+    if domain_counts:
+        rows = [(domain, mockup, count) for domain, counts in domain_counts.items() for mockup, count in counts.items()]
     else:
-        print(f"   - Tiếp tục cộng dồn dữ liệu cho ngày {today_str}.")
+        rows = [(None, mockup, count) for mockup, count in (new_counts or {}).items()]
 
-    # --- CẬP NHẬT DỮ LIỆU MỚI ---
-    if not new_counts:
+    if not rows:
         print("   - Không có ảnh mới nào được tạo trong lần chạy này.")
     else:
-        for mockup, count in new_counts.items():
-            combined_key = f"{tool_name}.{mockup}"
-            totals[combined_key] = totals.get(combined_key, 0) + count
-        print(f"   - Đã cập nhật {len(new_counts)} mục từ tool '{tool_name}'.")
+        try:
+            record_counts(tool_name, rows, db_path=db_path)
+            print(f"   - Đã ghi {len(new_counts or {})} mục từ tool '{tool_name}' vào kho số liệu.")
+        except Exception as e:
+            print(f"❌ Lỗi khi ghi kho số liệu: {e}")
 
-    # --- GHI LẠI TOÀN BỘ FILE ---
     try:
-        with open(filepath, 'w', encoding='utf-8') as f:
-            # Ghi timestamp mới ở dòng đầu tiên
-            f.write(f"Timestamp: {today_str}\n\n")
-            
-            # Ghi dữ liệu đã được cập nhật/reset
-            for key in sorted(totals.keys()):
-                f.write(f"{key}: {totals[key]}\n")
+        render_total_image_view(filepath, db_path=db_path)
         print(f"✅ Đã cập nhật thành công file {os.path.basename(filepath)}.")
     except Exception as e:
         print(f"❌ Lỗi khi ghi file {os.path.basename(filepath)}: {e}")
@@ -96,7 +75,7 @@ def pre_clean_filename(base_filename, regex_pattern):
     try:
         return re.sub(regex_pattern, '', base_filename)
     except re.error as e:
-        print(f"  - ⚠️ Cảnh báo: Lỗi biểu thức chính quy trong pre_clean_regex: {e}")
+        say(f"  - ⚠️ Cảnh báo: Lỗi biểu thức chính quy trong pre_clean_regex: {e}", WARNING)
         return base_filename
 
 
@@ -125,63 +104,10 @@ def should_globally_skip(filename, skip_keywords):
     """Kiểm tra filename có chứa từ khóa skip toàn cục không."""
     for keyword in skip_keywords:
         if re.search(r'\b' + re.escape(keyword) + r'\b', filename, re.IGNORECASE):
-            print(f"Skipping (Global): '{filename}' chứa từ khóa bị cấm '{keyword}'.")
+            say(f"Skipping (Global): '{filename}' chứa từ khóa bị cấm '{keyword}'.", DEBUG)
             return True
     return False
 
-def _convert_to_gps(value, is_longitude):
-    abs_value = abs(value)
-    ref = ('E' if value >= 0 else 'W') if is_longitude else ('N' if value >= 0 else 'S')
-    degrees = int(abs_value)
-    minutes_float = (abs_value - degrees) * 60
-    minutes = int(minutes_float)
-    seconds_float = (minutes_float - minutes) * 60
-    return {
-        'value': ((degrees, 1), (minutes, 1), (int(seconds_float * 100), 100)),
-        'ref': ref.encode('ascii')
-    }
-
-def create_exif_data(prefix, final_filename, exif_defaults):
-    domain_exif = prefix + ".com"
-    digitized_time = datetime.now() - timedelta(hours=2)
-    original_time = digitized_time - timedelta(seconds=random.randint(3600, 7500))
-    digitized_str = digitized_time.strftime("%Y:%m:%d %H:%M:%S")
-    original_str = original_time.strftime("%Y:%m:%d %H:%M:%S")
-    try:
-        zeroth_ifd = {
-            piexif.ImageIFD.Artist: domain_exif.encode('utf-8'),
-            piexif.ImageIFD.Copyright: domain_exif.encode('utf-8'),
-            piexif.ImageIFD.ImageDescription: final_filename.encode('utf-8'),
-            piexif.ImageIFD.Software: exif_defaults.get("Software", "Adobe Photoshop 25.0").encode('utf-8'),
-            piexif.ImageIFD.DateTime: digitized_str.encode('utf-8'),
-            piexif.ImageIFD.Make: exif_defaults.get("Make", "").encode('utf-8'),
-            piexif.ImageIFD.Model: exif_defaults.get("Model", "").encode('utf-8'),
-            piexif.ImageIFD.XPAuthor: domain_exif.encode('utf-16le'),
-            piexif.ImageIFD.XPComment: final_filename.encode('utf-16le'),
-            piexif.ImageIFD.XPSubject: final_filename.encode('utf-16le'),
-            piexif.ImageIFD.XPKeywords: (prefix + ";" + "shirt;").encode('utf-16le')
-        }
-        exif_ifd = {
-            piexif.ExifIFD.DateTimeOriginal: original_str.encode('utf-8'),
-            piexif.ExifIFD.DateTimeDigitized: digitized_str.encode('utf-8'),
-            piexif.ExifIFD.FNumber: tuple(exif_defaults.get("FNumber", [0,1])),
-            piexif.ExifIFD.ExposureTime: tuple(exif_defaults.get("ExposureTime", [0,1])),
-            piexif.ExifIFD.ISOSpeedRatings: exif_defaults.get("ISOSpeedRatings", 0),
-            piexif.ExifIFD.FocalLength: tuple(exif_defaults.get("FocalLength", [0,1]))
-        }
-        gps_ifd = {}
-        lat, lon = exif_defaults.get("GPSLatitude"), exif_defaults.get("GPSLongitude")
-        if lat is not None and lon is not None:
-            gps_lat_data, gps_lon_data = _convert_to_gps(lat, False), _convert_to_gps(lon, True)
-            gps_ifd.update({
-                piexif.GPSIFD.GPSLatitude: gps_lat_data['value'], piexif.GPSIFD.GPSLatitudeRef: gps_lat_data['ref'],
-                piexif.GPSIFD.GPSLongitude: gps_lon_data['value'], piexif.GPSIFD.GPSLongitudeRef: gps_lon_data['ref']
-            })
-        return piexif.dump({"0th": zeroth_ifd, "Exif": exif_ifd, "GPS": gps_ifd})
-    except Exception as e:
-        print(f"Lỗi khi tạo dữ liệu EXIF: {e}")
-        return b''
-
 def find_mockup_image(mockup_dir, mockup_config, is_white):
     """
     Hàm thông minh tìm kiếm file mockup.
@@ -211,25 +137,24 @@ def find_mockup_image(mockup_dir, mockup_config, is_white):
     # Logic này có thể đơn giản hóa thành ghép đường dẫn trực tiếp
     filepath = os.path.join(mockup_dir, filename)
     if os.path.exists(filepath):
-        print(f"  - Đã tìm thấy mockup: '{filename}'")
+        say(f"  - Đã tìm thấy mockup: '{filename}'", DEBUG)
         return filepath, coords
     else:
-        print(f"  - ⚠️ Cảnh báo: Không tìm thấy file ảnh mockup '{filename}'.")
+        say(f"  - ⚠️ Cảnh báo: Không tìm thấy file ảnh mockup '{filename}'.", WARNING)
         return None, None
 
 # Thêm hàm mới này vào cuối file
 
-def send_telegram_summary(tool_name, total_image_file_path, session_counts):
+def send_telegram_summary(tool_name, total_image_file_path, session_counts, db_path=METRICS_DB_FILE):
     """
-    Tạo báo cáo chi tiết, phân nhóm theo tool và gửi qua Telegram.
+    Tạo báo cáo chi tiết, phân nhóm theo tool và đưa vào outbox Telegram.
     Báo cáo sẽ bao gồm cả các mockup không có ảnh mới (added: 0).
+    Việc gửi thực sự do worker nền của utils.notifier đảm nhiệm.
+    Số tổng được lấy trực tiếp từ kho số liệu; total_image_file_path chỉ còn để tương thích.
     """
     print(f"✈️  Chuẩn bị gửi báo cáo Telegram cho tool: {tool_name}...")
-    
-    token = os.getenv("TELEGRAM_BOT_TOKEN")
-    chat_id = os.getenv("TELEGRAM_CHAT_ID_CN")
 
-    if not token or not chat_id:
+    if not os.getenv("TELEGRAM_BOT_TOKEN") or not os.getenv("TELEGRAM_CHAT_ID_CN"):
         print("⚠️ Cảnh báo: Không tìm thấy biến môi trường Telegram. Bỏ qua."); return
 
     header = f"--- Summary of Last {tool_name} Run ---"
@@ -237,21 +162,7 @@ def send_telegram_summary(tool_name, total_image_file_path, session_counts):
     
     report_body = ""
     try:
-        all_totals = {}
-        with open(total_image_file_path, 'r', encoding='utf-8') as f:
-            for line in f:
-                # <<< SỬA LỖI: Thêm điều kiện để bỏ qua dòng timestamp và các dòng không hợp lệ >>>
-                line = line.strip()
-                if not line or not ':' in line or line.startswith("Timestamp:"):
-                    continue
-                
-                try:
-                    key, count_str = line.split(':', 1)
-                    all_totals[key.strip()] = int(count_str.strip())
-                except ValueError:
-                    # Bỏ qua nếu dòng có định dạng sai (ví dụ: 'abc: xyz')
-                    print(f"  - ⚠️ Cảnh báo: Bỏ qua dòng không hợp lệ trong TotalImage.txt: '{line}'")
-                    continue
+        all_totals = daily_totals(tool_name=tool_name, db_path=db_path)
 
         historical_mockups = {key.split('.', 1)[1] for key in all_totals if key.startswith(f"{tool_name}.")}
         session_mockups = set(session_counts.keys())
@@ -268,15 +179,9 @@ def send_telegram_summary(tool_name, total_image_file_path, session_counts):
                 report_lines.append(f"    {mockup}: {total_count} (added: {new_count})")
             report_body = "\n".join(report_lines)
 
-    except FileNotFoundError:
-        report_body = "File TotalImage.txt chưa được tạo."
     except Exception as e:
-        report_body = f"Lỗi khi đọc file báo cáo: {e}"
+        report_body = f"Lỗi khi đọc kho số liệu: {e}"
 
     message = f"{header}\nTimestamp: {timestamp}\n\n{tool_name}:\n{report_body}"
 
-    try:
-        requests.post(f"https://api.telegram.org/bot{token}/sendMessage", data={'chat_id': chat_id, 'text': message}, timeout=10)
-        print("✅ Gửi báo cáo tới Telegram thành công.")
-    except Exception as e:
-        print(f"❌ Lỗi khi gửi báo cáo tới Telegram: {e}")
\ No newline at end of file
+    enqueue_telegram_message(message, chat_id_env="TELEGRAM_CHAT_ID_CN")
\ No newline at end of file
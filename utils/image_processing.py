@@ -1,5 +1,5 @@
 # utils/image_processing.py
-from PIL import Image, ImageDraw, ImageFont, ImageFilter
+from PIL import Image, ImageDraw, ImageFont
 from io import BytesIO
 import requests
 import os
@@ -7,19 +7,161 @@ from urllib.parse import quote
 import cv2
 import numpy as np
 import random
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+
+from utils.event_log import say, DEBUG, WARNING
+
+# --- BỘ ĐỆM ẢNH NUMPY (dùng chung cho erase, crop, tách nền, xoay, trim) ---
+
+class ImageBuffer:
+    """
+    Ảnh RGBA dạng ndarray (H, W, 4) uint8, dùng trong vòng lặp xử lý từng ảnh thay cho PIL.Image:
+    - crop() trả về một view (không copy); `origin` là vị trí của view trong ảnh gốc, nên các tọa độ
+      theo ảnh gốc (erase_zones) vẫn dùng được trên vùng crop.
+    - Các hàm erase_areas / remove_background_advanced sửa trực tiếp trên buffer.
+    - Có các thuộc tính/hàm giống PIL (size, width, height, getpixel, crop, getbbox, convert) để code cũ
+      và các hàm nhận PIL (phash, compose_mockup qua convert('RGBa')) dùng được mà không đổi.
+    """
+
+    def __init__(self, pixels, origin=(0, 0), valid_box=None, info=None):
+        self.pixels = pixels
+        self.origin = origin
+        height, width = pixels.shape[:2]
+        # Vùng có dữ liệu thật (tọa độ cục bộ); phần ngoài là lề trong suốt khi crop vượt ra ngoài ảnh
+        self.valid_box = valid_box or (0, 0, width, height)
+        self.info = info if info is not None else {}
+
+    @classmethod
+    def from_pil(cls, image):
+        """Chuyển ảnh PIL sang buffer RGBA (một lần copy duy nhất; ảnh RGB được ghi thẳng vào buffer RGBA)."""
+        if image.mode == "RGB":
+            pixels = np.empty((image.height, image.width, 4), dtype=np.uint8)
+            pixels[:, :, :3] = np.asarray(image)
+            pixels[:, :, 3] = 255
+        else:
+            pixels = np.array(image if image.mode == "RGBA" else image.convert("RGBA"))
+        return cls(pixels, info=dict(image.info))
+
+    # --- Giao diện giống PIL ---
+
+    @property
+    def size(self):
+        return self.pixels.shape[1], self.pixels.shape[0]
+
+    @property
+    def width(self):
+        return self.pixels.shape[1]
+
+    @property
+    def height(self):
+        return self.pixels.shape[0]
+
+    @property
+    def mode(self):
+        return "RGBA"
+
+    def getpixel(self, xy):
+        x, y = xy
+        if not (0 <= x < self.width and 0 <= y < self.height):
+            raise IndexError("image index out of range")
+        return tuple(int(v) for v in self.pixels[y, x])
+
+    def crop(self, box):
+        """Giống Image.crop: trong ảnh thì trả về view; vượt ra ngoài thì phần thừa là trong suốt (cần copy)."""
+        x0, y0, x1, y1 = (int(v) for v in box)
+        if x1 < x0 or y1 < y0:
+            raise ValueError("Coordinate 'right' is less than 'left'" if x1 < x0 else "Coordinate 'lower' is less than 'upper'")
+        origin = (self.origin[0] + x0, self.origin[1] + y0)
+        vx0, vy0, vx1, vy1 = self.valid_box
+        if vx0 <= x0 and vy0 <= y0 and x1 <= vx1 and y1 <= vy1:
+            return ImageBuffer(self.pixels[y0:y1, x0:x1], origin, info=self.info)
+        pixels = np.zeros((y1 - y0, x1 - x0, 4), dtype=np.uint8)
+        ix0, iy0, ix1, iy1 = max(x0, vx0), max(y0, vy0), min(x1, vx1), min(y1, vy1)
+        if ix0 < ix1 and iy0 < iy1:
+            pixels[iy0 - y0:iy1 - y0, ix0 - x0:ix1 - x0] = self.pixels[iy0:iy1, ix0:ix1]
+            valid_box = (ix0 - x0, iy0 - y0, ix1 - x0, iy1 - y0)
+        else:
+            valid_box = (0, 0, 0, 0)
+        return ImageBuffer(pixels, origin, valid_box, info=self.info)
+
+    def getbbox(self):
+        """Khung bao các pixel có alpha > 0 (như Image.getbbox của ảnh RGBA), hoặc None nếu trống."""
+        alpha = self.pixels[:, :, 3]
+        rows = np.flatnonzero(alpha.any(axis=1))
+        if rows.size == 0:
+            return None
+        cols = np.flatnonzero(alpha[rows[0]:rows[-1] + 1].any(axis=0))
+        return int(cols[0]), int(rows[0]), int(cols[-1]) + 1, int(rows[-1]) + 1
+
+    def fill(self, box, color):
+        """Tô màu RGB (alpha = 255) lên hình chữ nhật [x0, x1) x [y0, y1) tọa độ cục bộ, chỉ trong vùng có dữ liệu."""
+        vx0, vy0, vx1, vy1 = self.valid_box
+        x0, y0 = max(box[0], vx0), max(box[1], vy0)
+        x1, y1 = min(box[2], vx1), min(box[3], vy1)
+        if x0 >= x1 or y0 >= y1:
+            return False
+        region = self.pixels[y0:y1, x0:x1]
+        region[:, :, :3] = color[:3]
+        region[:, :, 3] = 255
+        return True
+
+    def premultiplied(self):
+        """Mảng RGBA đã nhân trước alpha (ndarray mới, liền bộ nhớ), làm tròn như Pillow khi convert('RGBa')."""
+        pixels = self.pixels
+        premul = np.empty(pixels.shape, dtype=np.uint8)
+        alpha = pixels[:, :, 3:4].astype(np.uint16)
+        tmp = pixels[:, :, :3] * alpha + 128           # MULDIV255 của Pillow
+        premul[:, :, :3] = ((tmp >> 8) + tmp) >> 8
+        premul[:, :, 3] = pixels[:, :, 3]
+        return premul
+
+    def convert(self, mode):
+        """
+        Xuất ra ảnh PIL. 'RGBa' (premultiplied) và 'L' được tính thẳng từ buffer với đúng công thức
+        làm tròn của Pillow, nên kết quả (và pHash) giống hệt khi convert từ ảnh PIL.
+        """
+        pixels = self.pixels
+        if mode == "RGBA":
+            return Image.fromarray(np.ascontiguousarray(pixels), "RGBA")
+        if mode == "RGB":
+            return Image.fromarray(np.ascontiguousarray(pixels[:, :, :3]), "RGB")
+        if mode == "RGBa":
+            return Image.frombuffer("RGBa", self.size, self.premultiplied(), "raw", "RGBa", 0, 1)
+        if mode == "L":
+            luma = pixels[:, :, 0].astype(np.uint32) * 19595
+            luma += pixels[:, :, 1].astype(np.uint32) * 38470
+            luma += pixels[:, :, 2].astype(np.uint32) * 7471
+            luma += 0x8000
+            luma >>= 16
+            return Image.fromarray(luma.astype(np.uint8), "L")
+        return self.convert("RGBA").convert(mode)
 
 # --- CÁC HÀM XỬ LÝ ẢNH CỐT LÕI ---
 
-def download_image(url, timeout=30): # <<< THAY ĐỔI: Thêm tham số timeout
-    """Tải ảnh từ URL với thời gian chờ tùy chỉnh."""
+def load_image_bytes(data, as_buffer=False):
+    """Giải mã ảnh từ bytes đã có trong bộ nhớ (vd: ảnh gốc lấy từ spool)."""
+    with Image.open(BytesIO(data)) as decoded:
+        return ImageBuffer.from_pil(decoded) if as_buffer else decoded.convert("RGBA")
+
+def download_image(url, timeout=30, as_buffer=False, keep_source=False): # <<< THAY ĐỔI: Thêm tham số timeout
+    """
+    Tải ảnh từ URL với thời gian chờ tùy chỉnh. Số byte đã tải nằm trong image.info['download_bytes'].
+    as_buffer=True: trả về ImageBuffer (giải mã thẳng vào buffer RGBA) thay cho ảnh PIL.
+    keep_source=True: giữ bytes gốc trong image.info['source_bytes'] (để đưa vào spool cho ktbimg).
+    """
     headers = {'User-Agent': 'Mozilla/5.0'}
     try:
         # Sử dụng giá trị timeout được truyền vào
         response = requests.get(url, headers=headers, timeout=timeout)
         response.raise_for_status()
-        return Image.open(BytesIO(response.content)).convert("RGBA")
+        image = load_image_bytes(response.content, as_buffer)
+        image.info["download_bytes"] = len(response.content)
+        if keep_source:
+            image.info["source_bytes"] = response.content
+        return image
     except Exception as e:
-        print(f"Lỗi khi tải ảnh từ {url}: {e}")
+        say(f"Lỗi khi tải ảnh từ {url}: {e}", WARNING)
         return None
 
 def erase_areas(image_pil, zones, background_color):
@@ -30,6 +172,18 @@ def erase_areas(image_pil, zones, background_color):
     if not zones or not isinstance(zones, list):
         return image_pil
 
+    if isinstance(image_pil, ImageBuffer):
+        # Tô trực tiếp trên buffer, chỉ phần giao giữa zone (tọa độ ảnh gốc) và vùng đang giữ (vd: vùng crop)
+        origin_x, origin_y = image_pil.origin
+        for zone in zones:
+            try:
+                x, y, w, h = zone['x'] - origin_x, zone['y'] - origin_y, zone['w'], zone['h']
+                # draw.rectangle của PIL tô cả cạnh phải/dưới: giữ đúng kích thước (w + 1) x (h + 1)
+                image_pil.fill((x, y, x + w + 1, y + h + 1), background_color)
+            except (KeyError, TypeError):
+                say(f"  - ⚠️ Cảnh báo: Cấu trúc zone không hợp lệ, bỏ qua: {zone}", WARNING)
+        return image_pil
+
     # Không cần convert sang RGBA nữa vì chúng ta chỉ fill màu RGB
     img_copy = image_pil.copy()
     draw = ImageDraw.Draw(img_copy)
@@ -43,7 +197,7 @@ def erase_areas(image_pil, zones, background_color):
             draw.rectangle(rectangle_coords, fill=background_color)
             
         except (KeyError, TypeError):
-            print(f"  - ⚠️ Cảnh báo: Cấu trúc zone không hợp lệ, bỏ qua: {zone}")
+            say(f"  - ⚠️ Cảnh báo: Cấu trúc zone không hợp lệ, bỏ qua: {zone}", WARNING)
             continue
             
     return img_copy
@@ -59,7 +213,7 @@ def crop_by_coords(image, coords_dict):
         )
         return image.crop(box)
     except Exception as e:
-        print(f"  - ❌ Lỗi khi thực hiện crop: {e}")
+        say(f"  - ❌ Lỗi khi thực hiện crop: {e}", WARNING)
         return None
 
 def rotate_image(image, angle):
@@ -68,6 +222,9 @@ def rotate_image(image, angle):
         return image
     
     # Xoay ảnh và lấp đầy nền thừa bằng màu trong suốt
+    if isinstance(image, ImageBuffer):
+        rotated = image.convert("RGBA").rotate(angle, resample=Image.Resampling.BICUBIC, expand=True, fillcolor=(0,0,0,0))
+        return ImageBuffer(np.asarray(rotated), info=image.info)
     return image.rotate(angle, resample=Image.Resampling.BICUBIC, expand=True, fillcolor=(0,0,0,0))
 
 def determine_color_from_sample_area(image, sample_coords):
@@ -108,7 +265,7 @@ def determine_color_from_sample_area(image, sample_coords):
         return avg_brightness > 128
 
     except (KeyError, IndexError):
-        print("  - ⚠️ Cảnh báo: 'color_sample_coords' không hợp lệ.")
+        say("  - ⚠️ Cảnh báo: 'color_sample_coords' không hợp lệ.", WARNING)
         return True # Mặc định là trắng nếu có lỗi
 
 def remove_background(design_img):
@@ -143,96 +300,262 @@ def remove_background(design_img):
                 stack.extend([(x + 1, y), (x - 1, y), (x, y + 1), (x, y - 1)])
     return design_img
 
-def remove_background_advanced(design_img, tolerance=30, refine_size=8000):
+# --- HỒ SƠ TÁCH NỀN (CHẤT LƯỢNG / TỐC ĐỘ) ---
+
+# refine_size: độ phân giải tinh chỉnh viền (0 = không tinh chỉnh)
+# sharpen: cường độ làm nét unsharp mask (0 = không làm nét; 0.5 = 1.5*ảnh - 0.5*ảnh mờ như cũ)
+# keying: "corners" = 4 lượt inRange cho 4 góc; "distinct" = gộp các màu góc gần nhau, mỗi màu nền một lượt
+BG_REMOVAL_PROFILES = {
+    "fast": {"refine_size": 0, "sharpen": 0.0, "keying": "distinct"},
+    "balanced": {"refine_size": 4000, "sharpen": 0.3, "keying": "distinct"},
+    "print": {"refine_size": 8000, "sharpen": 0.5, "keying": "corners"},
+}
+DEFAULT_BG_PROFILE = "print"
+
+def resolve_bg_profile(defaults, tool_name, domain_config=None, rule=None):
+    """
+    Chọn hồ sơ tách nền theo thứ tự ưu tiên:
+    rule["bg_profile"] > domain["bg_profile"] > defaults["bg_profile_by_tool"][tool] > defaults["bg_profile"] > "print".
+    Các hồ sơ có thể được ghi đè/bổ sung trong defaults["bg_profiles"].
+    Trả về (tên hồ sơ, dict tham số).
+    """
+    profiles = {name: dict(params) for name, params in BG_REMOVAL_PROFILES.items()}
+    for name, params in defaults.get("bg_profiles", {}).items():
+        profiles.setdefault(name, dict(BG_REMOVAL_PROFILES[DEFAULT_BG_PROFILE])).update(params)
+
+    candidates = [
+        (rule or {}).get("bg_profile"),
+        (domain_config or {}).get("bg_profile"),
+        defaults.get("bg_profile_by_tool", {}).get(tool_name),
+        defaults.get("bg_profile"),
+    ]
+    for name in candidates:
+        if not name:
+            continue
+        if name in profiles:
+            return name, profiles[name]
+        say(f"  - ⚠️ Cảnh báo: Không có hồ sơ tách nền '{name}', bỏ qua.", WARNING)
+    return DEFAULT_BG_PROFILE, profiles[DEFAULT_BG_PROFILE]
+
+def _distinct_key_colors(colors, tolerance):
+    """Gộp các màu góc gần nhau (lệch <= tolerance/2 mỗi kênh) để không chạy inRange trùng lặp."""
+    distinct = []
+    for color in colors:
+        if not any(np.all(np.abs(color - kept) <= tolerance / 2) for kept in distinct):
+            distinct.append(color)
+    return distinct
+
+# --- TÁCH NỀN THEO DẢI (ẢNH RẤT LỚN) ---
+
+# min_pixels: ảnh từ chừng này pixel trở lên thì tách nền theo dải
+# tile_rows: số hàng mỗi dải; workers: số luồng xử lý dải song song (0 = số nhân CPU)
+BG_TILING_DEFAULTS = {"min_pixels": 24_000_000, "tile_rows": 1024, "workers": 0}
+SHARPEN_SIGMA = 3
+SHARPEN_HALO = 3 * SHARPEN_SIGMA + 1   # Lề đọc thêm khi làm nét (>= bán kính kernel Gaussian)
+REFINE_HALO = 2                        # Lề (ở độ phân giải gốc) cho phép phóng to INTER_CUBIC (4 điểm lấy mẫu)
+
+def plan_bg_tiling(w, h, tiling_config=None):
+    """
+    Quyết định có tách nền theo dải hay không (defaults["bg_tiling"] ghi đè BG_TILING_DEFAULTS).
+    Trả về {"tile_rows", "workers"} hoặc None nếu ảnh đủ nhỏ để xử lý nguyên khung.
+    """
+    config = dict(BG_TILING_DEFAULTS, **(tiling_config or {}))
+    tile_rows = int(config["tile_rows"] or 0)
+    if not tile_rows or w * h < config["min_pixels"] or h <= tile_rows:
+        return None
+    return {"tile_rows": tile_rows, "workers": int(config["workers"] or 0) or os.cpu_count() or 1}
+
+def _bands(top, bottom, tile_rows):
+    return [(y, min(y + tile_rows, bottom)) for y in range(top, bottom, tile_rows)]
+
+def _key_colors(rgba_image, tolerance, keying):
+    """Màu nền lấy mẫu ở 4 góc (toàn ảnh), gộp các màu gần nhau nếu keying = 'distinct'."""
+    h, w = rgba_image.shape[:2]
+    sample_size = min(10, h // 10, w // 10)
+    corners = [
+        rgba_image[0:sample_size, 0:sample_size, :3],
+        rgba_image[0:sample_size, w-sample_size:w, :3],
+        rgba_image[h-sample_size:h, 0:sample_size, :3],
+        rgba_image[h-sample_size:h, w-sample_size:w, :3]
+    ]
+    corner_colors = [np.mean(corner, axis=(0, 1)) for corner in corners]
+    if keying == "distinct":
+        corner_colors = _distinct_key_colors(corner_colors, tolerance)
+    return corner_colors
+
+def _foreground_mask(rgba_image, corner_colors, tolerance):
+    """Mặt nạ vật thể (255) = không trùng màu nền nào. Thuần theo từng pixel nên tách dải không cần lề."""
+    combined_mask = np.zeros(rgba_image.shape[:2], np.uint8)
+    for color in corner_colors:
+        
+        # <<< SỬA LỖI: Thêm dtype=np.uint8 để ép kiểu dữ liệu về số nguyên 8-bit >>>
+        # Kênh alpha nhận mọi giá trị [0, 255] để so khớp 4 kênh trên buffer RGBA
+        lower = np.array([max(0, c - tolerance) for c in color] + [0], dtype=np.uint8)
+        upper = np.array([min(255, c + tolerance) for c in color] + [255], dtype=np.uint8)
+        
+        mask = cv2.inRange(rgba_image, lower, upper)
+        combined_mask = cv2.bitwise_or(combined_mask, mask)
+    return cv2.bitwise_not(combined_mask)
+
+def _smooth_mask(mask, scale_factor, top=0, rows=None):
+    """
+    Phóng to mặt nạ (INTER_CUBIC), nhị phân hoá rồi thu về (INTER_AREA): làm viền mượt kiểu vector.
+    top/rows: chỉ lấy các hàng [top, top + rows) của `mask` (phần còn lại là lề của dải).
+    """
+    rows = mask.shape[0] - top if rows is None else rows
+    h_up, w_up = mask.shape[0] * scale_factor, mask.shape[1] * scale_factor
+    upscaled_mask = cv2.resize(mask, (w_up, h_up), interpolation=cv2.INTER_CUBIC)
+    upscaled_mask = upscaled_mask[top * scale_factor:(top + rows) * scale_factor]
+    _, binary_mask = cv2.threshold(upscaled_mask, 127, 255, cv2.THRESH_BINARY)
+    return binary_mask
+
+def _downscale_mask(binary_mask, w, h):
+    refined_mask = cv2.resize(binary_mask, (w, h), interpolation=cv2.INTER_AREA)
+    _, refined_mask = cv2.threshold(refined_mask, 127, 255, cv2.THRESH_BINARY)
+    return refined_mask
+
+def _sharpen_bbox(refined_mask, w, h):
+    """Khung cần làm nét: khung bao vật thể cộng lề bằng bán kính kernel; None nếu mặt nạ trống."""
+    x, y, bw, bh = cv2.boundingRect(refined_mask)
+    if not (bw and bh):
+        return None
+    pad = SHARPEN_HALO
+    return max(0, x - pad), max(0, y - pad), min(w, x + bw + pad), min(h, y + bh + pad)
+
+def _sharpened(part, sharpen):
+    """Unsharp mask trên 4 kênh (OpenCV đọc được view RGBA không cần copy)."""
+    blurred = cv2.GaussianBlur(part, (0, 0), SHARPEN_SIGMA)
+    return cv2.addWeighted(part, 1 + sharpen, blurred, -sharpen, 0)
+
+def _remove_background_tiled(rgba_image, corner_colors, tolerance, scale_factor, sharpen, tiling):
+    """
+    Tách nền theo dải hàng ngang, các dải chạy song song (OpenCV/NumPy nhả GIL):
+    - Keying theo từng pixel; làm mượt viền đọc thêm REFINE_HALO hàng mỗi phía (keying lại phần lề tại chỗ)
+      nên kết quả trong dải trùng khớp với xử lý nguyên khung — không có đường nối. Bước vẽ lại contour
+      (FILLED, giữ nguyên lỗ) của bản nguyên khung cho ra đúng mặt nạ nhị phân nên ở đây bỏ qua.
+    - Làm nét đọc lề SHARPEN_HALO hàng từ bản chụp pixel GỐC ở các mép dải (dải bên cạnh có thể đã
+      ghi đè), nên cũng trùng khớp với làm nét nguyên khung.
+    Bộ nhớ tạm tỉ lệ với kích thước dải x số luồng, cộng mặt nạ 8-bit toàn ảnh.
+    """
+    h, w = rgba_image.shape[:2]
+    tile_rows = tiling["tile_rows"]
+    refined_mask = np.empty((h, w), np.uint8)
+
+    def mask_band(band):
+        y0, y1 = band
+        halo = REFINE_HALO if scale_factor > 1 else 0
+        top, bottom = max(0, y0 - halo), min(h, y1 + halo)
+        band_mask = _foreground_mask(rgba_image[top:bottom], corner_colors, tolerance)
+        if scale_factor > 1:
+            binary_mask = _smooth_mask(band_mask, scale_factor, top=y0 - top, rows=y1 - y0)
+            band_mask = _downscale_mask(binary_mask, w, y1 - y0)
+        refined_mask[y0:y1] = band_mask
+
+    with ThreadPoolExecutor(max_workers=tiling["workers"]) as executor:
+        list(executor.map(mask_band, _bands(0, h, tile_rows)))
+        say(f"   - Tách nền {len(corner_colors)} màu góc theo {-(-h // tile_rows)} dải thành công.", DEBUG)
+
+        rgba_image[:, :, 3] = refined_mask
+        bbox = _sharpen_bbox(refined_mask, w, h)
+        if not (sharpen and bbox):
+            return
+        x0, y0, x1, y1 = bbox
+        bands = _bands(y0, y1, tile_rows)
+        # Bản chụp các hàng quanh mép dải trước khi dải nào ghi đè
+        edges = {}
+        for top, _ in bands[1:]:
+            edge_top, edge_bottom = max(y0, top - SHARPEN_HALO), min(y1, top + SHARPEN_HALO)
+            edges[top] = (edge_top, rgba_image[edge_top:edge_bottom, x0:x1].copy())
+
+        def sharpen_band(band):
+            top, bottom = band
+            read_top, read_bottom = max(y0, top - SHARPEN_HALO), min(y1, bottom + SHARPEN_HALO)
+            part = rgba_image[read_top:read_bottom, x0:x1].copy()
+            for edge in (top, bottom):
+                if edge in edges:
+                    edge_top, snapshot = edges[edge]
+                    part[edge_top - read_top:edge_top - read_top + len(snapshot)] = snapshot
+            sharpened = _sharpened(part, sharpen)
+            rgba_image[top:bottom, x0:x1, :3] = sharpened[top - read_top:bottom - read_top, :, :3]
+
+        list(executor.map(sharpen_band, bands))
+    say("   - Làm nét ảnh thành công.", DEBUG)
+
+def remove_background_advanced(design_img, tolerance=30, refine_size=8000, sharpen=0.5, keying="corners", tiling=None):
     """
     Hàm tách nền cao cấp, kết hợp 3 kỹ thuật từ ktbrembg:
     1. Tách nền Magic Wand lấy mẫu 4 góc.
     2. Tinh chỉnh viền kiểu vector.
     3. Làm nét ảnh.
+    Mức độ của từng bước được điều khiển bởi hồ sơ tách nền (xem BG_REMOVAL_PROFILES).
+    Nhận ImageBuffer (sửa tại chỗ, kể cả khi là view crop) hoặc ảnh PIL (trả về ảnh PIL mới).
+    tiling (từ plan_bg_tiling): xử lý theo dải song song cho ảnh rất lớn, bộ nhớ tạm tỉ lệ với dải.
     """
-    print("✨ Áp dụng thuật toán tách nền cao cấp...")
+    say("✨ Áp dụng thuật toán tách nền cao cấp...", DEBUG)
     try:
-        # --- Chuyển đổi từ PIL sang OpenCV ---
-        img_cv = cv2.cvtColor(np.array(design_img), cv2.COLOR_RGBA2BGRA)
+        # Làm việc thẳng trên buffer RGBA: không đổi sang BGR/BGRA, không copy vùng crop
+        buffer = design_img if isinstance(design_img, ImageBuffer) else ImageBuffer.from_pil(design_img)
+        rgba_image = buffer.pixels
+        h, w = rgba_image.shape[:2]
+        corner_colors = _key_colors(rgba_image, tolerance, keying)
+        scale_factor = max(1, int(refine_size / max(h, w, 1))) if refine_size else 1
 
-        # --- Bước 1: Tách nền bằng Magic Wand toàn cục ---
-        bgr_image = img_cv[:,:,:3]
-        h, w = bgr_image.shape[:2]
-
-        sample_size = min(10, h // 10, w // 10)
-        corners = [
-            bgr_image[0:sample_size, 0:sample_size],
-            bgr_image[0:sample_size, w-sample_size:w],
-            bgr_image[h-sample_size:h, 0:sample_size],
-            bgr_image[h-sample_size:h, w-sample_size:w]
-        ]
-        corner_colors = [np.mean(corner, axis=(0, 1)) for corner in corners]
-        
-        combined_mask = np.zeros((h, w), np.uint8)
-        for color in corner_colors:
-            
-            # <<< SỬA LỖI: Thêm dtype=np.uint8 để ép kiểu dữ liệu về số nguyên 8-bit >>>
-            lower = np.array([max(0, c - tolerance) for c in color], dtype=np.uint8)
-            upper = np.array([min(255, c + tolerance) for c in color], dtype=np.uint8)
-            
-            mask = cv2.inRange(bgr_image, lower, upper)
-            combined_mask = cv2.bitwise_or(combined_mask, mask)
+        if tiling:
+            _remove_background_tiled(rgba_image, corner_colors, tolerance, scale_factor, sharpen, tiling)
+            return buffer if buffer is design_img else buffer.convert("RGBA")
 
-        foreground_mask = cv2.bitwise_not(combined_mask)
-        print("   - Tách nền 4 góc thành công.")
+        # --- Bước 1: Tách nền bằng Magic Wand toàn cục ---
+        foreground_mask = _foreground_mask(rgba_image, corner_colors, tolerance)
+        say(f"   - Tách nền {len(corner_colors)} màu góc thành công.", DEBUG)
 
         # --- Bước 2: Tinh chỉnh viền sắc nét ---
-        # (Phần này giữ nguyên)
-        scale_factor = max(1, int(refine_size / max(h, w, 1)))
         if scale_factor > 1:
-            h_up, w_up = h * scale_factor, w * scale_factor
-            upscaled_mask = cv2.resize(foreground_mask, (w_up, h_up), interpolation=cv2.INTER_CUBIC)
-            _, binary_mask = cv2.threshold(upscaled_mask, 127, 255, cv2.THRESH_BINARY)
+            binary_mask = _smooth_mask(foreground_mask, scale_factor)
             contours, _ = cv2.findContours(binary_mask, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
-            perfect_mask = np.zeros((h_up, w_up), dtype=np.uint8)
+            perfect_mask = np.zeros_like(binary_mask)
             cv2.drawContours(perfect_mask, contours, -1, (255), thickness=cv2.FILLED)
-            refined_mask = cv2.resize(perfect_mask, (w, h), interpolation=cv2.INTER_AREA)
-            _, refined_mask = cv2.threshold(refined_mask, 127, 255, cv2.THRESH_BINARY)
-            print("   - Tinh chỉnh viền thành công.")
+            refined_mask = _downscale_mask(perfect_mask, w, h)
+            say("   - Tinh chỉnh viền thành công.", DEBUG)
         else:
             refined_mask = foreground_mask
 
         # --- Bước 3: Áp dụng mặt nạ và làm nét ---
-        # (Phần này giữ nguyên)
-        bgra_image = cv2.cvtColor(bgr_image, cv2.COLOR_BGR2BGRA)
-        bgra_image[:, :, 3] = refined_mask
-        bgr_part = bgra_image[:, :, :3]
-        alpha_part = bgra_image[:, :, 3]
-        blurred = cv2.GaussianBlur(bgr_part, (0, 0), 3)
-        sharpened_bgr = cv2.addWeighted(bgr_part, 1.5, blurred, -0.5, 0)
-        final_cv_image = cv2.merge([sharpened_bgr, alpha_part])
-        print("   - Làm nét ảnh thành công.")
-
-        # --- Chuyển đổi ngược lại sang PIL để trả về ---
-        return Image.fromarray(cv2.cvtColor(final_cv_image, cv2.COLOR_BGRA2RGBA))
+        # Chỉ làm nét trong khung bao của vật thể (cộng lề bằng bán kính kernel);
+        # pixel trong suốt bên ngoài không ảnh hưởng tới kết quả.
+        rgba_image[:, :, 3] = refined_mask
+        bbox = _sharpen_bbox(refined_mask, w, h)
+        if sharpen and bbox:
+            x0, y0, x1, y1 = bbox
+            # Chỉ ghi lại 3 kênh màu
+            part = rgba_image[y0:y1, x0:x1]
+            part[:, :, :3] = _sharpened(part, sharpen)[:, :, :3]
+            say("   - Làm nét ảnh thành công.", DEBUG)
+
+        return buffer if buffer is design_img else buffer.convert("RGBA")
 
     except Exception as e:
-        print(f"  - ❌ Lỗi trong quá trình xử lý ảnh nâng cao: {e}")
+        say(f"  - ❌ Lỗi trong quá trình xử lý ảnh nâng cao: {e}", WARNING)
         return design_img
 
 def trim_transparent_background(image):
-    """Cắt bỏ toàn bộ phần nền trong suốt thừa xung quanh vật thể."""
+    """Cắt bỏ toàn bộ phần nền trong suốt thừa xung quanh vật thể (với ImageBuffer: trả về view)."""
     bbox = image.getbbox()
     if bbox:
         return image.crop(bbox)
     return None
 
-def apply_mockup(trimmed_design, mockup_img, mockup_coords):
+def compute_paste_layout(design_size, mockup_coords):
     """
-    Ghép design vào mockup với logic căn chỉnh động:
+    Tính kích thước sau resize và vị trí dán design vào khung mockup:
     - Resize để vừa khít với khung dán (theo chiều rộng hoặc cao).
     - Nếu thừa chiều cao, dán sát lề trên.
     - Nếu thừa chiều rộng, căn giữa theo chiều ngang.
+    Trả về (final_w, final_h, paste_x, paste_y).
     """
     # Lấy thông số của khung mockup và design
     mockup_frame_w = mockup_coords['w']
     mockup_frame_h = mockup_coords['h']
-    obj_w, obj_h = trimmed_design.size
+    obj_w, obj_h = design_size
 
     # Tính toán tỷ lệ co giãn theo từng chiều
     scale_w = mockup_frame_w / obj_w
@@ -244,7 +567,6 @@ def apply_mockup(trimmed_design, mockup_img, mockup_coords):
     # Kích thước cuối cùng sau khi resize
     final_w = int(obj_w * scale_ratio)
     final_h = int(obj_h * scale_ratio)
-    resized_design = trimmed_design.resize((final_w, final_h), Image.Resampling.LANCZOS)
 
     # === LOGIC CĂN CHỈNH ĐỘNG ===
     # Mặc định dán lên trên cùng
@@ -257,12 +579,211 @@ def apply_mockup(trimmed_design, mockup_img, mockup_coords):
     else: # Ngược lại, dán sát lề trái
         paste_x = mockup_coords['x']
 
+    return final_w, final_h, paste_x, paste_y
+
+def apply_mockup(trimmed_design, mockup_img, mockup_coords):
+    """
+    Ghép design vào mockup với logic căn chỉnh động (xem compute_paste_layout).
+    Trả về ảnh RGBA toàn khung; pipeline chính dùng compose_mockup thay cho hàm này.
+    """
+    final_w, final_h, paste_x, paste_y = compute_paste_layout(trimmed_design.size, mockup_coords)
+    resized_design = trimmed_design.resize((final_w, final_h), Image.Resampling.LANCZOS)
+
     # Thực hiện ghép ảnh
     final_mockup = mockup_img.copy().convert("RGBA")
     final_mockup.paste(resized_design, (paste_x, paste_y), resized_design)
     
     return final_mockup
 
+# --- COMPOSITOR PREMULTIPLIED ALPHA (NumPy) ---
+
+def _blend_premultiplied(target_rgb, layer_rgb_premul, layer_alpha, x, y):
+    """
+    Trộn một lớp đã nhân trước alpha vào buffer RGB (tại chỗ), chỉ trong hình chữ nhật của lớp:
+    out = layer_premul + target * (255 - alpha) / 255. Tự cắt phần nằm ngoài khung.
+    """
+    target_h, target_w = target_rgb.shape[:2]
+    layer_h, layer_w = layer_alpha.shape[:2]
+    x0, y0 = max(x, 0), max(y, 0)
+    x1, y1 = min(x + layer_w, target_w), min(y + layer_h, target_h)
+    if x0 >= x1 or y0 >= y1:
+        return target_rgb
+    lx0, ly0 = x0 - x, y0 - y
+    src = layer_rgb_premul[ly0:ly0 + (y1 - y0), lx0:lx0 + (x1 - x0)].astype(np.uint16)
+    inv_alpha = 255 - layer_alpha[ly0:ly0 + (y1 - y0), lx0:lx0 + (x1 - x0), None].astype(np.uint16)
+    region = target_rgb[y0:y1, x0:x1]
+    blended = src + (region * inv_alpha + 127) // 255
+    np.minimum(blended, 255, out=blended)
+    region[...] = blended
+    return target_rgb
+
+def _split_premultiplied(image_premul):
+    """Tách ảnh 'RGBa' (PIL, đã nhân trước alpha) thành (rgb_premul, alpha) dạng ndarray."""
+    arr = np.asarray(image_premul)
+    return arr[:, :, :3], arr[:, :, 3]
+
+@lru_cache(maxsize=32)
+def prepare_watermark_layer(watermark_descriptor, watermark_dir, font_path, canvas_size):
+    """
+    Dựng sẵn lớp watermark (ảnh hoặc chữ) cho một kích thước mockup, có cache.
+    Vị trí giống add_watermark. Trả về (rgb_premul, alpha, x, y) hoặc None.
+    """
+    if not watermark_descriptor:
+        return None
+    canvas_w, canvas_h = canvas_size
+    potential_path = os.path.join(watermark_dir, watermark_descriptor)
+
+    if os.path.exists(potential_path):
+        try:
+            watermark_img = Image.open(potential_path).convert("RGBA")
+            max_wm_width = 280
+            wm_w, wm_h = watermark_img.size
+            if wm_w > max_wm_width:
+                scale = max_wm_width / wm_w
+                watermark_img = watermark_img.resize((int(wm_w * scale), int(wm_h * scale)), Image.Resampling.LANCZOS)
+            wm_w, wm_h = watermark_img.size
+            rgb_premul, alpha = _split_premultiplied(watermark_img.convert("RGBa"))
+            return rgb_premul, alpha, canvas_w - wm_w - 20, canvas_h - wm_h - 50
+        except Exception as e:
+            say(f"Lỗi khi xử lý ảnh watermark: {e}", WARNING)
+            return None
+
+    # Watermark dạng chữ: chữ đen, độ phủ theo nét chữ (giống kết quả add_watermark sau khi convert RGB)
+    try:
+        font = ImageFont.truetype(font_path, 100)
+    except IOError:
+        font = ImageFont.load_default()
+    x0, y0, x1, y1 = font.getbbox(watermark_descriptor)
+    text_w, text_h = x1 - x0, y1 - y0
+    if text_w <= 0 or text_h <= 0:
+        return None
+    coverage = Image.new('L', (text_w, text_h), 0)
+    ImageDraw.Draw(coverage).text((-x0, -y0), watermark_descriptor, fill=255, font=font)
+    alpha = np.asarray(coverage)
+    rgb_premul = np.zeros((text_h, text_w, 3), dtype=np.uint8)
+    text_x, text_y = canvas_w - text_w - 20, canvas_h - text_h - 50
+    return rgb_premul, alpha, text_x + x0, text_y + y0
+
+# --- GEOMETRY: XOAY + TRIM + RESIZE TRONG MỘT LẦN LẤY MẪU ---
+
+class DesignGeometry:
+    """
+    Gộp các bước xoay (rotate_image), cắt nền trong suốt (trim_transparent_background) và resize vào khung
+    mockup thành MỘT phép biến đổi affine, lấy mẫu một lần từ vùng crop đã tách nền:
+    - Khung bao sau khi xoay được tính giải tích: xoay các đầu mút pixel có alpha > 0 của từng hàng
+      (đúng bằng khung bao của bao lồi vật thể), không cần dựng ảnh xoay rồi getbbox.
+    - Nguồn được nhân trước alpha một lần; mỗi kích thước khung đích chỉ warp một lần (cache),
+      các mockup cùng kích thước khung dùng lại kết quả.
+    - Thu nhỏ mạnh (>= 2 lần) thì giảm trước bằng INTER_AREA để tránh răng cưa khi warp.
+    Dùng thay cho ảnh design PIL trong compose_mockup; `size` tương đương kích thước ảnh sau trim.
+    """
+
+    def __init__(self, source_premul, angle, extent_min, size):
+        self._source = source_premul
+        self._angle = angle
+        self._extent_min = extent_min
+        self.size = size
+        self._rendered = {}
+
+    @classmethod
+    def from_image(cls, image, angle=0):
+        """Dựng geometry từ design đã tách nền (ImageBuffer hoặc PIL RGBA). Trả về None nếu design trống."""
+        buffer = image if isinstance(image, ImageBuffer) else ImageBuffer.from_pil(image)
+        bbox = buffer.getbbox()
+        if not bbox:
+            return None
+        region = buffer.crop(bbox)
+        width, height = region.size
+        if angle % 360 == 0:
+            return cls(region.premultiplied(), 0, (0.0, 0.0), (width, height))
+
+        # Đầu mút trái/phải của phần có alpha trên từng hàng -> 4 góc pixel mỗi hàng
+        opaque = region.pixels[:, :, 3] > 0
+        rows = np.flatnonzero(opaque.any(axis=1))
+        first = np.argmax(opaque[rows], axis=1)
+        last = width - np.argmax(opaque[rows, ::-1], axis=1)
+        xs = np.concatenate([first, last, first, last]).astype(np.float64)
+        ys = np.concatenate([rows, rows, rows + 1, rows + 1]).astype(np.float64)
+        rotation = cls._rotation(angle)
+        rotated_x = rotation[0, 0] * xs + rotation[0, 1] * ys
+        rotated_y = rotation[1, 0] * xs + rotation[1, 1] * ys
+        extent_min = (rotated_x.min(), rotated_y.min())
+        size = (max(1, int(np.ceil(rotated_x.max() - extent_min[0] - 1e-6))),
+                max(1, int(np.ceil(rotated_y.max() - extent_min[1] - 1e-6))))
+        return cls(region.premultiplied(), angle, extent_min, size)
+
+    @staticmethod
+    def _rotation(angle):
+        """Ma trận xoay ngược chiều kim đồng hồ `angle` độ (trục y hướng xuống, giống Image.rotate)."""
+        theta = np.deg2rad(angle)
+        cos_t, sin_t = np.cos(theta), np.sin(theta)
+        return np.array([[cos_t, sin_t], [-sin_t, cos_t]])
+
+    def render(self, final_w, final_h):
+        """Design đã xoay + trim + resize về (final_w, final_h). Trả về (rgb_premul, alpha) dạng ndarray."""
+        final_w, final_h = max(1, final_w), max(1, final_h)
+        key = (final_w, final_h)
+        if key not in self._rendered:
+            rendered = self._warp(final_w, final_h)
+            self._rendered[key] = (rendered[:, :, :3], rendered[:, :, 3])
+        return self._rendered[key]
+
+    def _warp(self, final_w, final_h):
+        source = self._source
+        src_h, src_w = source.shape[:2]
+        scale_x, scale_y = final_w / self.size[0], final_h / self.size[1]
+
+        if self._angle == 0:
+            shrinking = final_w < src_w or final_h < src_h
+            return cv2.resize(source, (final_w, final_h), interpolation=cv2.INTER_AREA if shrinking else cv2.INTER_LANCZOS4)
+
+        # Thu nhỏ nhiều: giảm nguồn trước bằng INTER_AREA (lọc hộp), phần lẻ còn lại do warp đảm nhận
+        reduce = int(1 / min(scale_x, scale_y))
+        step_x = step_y = 1.0
+        if reduce >= 2:
+            reduced_w, reduced_h = max(1, round(src_w / reduce)), max(1, round(src_h / reduce))
+            source = cv2.resize(source, (reduced_w, reduced_h), interpolation=cv2.INTER_AREA)
+            step_x, step_y = src_w / reduced_w, src_h / reduced_h
+
+        # Tọa độ liên tục (tâm pixel ở i + 0.5): u + 0.5 = S * (R * D * (i + 0.5) - extent_min)
+        forward = np.diag([scale_x, scale_y]) @ self._rotation(self._angle) @ np.diag([step_x, step_y])
+        offset = forward @ np.array([0.5, 0.5]) - np.array([scale_x * self._extent_min[0], scale_y * self._extent_min[1]]) - 0.5
+        matrix = np.hstack([forward, offset[:, None]])
+        return cv2.warpAffine(source, matrix, (final_w, final_h), flags=cv2.INTER_LANCZOS4,
+                              borderMode=cv2.BORDER_CONSTANT, borderValue=(0, 0, 0, 0))
+
+def compose_mockup(design, mockup_img, mockup_coords, watermark_descriptor=None, watermark_dir=None, font_path=None):
+    """
+    Ghép design + watermark vào mockup trong MỘT lượt, trên buffer RGB:
+    - Design được resize ở dạng premultiplied ('RGBa') và chỉ trộn trong vùng dán.
+    - Không tạo khung RGBA toàn ảnh trung gian; kết quả là ảnh RGB sẵn sàng để encode.
+    `design` có thể là DesignGeometry (xoay/trim/resize trong một lần lấy mẫu, khuyến nghị khi ghép nhiều mockup),
+    ảnh 'RGBA' hoặc ảnh đã chuyển sẵn sang 'RGBa'.
+    """
+    final_w, final_h, paste_x, paste_y = compute_paste_layout(design.size, mockup_coords)
+    if isinstance(design, DesignGeometry):
+        design_rgb, design_alpha = design.render(final_w, final_h)
+    else:
+        design_premul = design if design.mode == 'RGBa' else design.convert('RGBa')
+        resized_design = design_premul.resize((final_w, final_h), Image.Resampling.LANCZOS)
+        design_rgb, design_alpha = _split_premultiplied(resized_design)
+
+    if isinstance(mockup_img, np.ndarray):
+        canvas = mockup_img[:, :, :3].copy()
+    else:
+        canvas = np.array(mockup_img if mockup_img.mode == 'RGB' else mockup_img.convert('RGB'))
+
+    _blend_premultiplied(canvas, design_rgb, design_alpha, paste_x, paste_y)
+
+    if watermark_descriptor:
+        canvas_h, canvas_w = canvas.shape[:2]
+        layer = prepare_watermark_layer(watermark_descriptor, watermark_dir, font_path, (canvas_w, canvas_h))
+        if layer is not None:
+            wm_rgb, wm_alpha, wm_x, wm_y = layer
+            _blend_premultiplied(canvas, wm_rgb, wm_alpha, wm_x, wm_y)
+
+    return Image.fromarray(canvas, 'RGB')
+
 def add_watermark(image_to_watermark, watermark_descriptor, watermark_dir, font_path):
     """
     Thêm chữ ký vào ảnh. Ưu tiên tìm file ảnh trong folder Watermark,
@@ -292,7 +813,7 @@ def add_watermark(image_to_watermark, watermark_descriptor, watermark_dir, font_
             image_to_watermark.paste(watermark_img, (paste_x, paste_y), watermark_img)
 
         except Exception as e:
-            print(f"Lỗi khi xử lý ảnh watermark: {e}")
+            say(f"Lỗi khi xử lý ảnh watermark: {e}", WARNING)
     
     # --- Xử lý watermark dạng chữ nếu không tìm thấy file ---
     else:
@@ -313,42 +834,171 @@ def add_watermark(image_to_watermark, watermark_descriptor, watermark_dir, font_
 
 # utils/image_processing.py
 
+# --- STYLIZE (POSTERIZE + LÀM MỜ VIỀN) ---
+
+STYLIZE_SAMPLE_SIZE = 1024  # Cạnh dài tối đa của ảnh mẫu dùng để ước lượng bảng màu
+_LUT_BITS = 5               # Độ phân giải mỗi kênh của LUT 3D (32x32x32 ô màu)
+
+class StylizeEngine:
+    """
+    Bộ máy stylize cho một ảnh đầu vào, dùng lại phần việc chung giữa các lần render:
+    - Bảng màu được ước lượng trên bản thu nhỏ (fast octree, như convert ADAPTIVE với ảnh RGBA), cache theo posterize_level.
+    - Ảnh gốc được ánh xạ sang bảng màu qua LUT 3D; chỉ số ô LUT của từng pixel tính một lần.
+    - Mặt nạ viền mờ = tích ngoài của 2 profile 1D đã làm mờ (Gaussian tách được), cache theo tham số.
+    """
+
+    def __init__(self, image_pil, sample_size=STYLIZE_SAMPLE_SIZE):
+        self._rgb_img = image_pil.convert('RGB')
+        self.width, self.height = self._rgb_img.size
+        reduce_factor = max(1, -(-max(self.width, self.height) // sample_size))
+        self._sample = self._rgb_img.reduce(reduce_factor) if reduce_factor > 1 else self._rgb_img
+        self._cell_index = None
+        self._palettes = {}
+        self._masks = {}
+
+    def _lut_cells(self):
+        """Chỉ số ô LUT (uint16) của từng pixel ảnh gốc, tính lười một lần."""
+        if self._cell_index is None:
+            rgb = np.asarray(self._rgb_img)
+            shift = 8 - _LUT_BITS
+            cells = (rgb[:, :, 0] >> shift).astype(np.uint16) << (2 * _LUT_BITS)
+            cells |= (rgb[:, :, 1] >> shift).astype(np.uint16) << _LUT_BITS
+            cells |= (rgb[:, :, 2] >> shift).astype(np.uint16)
+            self._cell_index = cells
+        return self._cell_index
+
+    def palette(self, posterize_level):
+        """Bảng màu (k, 3) uint8 cho posterize_level, ước lượng trên ảnh mẫu."""
+        if posterize_level not in self._palettes:
+            colors = 2 ** max(1, min(8, posterize_level))
+            quantized = self._sample.quantize(colors=colors, method=Image.Quantize.FASTOCTREE)
+            full_palette = np.array(quantized.getpalette(), dtype=np.uint8).reshape(-1, 3)
+            used_indices = sorted(index for _, index in quantized.getcolors(256))
+            self._palettes[posterize_level] = full_palette[used_indices]
+        return self._palettes[posterize_level]
+
+    def _palette_lut(self, palette):
+        """
+        LUT 3D: mỗi ô màu -> màu gần nhất trong bảng màu (tính tại tâm ô).
+        Mỗi màu được đóng gói thành uint32 RGBA để ánh xạ cả ảnh bằng một lần np.take.
+        """
+        steps = 1 << _LUT_BITS
+        centers = (np.arange(steps, dtype=np.float32) + 0.5) * (256 / steps)
+        grid = np.stack(np.meshgrid(centers, centers, centers, indexing='ij'), axis=-1).reshape(-1, 3)
+        pal = palette.astype(np.float32)
+        # |c - p|^2 = |c|^2 - 2 c.p + |p|^2; |c|^2 không ảnh hưởng argmin
+        distances = (pal * pal).sum(axis=1)[None, :] - 2.0 * grid @ pal.T
+        packed = np.zeros((steps ** 3, 4), dtype=np.uint8)
+        packed[:, :3] = palette[np.argmin(distances, axis=1)]
+        return packed.view(np.uint32).ravel()
+
+    def posterized_rgba(self, posterize_level):
+        """Ảnh gốc đã giảm màu dạng ndarray (H, W, 4); kênh alpha chưa được gán."""
+        lut = self._palette_lut(self.palette(posterize_level))
+        mapped = np.take(lut, self._lut_cells())
+        return mapped.view(np.uint8).reshape(self.height, self.width, 4)
+
+    @staticmethod
+    def _blurred_profile(length, start, stop, sigma):
+        """Profile 1D của cạnh hình chữ nhật [start, stop) sau khi làm mờ Gaussian."""
+        profile = np.zeros((1, length), dtype=np.float32)
+        profile[0, max(0, start):max(0, stop)] = 1.0
+        blurred = cv2.GaussianBlur(profile, (0, 0), sigmaX=sigma, sigmaY=0, borderType=cv2.BORDER_REPLICATE)
+        return blurred[0]
+
+    def feather_mask(self, feather_margin, blur_factor):
+        """Mặt nạ viền mờ (H, W) uint8, lề dưới bằng một nửa lề trên."""
+        key = (feather_margin, blur_factor)
+        if key not in self._masks:
+            width, height = self.width, self.height
+            margin_w = int(width * feather_margin)
+            margin_h_top = int(height * feather_margin)
+            margin_h_bottom = margin_h_top // 2
+            # blur_factor càng lớn, bán kính càng nhỏ, viền càng nét
+            blur_radius = max(1, max(margin_w, margin_h_top) // blur_factor)
+
+            col_profile = self._blurred_profile(width, margin_w, width - margin_w + 1, blur_radius)
+            row_profile = self._blurred_profile(height, margin_h_top, height - margin_h_bottom + 1, blur_radius)
+            mask = np.outer(row_profile, col_profile * 255.0)
+            self._masks[key] = np.clip(mask + 0.5, 0, 255).astype(np.uint8)
+        return self._masks[key]
+
+    def render(self, posterize_level=4, feather_margin=0.1, blur_factor=5):
+        """Trả về ảnh RGBA đã stylize cho một bộ tham số."""
+        rgba = self.posterized_rgba(posterize_level)
+        rgba[:, :, 3] = self.feather_mask(feather_margin, blur_factor)
+        return Image.fromarray(rgba, 'RGBA')
+
 def stylize_image(image_pil, posterize_level=4, feather_margin=0.1, blur_factor=5):
     """
     "Trừu tượng hóa" ảnh bằng cách giảm màu và làm mờ viền một cách tùy chỉnh.
     - posterize_level: Càng thấp, màu càng ít.
     - feather_margin: Tỷ lệ độ rộng của viền mờ (vd: 0.1 = 10%).
     - blur_factor: Hệ số làm nét. Số càng LỚN, viền càng SẮC NÉT (ít nhòe).
+    Khi cần nhiều mức posterize cho cùng một ảnh, dùng trực tiếp StylizeEngine để dùng lại phần việc chung.
     """
-    # Bước 1: Posterize (giữ nguyên)
-    posterized_img = image_pil.convert('P', palette=Image.ADAPTIVE, colors=2**posterize_level).convert('RGBA')
+    return StylizeEngine(image_pil).render(posterize_level, feather_margin, blur_factor)
 
-    # Bước 2: Tạo mặt nạ để làm mờ viền (phiên bản mới)
-    width, height = posterized_img.size
-    mask = Image.new('L', (width, height), 0)
-    draw = ImageDraw.Draw(mask)
+# --- BỐ CỤC TEXT (FONT CACHE + CANH CỠ CHỮ) ---
 
-    # Tính toán các lề
-    margin_w = int(width * feather_margin)
-    margin_h_top = int(height * feather_margin) # Lề trên và 2 bên
-    margin_h_bottom = margin_h_top // 2        # <<< LỀ DƯỚI CHỈ BẰNG MỘT NỬA
+FONT_EXTENSIONS = ('.ttf', '.otf')
+TEXT_REFERENCE_SIZE = 100  # Cỡ chữ dùng để đo một lần trước khi tính cỡ chữ vừa khung
 
-    # Vẽ hình chữ nhật trắng với lề dưới nhỏ hơn
-    draw.rectangle(
-        (margin_w, margin_h_top, width - margin_w, height - margin_h_bottom),
-        fill=255
+@lru_cache(maxsize=8)
+def list_font_files(fonts_dir):
+    """Danh sách đường dẫn font trong thư mục, chỉ quét thư mục một lần cho mỗi process."""
+    return tuple(
+        os.path.join(fonts_dir, f) for f in sorted(os.listdir(fonts_dir))
+        if f.lower().endswith(FONT_EXTENSIONS)
     )
 
-    # Tính toán bán kính làm mờ dựa trên hệ số `blur_factor`
-    # blur_factor càng lớn, bán kính càng nhỏ, viền càng nét
-    blur_radius = max(1, max(margin_w, margin_h_top) // blur_factor)
-    
-    mask = mask.filter(ImageFilter.GaussianBlur(radius=blur_radius))
+@lru_cache(maxsize=128)
+def load_font(font_path, font_size):
+    """FreeType face theo (font, cỡ chữ), có cache."""
+    return ImageFont.truetype(font_path, font_size)
 
-    # Áp dụng mask vào kênh alpha của ảnh
-    posterized_img.putalpha(mask)
-    
-    return posterized_img
+def fit_font(text, font_path, max_width, max_height=80):
+    """
+    Tính cỡ chữ vừa khung trong MỘT bước từ số đo ở cỡ tham chiếu:
+    - Giới hạn chiều cao chữ tối đa max_height.
+    - Nếu vẫn rộng hơn max_width thì thu nhỏ theo tỷ lệ chiều rộng.
+    Trả về font đã nạp (từ cache).
+    """
+    x0, y0, x1, y1 = load_font(font_path, TEXT_REFERENCE_SIZE).getbbox(text)
+    ref_width, ref_height = x1 - x0, y1 - y0
+
+    font_size = TEXT_REFERENCE_SIZE
+    if ref_height > max_height:
+        font_size = int(font_size * max_height / ref_height)
+    scaled_width = ref_width * font_size / TEXT_REFERENCE_SIZE
+    if scaled_width > max_width:
+        font_size = int(font_size * max_width / scaled_width)
+    return load_font(font_path, max(1, font_size))
+
+def compose_text_below(image_pil, text, font, text_color, text_margin=20):
+    """
+    Ghép một dòng text bên dưới ảnh trên canvas đã tính sẵn kích thước:
+    - Ảnh chỉ được ghi vào canvas đúng một lần (paste trong C, không qua bản sao trung gian).
+    - Text được vẽ trên dải nhỏ riêng rồi dán vào, không vẽ/duyệt trên toàn canvas.
+    """
+    x0, y0, x1, y1 = font.getbbox(text)
+    text_width, text_height = x1 - x0, y1 - y0
+
+    new_width = max(image_pil.width, text_width)
+    new_height = image_pil.height + text_height + text_margin
+    final_canvas = Image.new('RGBA', (new_width, new_height), (0, 0, 0, 0))
+
+    img_paste_x = (new_width - image_pil.width) // 2
+    final_canvas.paste(image_pil, (img_paste_x, 0), image_pil)
+
+    if text_width > 0 and text_height > 0:
+        strip = Image.new('RGBA', (new_width, text_height), (0, 0, 0, 0))
+        text_paste_x = (new_width - text_width) // 2
+        # Trừ đi offset (x0, y0) của bounding box để toàn bộ text nằm trong vùng đã tính
+        ImageDraw.Draw(strip).text((text_paste_x - x0, -y0), text, font=font, fill=text_color)
+        final_canvas.paste(strip, (0, image_pil.height + text_margin))
+
+    return final_canvas
 
 def add_hashtag_text(image_pil, filename, fonts_dir, image_width, is_black_mockup):
     """
@@ -359,65 +1009,13 @@ def add_hashtag_text(image_pil, filename, fonts_dir, image_width, is_black_mocku
     text_color = (255, 255, 255) if is_black_mockup else (50, 50, 50)
     
     try:
-        font_files = [f for f in os.listdir(fonts_dir) if f.lower().endswith(('.ttf', '.otf'))]
+        font_files = list_font_files(fonts_dir)
         if not font_files: raise FileNotFoundError("Không tìm thấy file font.")
-        random_font_path = os.path.join(fonts_dir, random.choice(font_files))
-        
-        font_size = 100
-        font = ImageFont.truetype(random_font_path, font_size)
-        
-        # Dùng getbbox để lấy chiều cao chính xác
-        bbox = font.getbbox(text_to_add)
-        text_height = bbox[3] - bbox[1]
-
-        if text_height > 80:
-            scale = 80 / text_height
-            font_size = int(font_size * scale)
-            font = ImageFont.truetype(random_font_path, font_size)
-        
-        bbox = font.getbbox(text_to_add)
-        text_width = bbox[2] - bbox[0]
-        
-        if text_width > image_width:
-            scale = image_width / text_width
-            font_size = int(font_size * scale)
-            font = ImageFont.truetype(random_font_path, font_size)
-            
+        font = fit_font(text_to_add, random.choice(font_files), image_width)
     except Exception as e:
-        print(f"  - ⚠️ Lỗi font: {e}. Dùng font mặc định."); font = ImageFont.load_default()
+        say(f"  - ⚠️ Lỗi font: {e}. Dùng font mặc định.", WARNING); font = ImageFont.load_default()
 
-    # <<< THAY ĐỔI: TÍNH TOÁN LẠI KÍCH THƯỚC VÀ VỊ TRÍ DỰA TRÊN GETBBOX >>>
-    
-    # 1. Tính toán kích thước pixel thực tế của text
-    bbox = font.getbbox(text_to_add)
-    x0, y0, x1, y1 = bbox
-    text_width = x1 - x0
-    text_height = y1 - y0
-
-    text_margin = 20
-    
-    # 2. Tạo canvas mới đủ lớn
-    new_height = image_pil.height + text_height + text_margin
-    new_width = max(image_pil.width, text_width)
-    final_canvas = Image.new('RGBA', (new_width, new_height), (0,0,0,0))
-    
-    # 3. Ghép ảnh và text vào canvas
-    img_paste_x = (new_width - image_pil.width) // 2
-    final_canvas.paste(image_pil, (img_paste_x, 0), image_pil)
-    
-    text_draw = ImageDraw.Draw(final_canvas)
-    
-    # 4. Tính toán vị trí dán text có điều chỉnh
-    # Căn giữa theo chiều ngang
-    text_paste_x = (new_width - text_width) // 2
-    # Vị trí dán theo chiều dọc
-    text_paste_y = image_pil.height + text_margin
-    
-    # Dán text, nhưng trừ đi offset (x0, y0) của bounding box
-    # để đảm bảo toàn bộ text nằm trong vùng đã tính
-    text_draw.text((text_paste_x - x0, text_paste_y - y0), text_to_add, font=font, fill=text_color)
-    
-    return final_canvas
+    return compose_text_below(image_pil, text_to_add, font, text_color)
 
 def determine_mockup_color(image_pil, threshold=60):
     """
@@ -0,0 +1,198 @@
+# utils/memory_governor.py
+"""
+Bộ điều tiết bộ nhớ cho các bước xử lý ảnh nặng.
+- Ước lượng bộ nhớ của từng bước từ kích thước ảnh TRƯỚC khi chạy.
+- Hạ độ phân giải tinh chỉnh viền (refine_size) hoặc xếp hàng chờ khi vượt ngân sách RSS.
+- Đo RSS đỉnh của từng ảnh để ghi vào log của lần chạy.
+"""
+import os
+import sys
+import threading
+from contextlib import contextmanager
+
+from utils.event_log import say, DEBUG, INFO
+
+MB = 1024 * 1024
+
+# --- ĐỌC RSS CỦA PROCESS (không cần psutil) ---
+
+if sys.platform == 'win32':
+    import ctypes
+    from ctypes import wintypes
+
+    class _ProcessMemoryCounters(ctypes.Structure):
+        _fields_ = [
+            ("cb", wintypes.DWORD), ("PageFaultCount", wintypes.DWORD),
+            ("PeakWorkingSetSize", ctypes.c_size_t), ("WorkingSetSize", ctypes.c_size_t),
+            ("QuotaPeakPagedPoolUsage", ctypes.c_size_t), ("QuotaPagedPoolUsage", ctypes.c_size_t),
+            ("QuotaPeakNonPagedPoolUsage", ctypes.c_size_t), ("QuotaNonPagedPoolUsage", ctypes.c_size_t),
+            ("PagefileUsage", ctypes.c_size_t), ("PeakPagefileUsage", ctypes.c_size_t),
+        ]
+
+    def current_rss():
+        counters = _ProcessMemoryCounters()
+        counters.cb = ctypes.sizeof(counters)
+        handle = ctypes.windll.kernel32.GetCurrentProcess()
+        if ctypes.windll.psapi.GetProcessMemoryInfo(handle, ctypes.byref(counters), counters.cb):
+            return counters.WorkingSetSize
+        return 0
+else:
+    _PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+    def current_rss():
+        try:
+            with open('/proc/self/statm', 'r') as f:
+                return int(f.read().split()[1]) * _PAGE_SIZE
+        except (OSError, IndexError, ValueError):
+            import resource
+            # macOS trả về byte, Linux trả về KB; ở đây chỉ là giá trị đỉnh dùng tạm
+            peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            return peak if sys.platform == 'darwin' else peak * 1024
+
+# --- ƯỚC LƯỢNG BỘ NHỚ CỦA TỪNG BƯỚC ---
+
+BAND_HALO_ROWS = 10  # Lề đọc thêm mỗi phía của một dải khi tách nền theo dải (SHARPEN_HALO)
+
+
+def refine_scale_factor(w, h, refine_size):
+    """Hệ số phóng to mặt nạ khi tinh chỉnh viền (giống hệt cách tính trong remove_background_advanced)."""
+    return max(1, int(refine_size / max(h, w, 1))) if refine_size else 1
+
+
+def estimate_bg_removal_bytes(w, h, refine_size, tiling=None):
+    """
+    Ước lượng bộ nhớ tạm của remove_background_advanced:
+    ~16 byte/pixel cho các mặt nạ 8-bit, ảnh mờ/làm nét RGBA và bản copy khi đầu vào là ảnh PIL
+    (ImageBuffer được sửa tại chỗ), cộng 3 mặt nạ 8-bit ở kích thước phóng to.
+    Khi tách nền theo dải (tiling từ plan_bg_tiling): phần trên tính cho một dải (kể cả lề) nhân số luồng,
+    cộng mặt nạ 8-bit toàn ảnh.
+    """
+    scale = refine_scale_factor(w, h, refine_size)
+    per_pixel = 16 + (3 * scale * scale if scale > 1 else 0)
+    if tiling:
+        band_pixels = w * min(h, tiling["tile_rows"] + 2 * BAND_HALO_ROWS)
+        return w * h + per_pixel * band_pixels * max(1, tiling["workers"])
+    return per_pixel * w * h
+
+
+def estimate_canvas_bytes(w, h, channels=4, copies=2):
+    """Ước lượng bộ nhớ cho một canvas (vd: canvas 4200x4800 RGBA của ktbrbg) và các bản sao khi lưu."""
+    return w * h * channels * copies
+
+
+# --- GOVERNOR ---
+
+class PeakTracker:
+    """Lấy mẫu RSS ở luồng nền trong lúc xử lý một ảnh và giữ lại giá trị đỉnh."""
+
+    def __init__(self, interval=0.02):
+        self.interval = interval
+        self.start_rss = current_rss()
+        self.peak_rss = self.start_rss
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            self.peak_rss = max(self.peak_rss, current_rss())
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self.peak_rss = max(self.peak_rss, current_rss())
+
+    @property
+    def peak_mb(self):
+        return self.peak_rss / MB
+
+
+class MemoryGovernor:
+    """
+    Giữ tổng bộ nhớ ước lượng của các bước đang chạy dưới ngân sách RSS.
+    budget_mb = None/0 nghĩa là không giới hạn (chỉ đo RSS đỉnh).
+    """
+
+    def __init__(self, budget_mb=None, min_refine_size=2000):
+        self.budget = int(budget_mb * MB) if budget_mb else None
+        self.min_refine_size = min_refine_size
+        self.baseline_rss = current_rss()
+        self._reservations = {}  # token -> (byte ước lượng, RSS lúc giữ chỗ)
+        self._active = 0
+        self._cond = threading.Condition()
+        self.peaks = []  # [(nhãn, peak_mb)]
+
+    def _headroom(self):
+        """
+        Ngân sách còn lại sau RSS hiện tại và phần giữ chỗ CHƯA hiện ra trong RSS:
+        bộ nhớ một bước đã cấp phát (RSS tăng từ lúc giữ chỗ) không bị trừ hai lần.
+        """
+        if self.budget is None:
+            return None
+        rss = current_rss()
+        outstanding = sum(max(0, estimated - max(0, rss - start_rss))
+                          for estimated, start_rss in self._reservations.values())
+        return self.budget - max(rss, self.baseline_rss) - outstanding
+
+    def plan_refine_size(self, w, h, refine_size, tiling=None):
+        """
+        Trả về refine_size đã được hạ xuống (nếu cần) để bước tách nền vừa với ngân sách.
+        Hạ theo từng bậc của hệ số phóng to, không thấp hơn min_refine_size.
+        tiling: cách chia dải sẽ dùng (nếu có), vì bộ nhớ tạm khi đó tỉ lệ với dải chứ không phải cả ảnh.
+        """
+        if self.budget is None or not refine_size:
+            return refine_size
+        headroom = self.budget - self.baseline_rss
+        longest = max(w, h, 1)
+        planned = refine_size
+        while estimate_bg_removal_bytes(w, h, planned, tiling) > headroom and planned > self.min_refine_size:
+            scale = refine_scale_factor(w, h, planned)
+            if scale <= 1:
+                break
+            planned = max(self.min_refine_size, (scale - 1) * longest)
+        if planned != refine_size:
+            say(f"  - 🧠 Governor: hạ refine_size {refine_size} -> {planned} để vừa ngân sách "
+                  f"{self.budget // MB} MB (ảnh {w}x{h}).", INFO)
+        return planned
+
+    @contextmanager
+    def reserve(self, estimated_bytes, label=""):
+        """
+        Giữ chỗ bộ nhớ cho một bước. Nếu vượt ngân sách thì chờ các bước khác giải phóng;
+        nếu không còn bước nào đang chạy thì vẫn cho chạy (không thể làm tốt hơn).
+        """
+        if self.budget is None:
+            yield
+            return
+        with self._cond:
+            waited = False
+            while self._active and self._headroom() < estimated_bytes:
+                if not waited:
+                    say(f"  - 🧠 Governor: xếp hàng '{label}' (cần ~{estimated_bytes // MB} MB).", INFO)
+                    waited = True
+                self._cond.wait(timeout=1.0)
+            token = object()
+            self._reservations[token] = (estimated_bytes, current_rss())
+            self._active += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                del self._reservations[token]
+                self._active -= 1
+                self._cond.notify_all()
+
+    @contextmanager
+    def track_peak(self, label):
+        """Đo RSS đỉnh trong khi xử lý một ảnh; in ra log và lưu vào self.peaks."""
+        tracker = PeakTracker().start()
+        try:
+            yield tracker
+        finally:
+            tracker.stop()
+            self.peaks.append((label, tracker.peak_mb))
+            say(f"  - 🧠 RSS đỉnh khi xử lý '{label}': {tracker.peak_mb:.0f} MB", DEBUG)
+
@@ -0,0 +1,312 @@
+# utils/metrics_exporter.py
+"""
+Metrics dạng Prometheus cho các lần chạy tool (không cần thư viện prometheus_client).
+- Bộ đếm/histogram được cập nhật từ các sự kiện của EventLog (đăng ký qua events.add_listener),
+  tức là chạy trên luồng ghi nền, không chạm vào vòng lặp xử lý ảnh.
+- Cuối mỗi lần chạy: ghi file textfile cho node-exporter (.metrics/textfile/ktb_<tool>.prom, ghi nguyên tử).
+- Chế độ chạy lâu (--metrics-port N hoặc metrics_export.port): phục vụ HTTP GET /metrics.
+- Thử cục bộ không cần Prometheus: curl http://127.0.0.1:<port>/metrics, hoặc
+  python -m utils.metrics_exporter .events/<file>.jsonl  (dựng lại metrics từ file sự kiện và in ra).
+"""
+import os
+import sys
+import argparse
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TEXTFILE_DIR = os.path.join(PROJECT_ROOT, ".metrics", "textfile")
+METRIC_PREFIX = "ktb"
+DEFAULT_HOST = "127.0.0.1"
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Giây; đủ rộng cho cả tải ảnh (vài chục ms) lẫn tách nền ảnh lớn (vài chục giây)
+DURATION_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+FILE_SIZE_BUCKETS = (25_000, 50_000, 100_000, 200_000, 300_000, 500_000, 1_000_000, 2_000_000, 5_000_000)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    pairs += [f'{name}="{_escape(value)}"' for name, value in extra]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+# --- KIỂU METRIC ---
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, help_text, label_names=()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, "")) for name in self.label_names)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            items = sorted(self._values.items())
+            lines += self._render_items(items)
+        return lines
+
+    def _render_items(self, items):
+        return [f"{self.name}{_format_labels(self.label_names, key)} {_format_value(value)}" for key, value in items]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help_text, label_names=(), buckets=DURATION_BUCKETS):
+        super().__init__(name, help_text, label_names)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[0][index] += 1
+                    break
+            state[1] += value
+            state[2] += 1
+
+    def _render_items(self, items):
+        lines = []
+        for key, (bucket_counts, total, count) in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, bucket_counts):
+                cumulative += bucket_count
+                labels = _format_labels(self.label_names, key, extra=[("le", _format_value(bound))])
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.label_names, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines += metric.render()
+        return "\n".join(lines) + "\n"
+
+
+# --- METRICS CỦA PIPELINE ---
+
+class PipelineMetrics:
+    """
+    Các metrics chung của mọi tool, cập nhật từ sự kiện của EventLog.
+    Một instance cho mỗi tool trong process (xem for_tool) để số liệu cộng dồn qua nhiều lần chạy
+    khi tool chạy lâu, và cổng HTTP chỉ mở một lần.
+    """
+
+    _instances = {}
+    _instances_lock = threading.Lock()
+
+    def __init__(self, tool_name, textfile_dir=TEXTFILE_DIR):
+        self.tool_name = tool_name
+        self.textfile_dir = textfile_dir
+        self.registry = MetricsRegistry()
+        self._server = None
+        p = METRIC_PREFIX
+        add = self.registry.register
+        self.images = add(Counter(f"{p}_images_total", "Số ảnh/URL đã xử lý theo kết quả.", ("tool", "status")))
+        self.downloads = add(Counter(f"{p}_images_downloaded_total", "Số ảnh tải thành công.", ("tool", "domain")))
+        self.download_bytes = add(Counter(f"{p}_download_bytes_total", "Tổng số byte ảnh đã tải.", ("tool", "domain")))
+        self.download_errors = add(Counter(f"{p}_download_errors_total", "Số lần tải ảnh thất bại.", ("tool", "domain")))
+        self.spooled = add(Counter(f"{p}_spooled_images_total", "Số ảnh gốc ktbimage đưa vào spool cho ktbimg.", ("tool", "domain")))
+        self.spool_hits = add(Counter(f"{p}_spool_hits_total", "Số ảnh lấy từ spool thay vì tải lại.", ("tool", "domain")))
+        self.skips = add(Counter(f"{p}_skips_total", "Số ảnh bị bỏ qua theo lý do.", ("tool", "reason")))
+        self.outputs = add(Counter(f"{p}_outputs_total", "Số output đã encode theo mockup set.", ("tool", "mockup")))
+        self.identical_outputs = add(Counter(f"{p}_identical_outputs_total", "Số output giống hệt output cũ (dùng lại bytes, không encode lại).", ("tool", "mockup")))
+        self.output_bytes = add(Counter(f"{p}_output_bytes_total", "Tổng số byte output đã encode.", ("tool", "mockup")))
+        self.output_file_bytes = add(Histogram(f"{p}_output_file_bytes", "Kích thước từng file output (mọi biến thể).", ("tool", "mockup"), FILE_SIZE_BUCKETS))
+        self.stage_seconds = add(Histogram(f"{p}_stage_duration_seconds", "Thời gian từng giai đoạn của một ảnh.", ("tool", "stage")))
+        self.image_seconds = add(Histogram(f"{p}_image_duration_seconds", "Tổng thời gian xử lý một ảnh.", ("tool",)))
+        self.runs = add(Counter(f"{p}_runs_total", "Số lần chạy đã kết thúc.", ("tool",)))
+        self.last_run_duration = add(Gauge(f"{p}_last_run_duration_seconds", "Thời gian của lần chạy gần nhất.", ("tool",)))
+        self.last_run_end = add(Gauge(f"{p}_last_run_end_timestamp_seconds", "Thời điểm kết thúc lần chạy gần nhất (Unix).", ("tool",)))
+
+    @classmethod
+    def for_tool(cls, tool_name, config=None, argv=None):
+        """
+        config = defaults['metrics_export'] trong config.json: {"textfile_dir": ..., "port": ..., "host": ...}.
+        --metrics-port trên dòng lệnh được ưu tiên; port 0/không đặt = không mở HTTP.
+        """
+        config = config or {}
+        args = parse_metrics_args(argv)
+        with cls._instances_lock:
+            metrics = cls._instances.get(tool_name)
+            if metrics is None:
+                textfile_dir = config.get("textfile_dir") or TEXTFILE_DIR
+                if not os.path.isabs(textfile_dir):
+                    textfile_dir = os.path.join(PROJECT_ROOT, textfile_dir)
+                metrics = cls._instances[tool_name] = cls(tool_name, textfile_dir)
+                port = args.metrics_port if args.metrics_port is not None else config.get("port", 0)
+                if port:
+                    metrics.serve(port, config.get("host", DEFAULT_HOST))
+        return metrics
+
+    # --- CẬP NHẬT TỪ SỰ KIỆN ---
+
+    def observe(self, event):
+        """Listener cho EventLog.add_listener: cập nhật metrics từ một sự kiện."""
+        kind = event.get("event")
+        tool = event.get("tool", self.tool_name)
+        if kind == "image":
+            self._observe_image(tool, event)
+        elif kind == "run_end":
+            self.runs.inc(tool=tool)
+            self.last_run_duration.set(event.get("duration_s", 0), tool=tool)
+            self.last_run_end.set(event.get("ts", 0), tool=tool)
+
+    def _observe_image(self, tool, event):
+        domain = event.get("domain", "")
+        self.images.inc(tool=tool, status=event.get("status", ""))
+        if event.get("download_bytes") is not None:
+            self.downloads.inc(tool=tool, domain=domain)
+            self.download_bytes.inc(event["download_bytes"], tool=tool, domain=domain)
+        if event.get("spooled"):
+            self.spooled.inc(tool=tool, domain=domain)
+        if event.get("spool_hit"):
+            self.spool_hits.inc(tool=tool, domain=domain)
+        reason = event.get("skip_reason")
+        if reason:
+            self.skips.inc(tool=tool, reason=reason)
+            if reason == "download_failed":
+                self.download_errors.inc(tool=tool, domain=domain)
+        for output in event.get("outputs", []):
+            mockup = output.get("mockup", "")
+            if output.get("identical_to"):
+                self.identical_outputs.inc(tool=tool, mockup=mockup)
+            else:
+                self.outputs.inc(tool=tool, mockup=mockup)
+                self.output_bytes.inc(output.get("bytes", 0), tool=tool, mockup=mockup)
+                for entry in output.get("files") or [output]:
+                    self.output_file_bytes.observe(entry.get("bytes", 0), tool=tool, mockup=mockup)
+        for stage, ms in event.get("stages_ms", {}).items():
+            self.stage_seconds.observe(ms / 1000, tool=tool, stage=stage)
+        if "total_ms" in event:
+            self.image_seconds.observe(event["total_ms"] / 1000, tool=tool)
+
+    # --- XUẤT ---
+
+    def render(self):
+        return self.registry.render()
+
+    def write_textfile(self):
+        """Ghi file .prom cho textfile collector của node-exporter (ghi file tạm rồi đổi tên)."""
+        os.makedirs(self.textfile_dir, exist_ok=True)
+        path = os.path.join(self.textfile_dir, f"{METRIC_PREFIX}_{self.tool_name}.prom")
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                f.write(self.render())
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"⚠️ Không ghi được file metrics {path}: {e}")
+            return None
+        print(f"📈 Đã ghi metrics: {path}")
+        return path
+
+    def serve(self, port, host=DEFAULT_HOST):
+        """Mở HTTP /metrics ở luồng nền (daemon) cho chế độ chạy lâu."""
+        if self._server is not None:
+            return self._server.server_address[1]
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?", 1)[0] != "/metrics":
+                    self.send_response(404)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                body = metrics.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", CONTENT_TYPE)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        try:
+            self._server = ThreadingHTTPServer((host, port), Handler)
+        except OSError as e:
+            print(f"⚠️ Không mở được cổng metrics {host}:{port} ({e}); chỉ ghi textfile.")
+            return None
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, name=f"metrics-{self.tool_name}", daemon=True).start()
+        bound_port = self._server.server_address[1]
+        print(f"📈 Metrics: http://{host}:{bound_port}/metrics")
+        return bound_port
+
+    def close(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+
+def parse_metrics_args(argv=None):
+    """Đọc --metrics-port N từ dòng lệnh (bỏ qua các tham số khác)."""
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument("--metrics-port", type=int)
+    args, _ = parser.parse_known_args(sys.argv[1:] if argv is None else argv)
+    return args
+
+
+if __name__ == "__main__":
+    # Dựng lại metrics từ file sự kiện: python -m utils.metrics_exporter <events.jsonl> [...]
+    from utils.event_log import read_events
+    if len(sys.argv) < 2:
+        print("Cách dùng: python -m utils.metrics_exporter <events.jsonl> [...]"); sys.exit(2)
+    replay = PipelineMetrics("replay")
+    for events_path in sys.argv[1:]:
+        for event in read_events(events_path):
+            replay.observe(event)
+    sys.stdout.write(replay.render())
@@ -0,0 +1,165 @@
+# utils/metrics_store.py
+"""
+Kho đếm số ảnh dạng append-only (SQLite WAL).
+- Mỗi lần chạy chỉ INSERT thêm dòng mới, không đọc-sửa-ghi lại toàn bộ file,
+  nên nhiều tool kết thúc cùng lúc không làm mất số liệu của nhau.
+- Lưu theo run, tool, domain, mockup kèm timestamp; tổng hợp theo ngày/tuần bằng SQL.
+- TotalImage.txt chỉ còn là một "view" được render lại từ kho khi cần.
+"""
+import os
+import time
+import uuid
+import sqlite3
+from datetime import datetime, timedelta
+import pytz
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+METRICS_DB_FILE = os.path.join(PROJECT_ROOT, ".metrics", "counters.db")
+TIMEZONE = pytz.timezone('Asia/Ho_Chi_Minh')
+
+
+def _today_str():
+    return datetime.now(TIMEZONE).strftime('%Y-%m-%d')
+
+
+def _connect(db_path):
+    os.makedirs(os.path.dirname(db_path), exist_ok=True)
+    conn = sqlite3.connect(db_path, timeout=30)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS image_counts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            run_id TEXT NOT NULL,
+            ts REAL NOT NULL,
+            day TEXT NOT NULL,
+            tool TEXT NOT NULL,
+            domain TEXT,
+            mockup TEXT NOT NULL,
+            count INTEGER NOT NULL
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_image_counts_day_tool ON image_counts (day, tool)")
+    return conn
+
+
+def new_run_id(tool_name):
+    return f"{tool_name}.{datetime.now(TIMEZONE).strftime('%Y%m%d_%H%M%S')}.{uuid.uuid4().hex[:8]}"
+
+
+def record_counts(tool_name, rows, db_path=METRICS_DB_FILE, run_id=None):
+    """
+    Ghi thêm số liệu của một lần chạy.
+    rows: danh sách (domain, mockup, count); domain có thể là None với các tool không theo domain.
+    """
+    rows = [(domain, mockup, int(count)) for domain, mockup, count in rows if count]
+    if not rows:
+        return None
+    run_id = run_id or new_run_id(tool_name)
+    now, day = time.time(), _today_str()
+    conn = _connect(db_path)
+    try:
+        with conn:
+            conn.executemany(
+                "INSERT INTO image_counts (run_id, ts, day, tool, domain, mockup, count) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [(run_id, now, day, tool_name, domain, mockup, count) for domain, mockup, count in rows]
+            )
+    finally:
+        conn.close()
+    return run_id
+
+
+def range_totals(start_day, end_day, tool_name=None, group_by=("tool", "mockup"), db_path=METRICS_DB_FILE):
+    """
+    Tổng số ảnh trong khoảng ngày [start_day, end_day] (chuỗi 'YYYY-MM-DD'),
+    gom nhóm theo các cột trong group_by (tool, domain, mockup, day, run_id).
+    Trả về dict {tuple_các_cột: tổng}.
+    """
+    allowed = {"tool", "domain", "mockup", "day", "run_id"}
+    columns = [c for c in group_by if c in allowed]
+    if not columns:
+        raise ValueError(f"group_by phải chứa ít nhất một trong {sorted(allowed)}")
+    sql = f"SELECT {', '.join(columns)}, SUM(count) FROM image_counts WHERE day BETWEEN ? AND ?"
+    params = [start_day, end_day]
+    if tool_name:
+        sql += " AND tool = ?"
+        params.append(tool_name)
+    sql += f" GROUP BY {', '.join(columns)}"
+    conn = _connect(db_path)
+    try:
+        return {tuple(row[:-1]): row[-1] for row in conn.execute(sql, params)}
+    finally:
+        conn.close()
+
+
+def daily_totals(day=None, tool_name=None, db_path=METRICS_DB_FILE):
+    """Tổng theo 'tool.mockup' trong một ngày (mặc định hôm nay, GMT+7)."""
+    day = day or _today_str()
+    totals = range_totals(day, day, tool_name, ("tool", "mockup"), db_path)
+    return {f"{tool}.{mockup}": count for (tool, mockup), count in totals.items()}
+
+
+def weekly_totals(day=None, tool_name=None, group_by=("tool", "mockup"), db_path=METRICS_DB_FILE):
+    """Tổng của tuần (thứ Hai - Chủ Nhật) chứa ngày `day`."""
+    ref = datetime.strptime(day, '%Y-%m-%d') if day else datetime.now(TIMEZONE)
+    start = ref - timedelta(days=ref.weekday())
+    end = start + timedelta(days=6)
+    return range_totals(start.strftime('%Y-%m-%d'), end.strftime('%Y-%m-%d'), tool_name, group_by, db_path)
+
+
+def import_legacy_total_file(filepath, db_path=METRICS_DB_FILE):
+    """
+    Nhập số liệu của ngày hôm nay từ TotalImage.txt cũ vào kho (chỉ khi kho còn trống),
+    để lần chuyển đổi đầu tiên không làm mất số đếm trong ngày.
+    Kiểm tra kho trống và ghi nằm trong cùng một transaction BEGIN IMMEDIATE, nên hai tool
+    chạy cùng lúc lần đầu không nhập trùng (số liệu bị nhân đôi).
+    """
+    try:
+        with open(filepath, 'r', encoding='utf-8') as f:
+            first_line = f.readline().strip()
+            if not first_line.startswith("Timestamp:") or first_line.split()[1] != _today_str():
+                return False
+            rows = []
+            for line in f:
+                if ':' not in line:
+                    continue
+                key, count = line.strip().split(':', 1)
+                tool, _, mockup = key.strip().partition('.')
+                if mockup and count.strip().isdigit() and int(count.strip()):
+                    rows.append((tool, mockup, int(count.strip())))
+    except (OSError, IndexError):
+        return False
+    if not rows:
+        return False
+
+    now, day = time.time(), _today_str()
+    conn = _connect(db_path)
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if conn.execute("SELECT 1 FROM image_counts LIMIT 1").fetchone():
+                conn.execute("ROLLBACK")
+                return False
+            conn.executemany(
+                "INSERT INTO image_counts (run_id, ts, day, tool, domain, mockup, count) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [(f"{tool}.legacy-import", now, day, tool, None, mockup, count) for tool, mockup, count in rows]
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+    finally:
+        conn.close()
+    return True
+
+
+def render_total_image_view(filepath, day=None, db_path=METRICS_DB_FILE):
+    """Render lại view TotalImage.txt (định dạng cũ) từ kho số liệu, ghi nguyên tử."""
+    day = day or _today_str()
+    totals = daily_totals(day, db_path=db_path)
+    tmp_path = f"{filepath}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write(f"Timestamp: {day}\n\n")
+        for key in sorted(totals.keys()):
+            f.write(f"{key}: {totals[key]}\n")
+    os.replace(tmp_path, filepath)
+    return totals
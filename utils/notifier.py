@@ -0,0 +1,195 @@
+# utils/notifier.py
+"""
+Outbox cho các báo cáo Telegram.
+- Tool chỉ ghi nội dung báo cáo vào một hàng đợi SQLite rồi thoát ngay.
+- Một worker chạy nền (process tách rời) gửi các báo cáo, gộp nhiều lần chạy
+  thành một tin nhắn và thử lại khi lỗi, nên không mất báo cáo.
+"""
+import os
+import sys
+import time
+import sqlite3
+import subprocess
+import requests
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+OUTBOX_DIR = os.path.join(PROJECT_ROOT, ".outbox")
+OUTBOX_FILE = os.path.join(OUTBOX_DIR, "telegram.db")
+WORKER_LOG_FILE = os.path.join(OUTBOX_DIR, "worker.log")
+DEFAULT_API_BASE = "https://api.telegram.org"
+
+TELEGRAM_MAX_LENGTH = 4096
+COALESCE_WINDOW_SECONDS = 3
+CLAIM_TIMEOUT_SECONDS = 300
+MAX_SEND_ROUNDS = 5
+
+_worker_started = False
+
+# --- HÀNG ĐỢI SQLITE ---
+
+def _connect(outbox_path):
+    os.makedirs(os.path.dirname(outbox_path), exist_ok=True)
+    conn = sqlite3.connect(outbox_path, timeout=30, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            chat_id TEXT NOT NULL,
+            text TEXT NOT NULL,
+            created REAL NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt REAL NOT NULL DEFAULT 0,
+            claimed REAL
+        )
+    """)
+    return conn
+
+
+def enqueue_telegram_message(text, chat_id_env="TELEGRAM_CHAT_ID", outbox_path=OUTBOX_FILE, start_worker=True):
+    """
+    Ghi một báo cáo vào outbox. Trả về True nếu đã ghi.
+    Worker gửi nền sẽ được khởi động (một lần cho mỗi process) nếu start_worker=True.
+    """
+    token, chat_id = os.getenv("TELEGRAM_BOT_TOKEN"), os.getenv(chat_id_env)
+    if not token or not chat_id:
+        print("⚠️ Cảnh báo: Không tìm thấy biến môi trường Telegram. Bỏ qua."); return False
+
+    conn = _connect(outbox_path)
+    try:
+        conn.execute("INSERT INTO outbox (chat_id, text, created) VALUES (?, ?, ?)", (chat_id, text, time.time()))
+    finally:
+        conn.close()
+    print("📮 Đã ghi báo cáo vào outbox Telegram.")
+
+    if start_worker:
+        start_flush_worker(outbox_path)
+    return True
+
+# --- GỬI TIN ---
+
+def _coalesce(items, max_length=TELEGRAM_MAX_LENGTH):
+    """
+    Gộp nhiều báo cáo [(id, text)] thành ít tin nhắn nhất có thể, không vượt giới hạn độ dài của Telegram.
+    Trả về [(danh sách id trong tin, nội dung tin)] để xoá đúng các báo cáo đã gửi.
+    """
+    chunks, current, current_ids = [], "", []
+    for row_id, text in items:
+        text = text[:max_length]
+        candidate = f"{current}\n\n{text}" if current else text
+        if len(candidate) <= max_length:
+            current = candidate
+        else:
+            chunks.append((current_ids, current))
+            current, current_ids = text, []
+        current_ids.append(row_id)
+    if current_ids:
+        chunks.append((current_ids, current))
+    return chunks
+
+
+def _claim_batch(conn):
+    """Nhận (claim) các báo cáo đến hạn gửi trong một transaction để hai worker không gửi trùng."""
+    now = time.time()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        rows = conn.execute(
+            "SELECT id, chat_id, text FROM outbox WHERE next_attempt <= ? AND (claimed IS NULL OR claimed < ?) ORDER BY id",
+            (now, now - CLAIM_TIMEOUT_SECONDS)
+        ).fetchall()
+        if rows:
+            conn.executemany("UPDATE outbox SET claimed = ? WHERE id = ?", [(now, row[0]) for row in rows])
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    return rows
+
+
+def flush_outbox(outbox_path=OUTBOX_FILE, api_base=None, timeout=10):
+    """
+    Gửi một lượt tất cả báo cáo đến hạn. Các báo cáo cùng chat được gộp lại.
+    Trả về số báo cáo vẫn còn chờ trong outbox.
+    """
+    token = os.getenv("TELEGRAM_BOT_TOKEN")
+    api_base = (api_base or os.getenv("TELEGRAM_API_BASE") or DEFAULT_API_BASE).rstrip('/')
+    conn = _connect(outbox_path)
+    try:
+        rows = _claim_batch(conn)
+        by_chat = {}
+        for row_id, chat_id, text in rows:
+            by_chat.setdefault(chat_id, []).append((row_id, text))
+
+        for chat_id, items in by_chat.items():
+            # Mỗi tin gửi xong thì xoá ngay các báo cáo trong tin đó, để lần thử lại không gửi trùng
+            pending_ids = [row_id for row_id, _ in items]
+            sent_count = 0
+            if token:
+                for chunk_ids, message in _coalesce(items):
+                    try:
+                        response = requests.post(f"{api_base}/bot{token}/sendMessage",
+                                                 data={'chat_id': chat_id, 'text': message}, timeout=timeout)
+                        response.raise_for_status()
+                    except Exception as e:
+                        print(f"❌ Lỗi khi gửi báo cáo tới Telegram: {e}")
+                        break
+                    conn.execute(f"DELETE FROM outbox WHERE id IN ({','.join('?' * len(chunk_ids))})", chunk_ids)
+                    pending_ids = pending_ids[len(chunk_ids):]
+                    sent_count += len(chunk_ids)
+
+            if sent_count:
+                print(f"✅ Đã gửi {sent_count} báo cáo tới Telegram (chat {chat_id}).")
+            if pending_ids:
+                # Backoff theo số lần thử: 30s, 60s, 120s... tối đa 30 phút
+                conn.execute(
+                    f"UPDATE outbox SET attempts = attempts + 1, claimed = NULL, "
+                    f"next_attempt = ? + MIN(1800, 30 * (1 << MIN(attempts, 6))) WHERE id IN ({','.join('?' * len(pending_ids))})",
+                    [time.time()] + pending_ids
+                )
+        return conn.execute("SELECT COUNT(*) FROM outbox").fetchone()[0]
+    finally:
+        conn.close()
+
+
+def run_worker(outbox_path=OUTBOX_FILE, api_base=None, coalesce_window=COALESCE_WINDOW_SECONDS, max_rounds=MAX_SEND_ROUNDS):
+    """Vòng lặp của worker nền: chờ gom báo cáo, gửi, thử lại vài lượt rồi thoát."""
+    time.sleep(coalesce_window)
+    for _ in range(max_rounds):
+        remaining = flush_outbox(outbox_path, api_base)
+        if not remaining:
+            return 0
+        conn = _connect(outbox_path)
+        try:
+            next_due = conn.execute("SELECT MIN(next_attempt) FROM outbox").fetchone()[0] or time.time()
+        finally:
+            conn.close()
+        time.sleep(min(max(next_due - time.time(), 1), 300))
+    return remaining
+
+
+def start_flush_worker(outbox_path=OUTBOX_FILE):
+    """Khởi động worker gửi tin ở một process tách rời để tool có thể thoát ngay."""
+    global _worker_started
+    if _worker_started:
+        return
+    _worker_started = True
+    os.makedirs(os.path.dirname(outbox_path), exist_ok=True)
+    kwargs = {}
+    if os.name == 'nt':
+        kwargs['creationflags'] = subprocess.DETACHED_PROCESS | subprocess.CREATE_NEW_PROCESS_GROUP
+    else:
+        kwargs['start_new_session'] = True
+    try:
+        with open(WORKER_LOG_FILE, 'a', encoding='utf-8') as log_file:
+            subprocess.Popen(
+                [sys.executable, "-m", "utils.notifier", outbox_path],
+                cwd=PROJECT_ROOT, stdin=subprocess.DEVNULL, stdout=log_file, stderr=subprocess.STDOUT, **kwargs
+            )
+    except OSError as e:
+        print(f"⚠️ Không khởi động được worker gửi Telegram ({e}). Báo cáo vẫn nằm trong outbox.")
+
+
+if __name__ == "__main__":
+    # Worker nền: python -m utils.notifier [đường_dẫn_outbox]
+    from dotenv import load_dotenv
+    load_dotenv(dotenv_path=os.path.join(PROJECT_ROOT, '.env'))
+    sys.exit(1 if run_worker(sys.argv[1] if len(sys.argv) > 1 else OUTBOX_FILE) else 0)
@@ -0,0 +1,404 @@
+# utils/output_encoder.py
+"""
+Encode ảnh output (WebP/JPEG) từ ảnh đã ghép mockup trong bộ nhớ, kèm các biến thể kích thước.
+- Mỗi mockup set có thể khai báo "variants" trong config.json, vd:
+    "variants": [
+        {"suffix": "", "max_side": 0},
+        {"suffix": " 1200", "max_side": 1200},
+        {"suffix": " thumb", "max_side": 400, "quality": 80}
+    ]
+  max_side = cạnh dài tối đa (0 = giữ nguyên cỡ), suffix được chèn trước phần mở rộng của tên file.
+  Không khai báo = chỉ một file cỡ gốc như trước.
+- Các cỡ được dựng theo kim tự tháp: mỗi cỡ nhỏ resize từ cỡ lớn liền trước (không decode lại file đã encode).
+- Các cỡ được encode song song trên một pool luồng dùng chung cho cả process; các file nằm cạnh nhau
+  trong cùng zip/thư mục của mockup set.
+- Chế độ ngân sách byte / ngưỡng chất lượng: "encoding" của mockup set (hoặc defaults["output_encoding"]), vd:
+    "encoding": {"max_bytes": 300000, "min_ssim": 0.97, "min_quality": 60, "max_quality": 90}
+  Quality được dự đoán từ 4 lần encode thử trên bản thu nhỏ (log(byte) nội suy từng đoạn theo quality,
+  hệ số quy đổi sang cỡ thật tự học sau mỗi file), không dò nhị phân bằng các lần encode toàn ảnh.
+  Ngưỡng SSIM được dò trên bản thu nhỏ. Có cả hai thì ngưỡng chất lượng được ưu tiên.
+  Một biến thể có thể ghi đè max_bytes/min_ssim riêng; biến thể có "quality" cố định thì không dự đoán.
+- OutputRenderer: bước đặt tên -> ghép mockup -> băm pixel -> encode dùng chung cho mọi tool.
+"""
+import os
+import threading
+from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import cv2
+from PIL import Image
+
+from utils.event_log import say, DEBUG, WARNING
+from utils.image_processing import compose_mockup
+from utils.output_index import content_digest
+
+DEFAULT_QUALITY = 90
+DEFAULT_MIN_QUALITY = 50
+FULL_SIZE_VARIANT = {"suffix": "", "max_side": 0, "quality": None}
+ENCODE_WORKERS = min(4, os.cpu_count() or 1)
+TRIAL_SIDE = 512               # Cạnh dài của bản thu nhỏ dùng để encode thử
+INITIAL_SCALE_FACTOR = 0.6     # byte thật / (byte thử x tỉ lệ pixel) ban đầu, sau đó tự học (EMA)
+SCALE_FACTOR_SMOOTHING = 0.3
+
+_pool = None
+_pool_lock = threading.Lock()
+_scale_factors = {}            # save_format -> hệ số quy đổi từ bản thử sang cỡ thật
+_scale_lock = threading.Lock()
+
+
+def _encode_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPoolExecutor(max_workers=ENCODE_WORKERS, thread_name_prefix="encode")
+        return _pool
+
+
+def normalize_variants(variants):
+    """Chuẩn hoá danh sách biến thể từ config (bỏ mục lỗi). Rỗng/không khai báo = chỉ cỡ gốc."""
+    if not variants:
+        return [FULL_SIZE_VARIANT]
+    normalized = []
+    for variant in variants:
+        try:
+            normalized.append({
+                "suffix": str(variant.get("suffix", "")),
+                "max_side": max(0, int(variant.get("max_side") or 0)),
+                "quality": int(variant["quality"]) if variant.get("quality") is not None else None,
+                "max_bytes": variant.get("max_bytes"),
+                "min_ssim": variant.get("min_ssim"),
+            })
+        except (AttributeError, TypeError, ValueError):
+            say(f"  - ⚠️ Cảnh báo: Biến thể output không hợp lệ, bỏ qua: {variant}", WARNING)
+    if len({variant["suffix"] for variant in normalized}) != len(normalized):
+        say(f"  - ⚠️ Cảnh báo: Các biến thể output trùng suffix, chỉ giữ cỡ gốc: {variants}", WARNING)
+        return [FULL_SIZE_VARIANT]
+    return normalized or [FULL_SIZE_VARIANT]
+
+
+def variant_filename(final_filename, suffix):
+    """'Tên.webp' + ' 1200' -> 'Tên 1200.webp'."""
+    if not suffix:
+        return final_filename
+    stem, ext = os.path.splitext(final_filename)
+    return f"{stem}{suffix}{ext}"
+
+
+def _target_size(size, max_side):
+    width, height = size
+    longest = max(width, height)
+    if not max_side or longest <= max_side:
+        return size
+    scale = max_side / longest
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+class EncodedFiles(list):
+    """Danh sách [(tên file, bytes)] như trước, kèm thông tin quality/ngân sách của từng file cho sự kiện."""
+
+    def __init__(self, files, details, suffixes=None):
+        super().__init__(files)
+        self.details = details
+        self.suffixes = suffixes or [""] * len(files)
+
+    @property
+    def total_bytes(self):
+        return sum(len(data) for _, data in self)
+
+    def event_fields(self):
+        """Các trường thêm vào output của sự kiện 'image' (xem record.output)."""
+        primary = self.details[0]
+        fields = {"quality": primary["quality"]}
+        if primary.get("max_bytes"):
+            fields["max_bytes"] = primary["max_bytes"]
+        if len(self.details) > 1:
+            fields["files"] = self.details
+        return fields
+
+    def renamed(self, final_filename):
+        """Cùng bytes đã encode, đổi sang tên file của output khác (giữ suffix của từng biến thể)."""
+        files = [(variant_filename(final_filename, suffix), data) for suffix, (_, data) in zip(self.suffixes, self)]
+        details = [dict(detail, file=name) for detail, (name, _) in zip(self.details, files)]
+        return EncodedFiles(files, details, self.suffixes)
+
+
+def _encode(image, save_format, quality, save_params):
+    buffer = BytesIO()
+    image.save(buffer, format=save_format, quality=quality, **save_params)
+    return buffer.getvalue()
+
+
+# --- DỰ ĐOÁN QUALITY THEO NGÂN SÁCH BYTE / NGƯỠNG SSIM ---
+
+def _ssim(gray_a, gray_b):
+    """SSIM trung bình (cửa sổ Gaussian 11x11, sigma 1.5) của hai ảnh xám cùng cỡ."""
+    a, b = gray_a.astype(np.float32), gray_b.astype(np.float32)
+    c1, c2 = (0.01 * 255) ** 2, (0.03 * 255) ** 2
+    blur = lambda x: cv2.GaussianBlur(x, (11, 11), 1.5)
+    mu_a, mu_b = blur(a), blur(b)
+    var_a = blur(a * a) - mu_a * mu_a
+    var_b = blur(b * b) - mu_b * mu_b
+    cov = blur(a * b) - mu_a * mu_b
+    ssim_map = ((2 * mu_a * mu_b + c1) * (2 * cov + c2)) / ((mu_a * mu_a + mu_b * mu_b + c1) * (var_a + var_b + c2))
+    return float(ssim_map.mean())
+
+
+class _QualityPlanner:
+    """Chọn quality cho một ảnh từ các lần encode thử trên bản thu nhỏ (không kèm metadata)."""
+
+    def __init__(self, image, save_format, min_quality, max_quality):
+        self.save_format = save_format
+        self.min_quality, self.max_quality = min_quality, max_quality
+        self.trial = image if max(image.size) <= TRIAL_SIDE else image.reduce(-(-max(image.size) // TRIAL_SIDE))
+        self.pixel_ratio = (image.width * image.height) / (self.trial.width * self.trial.height)
+        self._trial_bytes = {}
+
+    def _trial_encode(self, quality):
+        data = _encode(self.trial, self.save_format, quality, {})
+        self._trial_bytes[quality] = len(data)
+        return data
+
+    def trial_bytes(self, quality):
+        if quality not in self._trial_bytes:
+            self._trial_encode(quality)
+        return self._trial_bytes[quality]
+
+    def _anchors(self):
+        """
+        Các điểm encode thử (quality, log byte): min, giữa, 3/4, max; log(byte) nội suy tuyến tính từng đoạn
+        (đường kích thước cong lên mạnh ở nửa quality cao nên đặt thêm một điểm ở đó).
+        """
+        middle = (self.min_quality + self.max_quality) // 2
+        qualities = sorted({self.min_quality, middle, (middle + self.max_quality) // 2, self.max_quality})
+        return qualities, [float(np.log(self.trial_bytes(quality))) for quality in qualities]
+
+    def predicted_trial_bytes(self, quality):
+        if quality in self._trial_bytes:
+            return float(self._trial_bytes[quality])
+        qualities, log_bytes = self._anchors()
+        return float(np.exp(np.interp(quality, qualities, log_bytes)))
+
+    def quality_for_bytes(self, max_bytes, scale_factor):
+        """Quality cao nhất mà kích thước dự đoán ở cỡ thật không vượt max_bytes."""
+        target = np.log(max(max_bytes / (self.pixel_ratio * scale_factor), 1.0))
+        if target >= np.log(self.trial_bytes(self.max_quality)):
+            return self.max_quality  # Vừa ngân sách ngay ở max_quality: không cần các điểm thử còn lại
+        qualities, log_bytes = self._anchors()
+        # Kích thước tăng theo quality: nội suy ngược trên đoạn chứa target (đoạn phẳng thì lấy đầu đoạn)
+        for (q_lo, q_hi), (log_lo, log_hi) in zip(zip(qualities, qualities[1:]), zip(log_bytes, log_bytes[1:])):
+            if target < log_hi:
+                if log_hi <= log_lo:
+                    return q_lo
+                return max(self.min_quality, int(np.floor(q_lo + (target - log_lo) * (q_hi - q_lo) / (log_hi - log_lo))))
+        return self.min_quality
+
+    def quality_for_ssim(self, min_ssim):
+        """Quality thấp nhất mà bản thử (đã decode) vẫn đạt SSIM >= min_ssim so với bản thử gốc."""
+        reference = np.asarray(self.trial.convert("L"))
+        low, high = self.min_quality, self.max_quality
+        while low < high:
+            middle = (low + high) // 2
+            decoded = Image.open(BytesIO(self._trial_encode(middle))).convert("L")
+            if _ssim(reference, np.asarray(decoded)) >= min_ssim:
+                high = middle
+            else:
+                low = middle + 1
+        return low
+
+
+def _scale_factor(save_format):
+    with _scale_lock:
+        return _scale_factors.get(save_format, INITIAL_SCALE_FACTOR)
+
+
+def _learn_scale_factor(save_format, observed):
+    with _scale_lock:
+        current = _scale_factors.get(save_format, INITIAL_SCALE_FACTOR)
+        _scale_factors[save_format] = current + SCALE_FACTOR_SMOOTHING * (observed - current)
+
+
+def _encode_planned(image, save_format, settings, save_params):
+    """
+    Encode một cỡ: quality cố định, hoặc dự đoán theo ngân sách byte / ngưỡng SSIM.
+    Trả về (bytes, chi tiết). Nếu file thật vẫn vượt ngân sách thì sửa lại đúng một lần với hệ số vừa học.
+    """
+    max_bytes, min_ssim = settings.get("max_bytes"), settings.get("min_ssim")
+    if settings.get("quality") is not None or not (max_bytes or min_ssim):
+        quality = settings.get("quality") or settings.get("max_quality") or DEFAULT_QUALITY
+        return _encode(image, save_format, quality, save_params), {"quality": quality}
+
+    planner = _QualityPlanner(image, save_format, int(settings.get("min_quality", DEFAULT_MIN_QUALITY)),
+                              int(settings.get("max_quality", DEFAULT_QUALITY)))
+    metadata_bytes = sum(len(value) for value in save_params.values() if isinstance(value, (bytes, str)))
+    floor_quality = planner.quality_for_ssim(float(min_ssim)) if min_ssim else planner.min_quality
+    budget = int(max_bytes) - metadata_bytes if max_bytes else None
+
+    quality = planner.max_quality if budget is None else planner.quality_for_bytes(budget, _scale_factor(save_format))
+    if min_ssim:
+        quality = max(floor_quality, quality) if budget is not None else floor_quality
+    data = _encode(image, save_format, quality, save_params)
+
+    if budget is not None:
+        # Hệ số thật của chính ảnh này: dùng để học cho các ảnh sau và để sửa lại (một lần) nếu vượt ngân sách
+        observed = max(len(data) - metadata_bytes, 1) / (planner.predicted_trial_bytes(quality) * planner.pixel_ratio)
+        if planner.pixel_ratio > 1:
+            _learn_scale_factor(save_format, observed)
+        if len(data) > int(max_bytes) and quality > floor_quality:
+            retry_quality = max(floor_quality, min(quality - 1, planner.quality_for_bytes(budget, observed)))
+            quality, data = retry_quality, _encode(image, save_format, retry_quality, save_params)
+
+    detail = {"quality": quality}
+    if max_bytes:
+        detail["max_bytes"] = int(max_bytes)
+    if min_ssim:
+        detail["min_ssim"] = float(min_ssim)
+    return data, detail
+
+
+def encode_variants(image, final_filename, save_format, variants=None, save_params=None, encoding=None):
+    """
+    Encode ảnh đã ghép (RGB) thành các biến thể của mockup set.
+    Trả về EncodedFiles [(tên file, bytes)] theo thứ tự khai báo trong config; save_params (exif/xmp) dùng chung cho mọi cỡ.
+    encoding: cấu hình ngân sách byte / ngưỡng SSIM của mockup set (None = quality cố định như trước).
+    """
+    variants = normalize_variants(variants)
+    save_params = save_params or {}
+    encoding = encoding or {}
+
+    def settings_for(variant):
+        settings = dict(encoding)
+        settings.update({key: variant[key] for key in ("quality", "max_bytes", "min_ssim") if variant.get(key) is not None})
+        return settings
+
+    def finish(results):
+        files, details = [], []
+        for variant, (data, detail) in zip(variants, results):
+            filename = variant_filename(final_filename, variant["suffix"])
+            files.append((filename, data))
+            details.append({"file": filename, "bytes": len(data), **detail})
+        return EncodedFiles(files, details, [variant["suffix"] for variant in variants])
+
+    if len(variants) == 1 and not variants[0]["max_side"]:
+        return finish([_encode_planned(image, save_format, settings_for(variants[0]), save_params)])
+
+    # Kim tự tháp: đi từ cỡ lớn đến cỡ nhỏ, mỗi cỡ resize từ cỡ liền trước; cỡ nào dựng xong thì encode ngay
+    pool = _encode_pool()
+    order = sorted(range(len(variants)), key=lambda i: -(variants[i]["max_side"] or float("inf")))
+    futures, encoded = {}, {}
+    level = image
+    for index in order:
+        variant = variants[index]
+        size = _target_size(image.size, variant["max_side"])
+        if size != level.size:
+            level = level.resize(size, Image.Resampling.LANCZOS)
+        # Ảnh nhỏ hơn max_side của nhiều cỡ: cùng kích thước + cùng cách encode thì dùng lại bytes đã encode
+        settings = settings_for(variant)
+        key = (size, tuple(sorted(settings.items())))
+        if key not in encoded:
+            encoded[key] = pool.submit(_encode_planned, level, save_format, settings, save_params)
+        futures[index] = encoded[key]
+    return finish([futures[index].result() for index in range(len(variants))])
+
+
+# --- ĐẶT TÊN, GHÉP MOCKUP VÀ ENCODE MỘT OUTPUT (DÙNG CHUNG CHO CÁC TOOL) ---
+
+class OutputRenderer:
+    """
+    Dựng một output của mockup set cho một design, dùng chung cho ktbimage/ktbimg/ktbcreator/ktbkrt:
+    - tên file được giữ chỗ TRƯỚC khi render (output_index) để phát hiện trùng tên trong cùng zip/thư mục;
+    - ảnh ghép giống hệt từng pixel với một output đã encode thì không encode lại: bytes cũ được dùng lại
+      dưới tên file của output này (mỗi sản phẩm vẫn có ảnh riêng);
+    - các cỡ của mockup set (variants) được resize nối tiếp từ ảnh đã ghép và encode song song.
+    """
+
+    def __init__(self, output_index, asset_store, metadata_builder, save_format, ext, watermark_dir, font_file):
+        self.output_index = output_index
+        self.asset_store = asset_store
+        self.metadata_builder = metadata_builder
+        self.save_format = save_format
+        self.ext = ext
+        self.watermark_dir = watermark_dir
+        self.font_file = font_file
+
+    def render(self, record, design, mockup_name, mockup_path, mockup_coords, base_name, source, scope,
+               variants=None, encoding=None, watermark_text=None):
+        """
+        Trả về (tên file, EncodedFiles, identical_to); ghi output vào `record` (EventLog.image).
+        identical_to = tên output cũ giống hệt (bytes được dùng lại). EncodedFiles = None chỉ khi output cũ
+        có đúng tên này (cùng nguồn được render lại), tức không có file mới nào cần ghi.
+        """
+        final_filename = self.output_index.reserve_name(scope, base_name, self.ext, source)
+        with record.stage("compose"), self.asset_store.open_image(mockup_path) as mockup_img:
+            image = compose_mockup(design, mockup_img, mockup_coords, watermark_text, self.watermark_dir, self.font_file)
+
+        digest = content_digest(image)
+        identical = self.output_index.find_identical(scope, digest)
+        if identical:
+            identical_to, earlier_files = identical
+            if identical_to == final_filename:
+                record.output(mockup_name, identical_to, identical_to=identical_to)
+                return final_filename, None, identical_to
+            say(f"    - ⏩ Bỏ qua encode: giống hệt '{identical_to}', dùng lại bytes cho '{final_filename}' ({mockup_name}).", DEBUG)
+            encoded_files = earlier_files.renamed(final_filename)
+            record.output(mockup_name, final_filename, size=encoded_files.total_bytes, identical_to=identical_to, **encoded_files.event_fields())
+            return final_filename, encoded_files, identical_to
+
+        metadata_params = self.metadata_builder.save_params(mockup_name, final_filename)
+        with record.stage("encode"):
+            encoded_files = encode_variants(image, final_filename, self.save_format, variants, metadata_params, encoding)
+        self.output_index.record_content(scope, digest, final_filename, encoded_files)
+        record.output(mockup_name, final_filename, size=encoded_files.total_bytes, **encoded_files.event_fields())
+        return final_filename, encoded_files, None
+
+
+# --- PHÂN BỐ KÍCH THƯỚC OUTPUT (BÁO CÁO CUỐI LẦN CHẠY) ---
+
+def size_distribution(run_events):
+    """
+    Phân bố kích thước các file đã encode theo mockup set, từ sự kiện 'image' của lần chạy:
+    {mockup: {"files", "total", "p50", "p90", "max", "over_budget"}}.
+    """
+    sizes, over_budget = {}, {}
+    for event in run_events:
+        if event.get("event") != "image":
+            continue
+        for output in event.get("outputs", []):
+            if output.get("identical_to"):
+                continue
+            mockup = output.get("mockup", "")
+            files = output.get("files") or [{"bytes": output.get("bytes", 0), "max_bytes": output.get("max_bytes")}]
+            for entry in files:
+                sizes.setdefault(mockup, []).append(entry.get("bytes", 0))
+                if entry.get("max_bytes") and entry.get("bytes", 0) > entry["max_bytes"]:
+                    over_budget[mockup] = over_budget.get(mockup, 0) + 1
+    distribution = {}
+    for mockup, values in sizes.items():
+        values = np.array(values)
+        distribution[mockup] = {
+            "files": int(values.size), "total": int(values.sum()),
+            "p50": int(np.percentile(values, 50)), "p90": int(np.percentile(values, 90)), "max": int(values.max()),
+            "over_budget": over_budget.get(mockup, 0),
+        }
+    return distribution
+
+
+def format_size_distribution(distribution):
+    """Các dòng báo cáo (tiếng Anh, cùng kiểu generate.log) cho size_distribution()."""
+    lines = []
+    for mockup, stats in sorted(distribution.items()):
+        line = (f"  - {mockup}: {stats['files']} files, p50 {stats['p50'] / 1024:.0f} KB, "
+                f"p90 {stats['p90'] / 1024:.0f} KB, max {stats['max'] / 1024:.0f} KB, total {stats['total'] / 1048576:.1f} MB")
+        if stats["over_budget"]:
+            line += f", over budget: {stats['over_budget']}"
+        lines.append(line)
+    return lines
+
+
+def print_size_distribution(run_events):
+    """In phân bố kích thước output của lần chạy ra console (các tool không có generate.log)."""
+    lines = format_size_distribution(size_distribution(run_events))
+    if lines:
+        print("\n📦 Kích thước output theo mockup set:")
+        for line in lines:
+            print(line)
@@ -0,0 +1,133 @@
+# utils/output_index.py
+"""
+Chỉ mục tên file output và nội dung ảnh đã render.
+- Giữ chỗ tên file TRƯỚC khi render: nếu hai ảnh nguồn khác nhau ra cùng một tiêu đề
+  (sau clean_title + prefix/suffix) thì ảnh sau được thêm hậu tố cố định suy ra từ nguồn,
+  nên không còn tên trùng trong zip hay file bị ghi đè trong thư mục.
+- Băm pixel của ảnh đã ghép mockup TRƯỚC khi encode: ảnh giống hệt ảnh đã xuất thì dùng lại bytes đã encode.
+- Tuỳ chọn lưu bền (SQLite, mặc định tắt) để cùng một nguồn luôn nhận lại đúng tên cũ giữa các lần chạy;
+  tên không được dùng lại trong max_age_days ngày bị xoá khi mở chỉ mục.
+"""
+import os
+import time
+import sqlite3
+import hashlib
+import itertools
+import threading
+
+from utils.event_log import say, INFO
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+OUTPUT_INDEX_DB_FILE = os.path.join(PROJECT_ROOT, ".output_index", "outputs.db")
+SOURCE_SUFFIX_LENGTH = 6
+DEFAULT_MAX_AGE_DAYS = 30
+
+
+def content_digest(image_pil):
+    """Băm nội dung pixel (kèm mode và kích thước) của ảnh sắp được encode."""
+    digest = hashlib.sha1(f"{image_pil.mode}:{image_pil.size}".encode("utf-8"))
+    digest.update(image_pil.tobytes())
+    return digest.hexdigest()
+
+
+def _source_suffix(source):
+    return hashlib.sha1(source.encode("utf-8")).hexdigest()[:SOURCE_SUFFIX_LENGTH]
+
+
+class OutputIndex:
+    """
+    scope: phạm vi mà tên file phải duy nhất ('<domain>/<mockup>' cho ktbimage/ktbimg, tên mockup cho tool khác).
+    source: định danh ảnh nguồn (URL hoặc tên file input).
+    db_path = None: chỉ dùng trong lần chạy hiện tại; có db_path thì tên đã cấp được dùng chung
+    giữa các lần chạy và giữa các tool (URL bị ktbimage skip sang ktbimg vẫn giữ đúng tên).
+    """
+
+    def __init__(self, tool_name, db_path=None, max_age_days=DEFAULT_MAX_AGE_DAYS):
+        self.tool_name = tool_name
+        self._lock = threading.Lock()
+        self._names = {}     # (scope, tên file viết thường) -> source
+        self._contents = {}  # (scope, digest) -> (tên file, EncodedFiles)
+        self._conn = None
+        if db_path:
+            os.makedirs(os.path.dirname(db_path), exist_ok=True)
+            self._conn = sqlite3.connect(db_path, timeout=30, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            with self._conn:
+                self._conn.execute("""
+                    CREATE TABLE IF NOT EXISTS outputs (
+                        tool TEXT NOT NULL,
+                        scope TEXT NOT NULL,
+                        name_key TEXT NOT NULL,
+                        name TEXT NOT NULL,
+                        source TEXT NOT NULL,
+                        ts REAL NOT NULL,
+                        PRIMARY KEY (scope, name_key)
+                    )
+                """)
+                if max_age_days:
+                    self._conn.execute("DELETE FROM outputs WHERE ts < ?", (time.time() - max_age_days * 86400,))
+
+    @classmethod
+    def from_config(cls, tool_name, config=None):
+        """config = defaults['output_index']: {"persistent" (mặc định False), "max_age_days"}."""
+        config = config or {}
+        db_path = OUTPUT_INDEX_DB_FILE if config.get("persistent", False) else None
+        return cls(tool_name, db_path, config.get("max_age_days", DEFAULT_MAX_AGE_DAYS))
+
+    def _owner_of(self, scope, name_key):
+        owner = self._names.get((scope, name_key))
+        if owner is None and self._conn is not None:
+            row = self._conn.execute(
+                "SELECT source FROM outputs WHERE scope = ? AND name_key = ?",
+                (scope, name_key)
+            ).fetchone()
+            if row:
+                owner = row[0]
+                self._names[(scope, name_key)] = owner
+        return owner
+
+    def reserve_name(self, scope, base_name, ext, source):
+        """
+        Trả về tên file cuối cùng cho ảnh `source` trong `scope`.
+        Chính sách: nguồn đầu tiên giữ tên gốc; nguồn khác trùng tên nhận hậu tố
+        ' <6 ký tự sha1 của nguồn>' (cố định theo nguồn, không phụ thuộc thứ tự); hiếm khi vẫn trùng thì thêm số đếm.
+        So sánh không phân biệt hoa thường (Windows/zip giải nén trên Windows).
+        """
+        suffixed = f"{base_name} {_source_suffix(source)}"
+        with self._lock:
+            for attempt in itertools.count():
+                candidate = base_name if attempt == 0 else (suffixed if attempt == 1 else f"{suffixed} {attempt}")
+                name = f"{candidate}{ext}"
+                name_key = name.lower()
+                owner = self._owner_of(scope, name_key)
+                if owner is None or owner == source:
+                    self._names[(scope, name_key)] = source
+                    if self._conn is not None:
+                        # Dùng lại tên cũ cũng làm mới thời điểm, để tên còn dùng không bị dọn
+                        with self._conn:
+                            self._conn.execute(
+                                "INSERT OR REPLACE INTO outputs (tool, scope, name_key, name, source, ts) VALUES (?, ?, ?, ?, ?, ?)",
+                                (self.tool_name, scope, name_key, name, source, time.time())
+                            )
+                    if candidate != base_name:
+                        say(f"    - 🔀 Tên '{base_name}{ext}' đã được dùng cho ảnh khác, đổi thành '{name}'.", INFO)
+                    return name
+
+    def find_identical(self, scope, digest):
+        """(tên file, các file đã encode) của output trong lần chạy này có nội dung pixel giống hệt, hoặc None."""
+        with self._lock:
+            return self._contents.get((scope, digest))
+
+    def record_content(self, scope, digest, name, encoded_files=None):
+        with self._lock:
+            self._contents.setdefault((scope, digest), (name, encoded_files))
+
+    def forget_contents(self, scope_prefix):
+        """Bỏ các bytes đã giữ để dùng lại của mọi scope bắt đầu bằng `scope_prefix` (vd: domain đã ghi xong)."""
+        with self._lock:
+            for key in [key for key in self._contents if key[0].startswith(scope_prefix)]:
+                del self._contents[key]
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
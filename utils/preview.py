@@ -0,0 +1,146 @@
+# utils/preview.py
+"""
+Chế độ xem trước độ phân giải thấp cho các tool tương tác (ktbimg, ktbcreator, ktbkrt).
+- Sau khi nhập cài đặt (crop, vùng tẩy, góc xoay, posterize...), vài ảnh đầu được chạy qua đúng các bước
+  của tool ở độ phân giải thấp, ghép vào mọi mockup đã chọn và gom thành một contact sheet (JPEG).
+- Người vận hành xem contact sheet rồi chọn chạy toàn bộ hoặc nhập lại cài đặt, thay vì chạy hết
+  cả lô ở độ phân giải đầy đủ mới biết cài đặt sai.
+- Cấu hình: defaults["preview"] = {"enabled", "images", "max_side", "tile_size"}.
+"""
+import os
+import time
+from datetime import datetime
+
+import cv2
+from PIL import Image, ImageDraw, ImageFont
+
+from utils.image_processing import ImageBuffer, compose_mockup
+from utils.event_log import say, WARNING
+
+PREVIEW_DEFAULTS = {"enabled": True, "images": 3, "max_side": 600, "tile_size": 360}
+CAPTION_HEIGHT = 22
+SHEET_BACKGROUND = (40, 40, 40)
+
+
+def preview_settings(config=None):
+    """defaults['preview'] trộn với PREVIEW_DEFAULTS."""
+    settings = dict(PREVIEW_DEFAULTS)
+    settings.update(config or {})
+    return settings
+
+
+def preview_scale(size, max_side):
+    """Tỉ lệ thu nhỏ (<= 1) để cạnh dài của `size` không vượt max_side."""
+    return min(1.0, max_side / max(size[0], size[1], 1))
+
+
+def downscale(image, scale):
+    """Thu nhỏ ImageBuffer (INTER_AREA, giữ vùng dữ liệu thật) hoặc ảnh PIL theo `scale`; scale >= 1 thì giữ nguyên."""
+    if scale >= 1:
+        return image
+    width, height = max(1, round(image.width * scale)), max(1, round(image.height * scale))
+    if isinstance(image, ImageBuffer):
+        pixels = cv2.resize(image.pixels, (width, height), interpolation=cv2.INTER_AREA)
+        x0, y0, x1, y1 = image.valid_box
+        valid_box = (int(x0 * scale), int(y0 * scale), min(width, round(x1 * scale)), min(height, round(y1 * scale)))
+        return ImageBuffer(pixels, valid_box=valid_box, info=image.info)
+    return image.resize((width, height), Image.Resampling.BOX)
+
+
+def scale_box(coords, scale):
+    """Tọa độ {x, y, w, h} theo ảnh gốc -> theo ảnh đã thu nhỏ `scale` lần."""
+    return {key: round(coords[key] * scale) for key in ("x", "y", "w", "h")}
+
+
+def preview_refine_size(refine_size, scale, max_side):
+    """Độ phân giải tinh chỉnh viền cho bản xem trước: theo tỉ lệ thu nhỏ, tối đa 2 lần max_side."""
+    return min(int(refine_size * scale), 2 * max_side) if refine_size else 0
+
+
+class ContactSheet:
+    """Lưới các ảnh xem trước: mỗi hàng một ảnh đầu vào, mỗi cột một mockup; có chú thích dưới từng ô."""
+
+    def __init__(self, tile_size=PREVIEW_DEFAULTS["tile_size"], font_path=None):
+        self.tile_size = tile_size
+        self.rows = []  # [(nhãn hàng, [(nhãn ô, ảnh)])]
+        try:
+            self.font = ImageFont.truetype(font_path, 13) if font_path else ImageFont.load_default()
+        except OSError:
+            self.font = ImageFont.load_default()
+
+    def new_row(self, label):
+        self.rows.append((label, []))
+
+    def add(self, caption, image):
+        """Thêm một ô vào hàng hiện tại (ảnh được thu nhỏ ngay để không giữ ảnh lớn)."""
+        if not self.rows:
+            self.new_row("")
+        tile = image.convert("RGB")
+        tile.thumbnail((self.tile_size, self.tile_size), Image.Resampling.BOX)
+        self.rows[-1][1].append((caption, tile))
+
+    def __len__(self):
+        return sum(len(tiles) for _, tiles in self.rows)
+
+    def save(self, directory, label):
+        """Ghi contact sheet ra '<directory>/preview.<label>.<timestamp>.jpg', trả về đường dẫn."""
+        rows = [(row_label, tiles) for row_label, tiles in self.rows if tiles]
+        columns = max(len(tiles) for _, tiles in rows)
+        cell_w, cell_h = self.tile_size, self.tile_size + CAPTION_HEIGHT
+        sheet = Image.new("RGB", (columns * cell_w, len(rows) * cell_h), SHEET_BACKGROUND)
+        draw = ImageDraw.Draw(sheet)
+        for row_index, (row_label, tiles) in enumerate(rows):
+            for column_index, (caption, tile) in enumerate(tiles):
+                x, y = column_index * cell_w, row_index * cell_h
+                sheet.paste(tile, (x + (cell_w - tile.width) // 2, y + (self.tile_size - tile.height) // 2))
+                text = f"{row_label} | {caption}" if row_label else caption
+                draw.text((x + 4, y + self.tile_size + 4), text[:60], fill=(230, 230, 230), font=self.font)
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, f"preview.{label}.{datetime.now().strftime('%Y%m%d_%H%M%S')}.jpg")
+        sheet.save(path, "JPEG", quality=85)
+        return path
+
+
+def add_mockup_tiles(sheet, design, is_white, mockup_cache, selected_mockups, asset_store, mockup_dir, watermark_dir, font_file):
+    """
+    Ghép design (DesignGeometry / ảnh RGBa) vào từng mockup đã chọn, giống bước compose của lần chạy thật
+    (cùng file mockup ngẫu nhiên đã chọn trong mockup_cache, cùng watermark), rồi thêm vào hàng hiện tại.
+    """
+    for mockup_name in selected_mockups:
+        cached_data = mockup_cache.get(mockup_name)
+        mockup_data = cached_data and (cached_data['white_data'] if is_white else cached_data['black_data'])
+        if not mockup_data or not mockup_data.get('file') or not mockup_data.get('coords'):
+            continue
+        mockup_path = os.path.join(mockup_dir, mockup_data['file'])
+        if not os.path.exists(mockup_path):
+            continue
+        with asset_store.open_image(mockup_path) as mockup_img:
+            composed = compose_mockup(design, mockup_img, mockup_data['coords'], cached_data.get("watermark_text"), watermark_dir, font_file)
+        sheet.add(mockup_name, composed)
+
+
+def preview_and_confirm(render, preview_dir, label, config=None, font_path=None):
+    """
+    Hỏi có xem trước không; có thì gọi render(sheet, settings) để vẽ các ảnh xem trước, ghi contact sheet
+    và hỏi tiếp. Trả về True = chạy toàn bộ với cài đặt hiện tại, False = người dùng muốn nhập lại cài đặt.
+    """
+    settings = preview_settings(config)
+    if not settings.get("enabled", True):
+        return True
+    choice = input(f"▶️ Xem trước {settings['images']} ảnh đầu ở độ phân giải thấp trước khi chạy toàn bộ? (Enter = xem trước, 'n' = chạy luôn): ")
+    if choice.strip().lower() == 'n':
+        return True
+
+    sheet = ContactSheet(settings["tile_size"], font_path)
+    started = time.perf_counter()
+    try:
+        render(sheet, settings)
+    except Exception as e:
+        say(f"  - ⚠️ Lỗi khi dựng bản xem trước: {e}", WARNING)
+    if not len(sheet):
+        print("  - ⚠️ Không dựng được ảnh xem trước nào (kiểm tra lại cài đặt hoặc log phía trên).")
+    else:
+        path = sheet.save(preview_dir, label)
+        print(f"🖼️  Contact sheet ({len(sheet)} ô, {time.perf_counter() - started:.1f}s): {path}")
+    choice = input("▶️ Enter = chạy toàn bộ với cài đặt này, 'r' = nhập lại cài đặt: ")
+    return choice.strip().lower() != 'r'
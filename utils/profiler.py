@@ -0,0 +1,301 @@
+# utils/profiler.py
+"""
+Chế độ profile sâu (--profile) cho các tool.
+- Mỗi ảnh (đơn vị công việc) được đo bằng cProfile, tách theo giai đoạn (tải ảnh, tách nền, ghép mockup, encode...),
+  cùng tracemalloc (đỉnh bộ nhớ Python và các vị trí cấp phát lớn nhất của ảnh đó).
+- Kết quả nằm trong .profile/<tool>.<thời gian>/:
+  + <n>.<ảnh>.prof: pstats của từng ảnh, all.prof: gộp cả lần chạy (mở bằng snakeviz / pstats);
+  + <n>.<ảnh>.txt: thời gian + bảng hotspot của từng giai đoạn, top vị trí cấp phát;
+  + timeline.speedscope.json: dòng thời gian ảnh/giai đoạn theo từng luồng (mở bằng speedscope);
+  + summary.txt: N ảnh chậm nhất kèm URL nguồn và rule, tổng thời gian theo giai đoạn.
+- Khi không bật --profile, image()/stage() chỉ trả về context rỗng (không tốn gì).
+"""
+import io
+import os
+import re
+import sys
+import json
+import time
+import pstats
+import cProfile
+import argparse
+import threading
+import tracemalloc
+from contextlib import contextmanager, nullcontext
+from datetime import datetime
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PROFILE_DIR = os.path.join(PROJECT_ROOT, ".profile")
+
+DEFAULT_TOP_N = 10        # Số ảnh chậm nhất được liệt kê trong summary
+HOTSPOT_ROWS = 15         # Số hàm trong bảng hotspot của mỗi giai đoạn
+ALLOCATION_ROWS = 10      # Số vị trí cấp phát trong báo cáo mỗi ảnh
+TRACEMALLOC_FRAMES = 1   # Chỉ cần dòng cấp phát; nhiều frame hơn làm snapshot chậm đi nhiều
+OTHER_STAGE = "other"     # Phần việc của ảnh không nằm trong giai đoạn nào
+MB = 1024 * 1024
+
+_NULL_CONTEXT = nullcontext()
+
+
+def parse_profile_args(argv=None):
+    """Đọc --profile, --profile-top N, --profile-dir DIR từ dòng lệnh (bỏ qua các tham số khác)."""
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument("--profile", action="store_true")
+    parser.add_argument("--profile-top", type=int, default=DEFAULT_TOP_N)
+    parser.add_argument("--profile-dir", default=PROFILE_DIR)
+    args, _ = parser.parse_known_args(sys.argv[1:] if argv is None else argv)
+    return args
+
+
+def _safe_name(label):
+    return re.sub(r"[^\w.-]+", "_", label).strip("_")[:80] or "image"
+
+
+class _ImageRecord:
+    """Trạng thái profile của ảnh đang xử lý trong một luồng."""
+
+    def __init__(self, index, label, source, rule):
+        self.index = index
+        self.label = label
+        self.source = source
+        self.rule = rule
+        self.profiles = {}        # giai đoạn -> cProfile.Profile
+        self.stage_seconds = {}   # giai đoạn -> thời gian riêng (không tính giai đoạn con)
+        self.stack = []           # các giai đoạn đang mở, phần tử cuối đang chạy
+        self.events = []          # (loại 'O'/'C', tên frame, thời điểm) cho speedscope
+        self.total_seconds = 0.0
+        self.peak_alloc = 0
+        self.files = []
+        self._switched_at = None
+
+
+class ImageProfiler:
+    """Profile theo ảnh; dùng chung cho mọi tool qua ImageProfiler.from_argv(tool_name)."""
+
+    def __init__(self, tool_name, enabled=False, profile_dir=PROFILE_DIR, top_n=DEFAULT_TOP_N):
+        self.tool_name = tool_name
+        self.enabled = enabled
+        self.top_n = top_n
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._records = []
+        self._threads = {}        # tên luồng -> danh sách event
+        self._frames = {}         # tên frame -> chỉ số trong speedscope
+        self._all_stats = None
+        self._cprofile_ok = True
+        self._counter = 0
+        self._started = time.perf_counter()
+        if enabled:
+            self.output_dir = os.path.join(profile_dir, f"{tool_name}.{datetime.now().strftime('%Y%m%d_%H%M%S')}")
+            os.makedirs(self.output_dir, exist_ok=True)
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(TRACEMALLOC_FRAMES)
+            print(f"🔬 Chế độ profile: kết quả sẽ được ghi vào {self.output_dir}")
+
+    @classmethod
+    def from_argv(cls, tool_name, argv=None):
+        args = parse_profile_args(argv)
+        return cls(tool_name, enabled=args.profile, profile_dir=args.profile_dir, top_n=args.profile_top)
+
+    # --- CHUYỂN GIAI ĐOẠN ---
+
+    def _now(self):
+        return time.perf_counter() - self._started
+
+    def _pause(self, record, now):
+        stage = record.stack[-1]
+        record.stage_seconds[stage] = record.stage_seconds.get(stage, 0.0) + (now - record._switched_at)
+        profile = record.profiles.get(stage)
+        if profile is not None:
+            profile.disable()
+
+    def _resume(self, record, now):
+        stage = record.stack[-1]
+        record._switched_at = now
+        if not self._cprofile_ok:
+            return
+        profile = record.profiles.setdefault(stage, cProfile.Profile())
+        try:
+            profile.enable()
+        except ValueError as e:
+            # Python 3.12+: chỉ một profiler hoạt động được tại một thời điểm trong process
+            self._cprofile_ok = False
+            record.profiles.pop(stage, None)
+            print(f"  - ⚠️ Không bật được cProfile ({e}); chỉ đo thời gian và bộ nhớ.")
+
+    # --- API ---
+
+    def image(self, label, source=None, rule=None):
+        """Bao một đơn vị công việc (một ảnh). Không làm gì khi không bật profile."""
+        if not self.enabled:
+            return _NULL_CONTEXT
+        return self._image(label, source, rule)
+
+    @contextmanager
+    def _image(self, label, source, rule):
+        with self._lock:
+            self._counter += 1
+            index = self._counter
+        record = _ImageRecord(index, label, source, rule)
+        self._local.record = record
+        snapshot_before = tracemalloc.take_snapshot()
+        tracemalloc.reset_peak()
+        traced_before = tracemalloc.get_traced_memory()[0]
+        started = self._now()
+        record.events.append(("O", label, started))
+        record.stack.append(OTHER_STAGE)
+        self._resume(record, started)
+        try:
+            yield record
+        finally:
+            now = self._now()
+            self._pause(record, now)  # các giai đoạn con đã tự đóng, chỉ còn OTHER_STAGE
+            record.stack.clear()
+            record.events.append(("C", label, now))
+            record.total_seconds = now - started
+            record.peak_alloc = max(0, tracemalloc.get_traced_memory()[1] - traced_before)
+            self._local.record = None
+            self._finish(record, snapshot_before)
+
+    def stage(self, name):
+        """Đánh dấu một giai đoạn bên trong ảnh hiện tại của luồng này."""
+        if not self.enabled or getattr(self._local, "record", None) is None:
+            return _NULL_CONTEXT
+        return self._stage(name)
+
+    @contextmanager
+    def _stage(self, name):
+        record = self._local.record
+        now = self._now()
+        self._pause(record, now)
+        record.stack.append(name)
+        record.events.append(("O", name, now))
+        self._resume(record, now)
+        try:
+            yield
+        finally:
+            now = self._now()
+            self._pause(record, now)
+            record.stack.pop()
+            record.events.append(("C", name, now))
+            self._resume(record, now)
+
+    def annotate(self, **fields):
+        """Bổ sung thông tin cho ảnh hiện tại (vd: rule=..., source=...)."""
+        record = getattr(self._local, "record", None) if self.enabled else None
+        if record is not None:
+            for key, value in fields.items():
+                setattr(record, key, value)
+
+    # --- GHI KẾT QUẢ ---
+
+    def _stats_for(self, profile):
+        try:
+            return pstats.Stats(profile)
+        except TypeError:
+            return None  # giai đoạn không có dữ liệu
+
+    def _finish(self, record, snapshot_before):
+        base = os.path.join(self.output_dir, f"{record.index:04d}.{_safe_name(record.label)}")
+        stage_stats = {stage: self._stats_for(profile) for stage, profile in record.profiles.items()}
+        stage_stats = {stage: stats for stage, stats in stage_stats.items() if stats is not None}
+
+        allocations = tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, cProfile.__file__),
+            tracemalloc.Filter(False, pstats.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap*"),
+        )).compare_to(snapshot_before, "lineno")
+        allocations = [diff for diff in allocations if diff.size_diff > 0][:ALLOCATION_ROWS]
+
+        lines = [
+            f"Ảnh: {record.label}",
+            f"Nguồn: {record.source or '-'} | Rule: {record.rule or '-'}",
+            f"Tổng: {record.total_seconds:.3f}s | Đỉnh cấp phát Python: {record.peak_alloc / MB:.1f} MB",
+            "", "--- Thời gian theo giai đoạn ---",
+        ]
+        for stage, seconds in sorted(record.stage_seconds.items(), key=lambda item: -item[1]):
+            share = seconds / record.total_seconds * 100 if record.total_seconds else 0
+            lines.append(f"  {stage:<20} {seconds:>9.3f}s {share:>6.1f}%")
+        for stage, stats in sorted(stage_stats.items(), key=lambda item: -record.stage_seconds.get(item[0], 0)):
+            buffer = io.StringIO()
+            stats.stream = buffer
+            stats.sort_stats("cumulative").print_stats(HOTSPOT_ROWS)
+            lines += ["", f"--- Hotspot: {stage} ---", buffer.getvalue().strip()]
+        lines += ["", "--- Top vị trí cấp phát (tăng thêm trong ảnh này) ---"]
+        for diff in allocations:
+            frame = diff.traceback[0]
+            lines.append(f"  {frame.filename}:{frame.lineno}  +{diff.size_diff / MB:.2f} MB ({diff.count_diff:+d} khối)")
+
+        with open(f"{base}.txt", "w", encoding="utf-8") as f:
+            f.write("\n".join(lines) + "\n")
+        record.files.append(f"{base}.txt")
+
+        merged = None
+        for stats in stage_stats.values():
+            merged = stats if merged is None else merged.add(stats)
+        if merged is not None:
+            merged.dump_stats(f"{base}.prof")
+            record.files.append(f"{base}.prof")
+
+        thread_name = threading.current_thread().name
+        with self._lock:
+            if merged is not None:
+                self._all_stats = pstats.Stats(f"{base}.prof") if self._all_stats is None else self._all_stats.add(f"{base}.prof")
+            self._threads.setdefault(thread_name, []).extend(record.events)
+            record.profiles, record.events = {}, []
+            self._records.append(record)
+
+    def _write_speedscope(self, path, end_value):
+        frames = {}
+        profiles = []
+        for thread_name, events in self._threads.items():
+            profile_events = []
+            for kind, name, at in events:
+                frame = frames.setdefault(name, len(frames))
+                profile_events.append({"type": kind, "frame": frame, "at": at})
+            profiles.append({
+                "type": "evented", "name": thread_name, "unit": "seconds",
+                "startValue": 0, "endValue": end_value, "events": profile_events
+            })
+        document = {
+            "$schema": "https://www.speedscope.app/file-format-schema.json",
+            "shared": {"frames": [{"name": name} for name in frames]},
+            "profiles": profiles, "name": f"{self.tool_name} images", "exporter": "ktbproject profiler"
+        }
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(document, f, ensure_ascii=False)
+
+    def close(self):
+        """Ghi summary, all.prof và timeline; gọi một lần khi tool kết thúc."""
+        if not self.enabled:
+            return
+        tracemalloc.stop()
+        end_value = self._now()
+        if self._all_stats is not None:
+            self._all_stats.dump_stats(os.path.join(self.output_dir, "all.prof"))
+        self._write_speedscope(os.path.join(self.output_dir, "timeline.speedscope.json"), end_value)
+
+        stage_totals = {}
+        for record in self._records:
+            for stage, seconds in record.stage_seconds.items():
+                stage_totals[stage] = stage_totals.get(stage, 0.0) + seconds
+        slowest = sorted(self._records, key=lambda record: -record.total_seconds)[:self.top_n]
+
+        lines = [f"--- Profile {self.tool_name}: {len(self._records)} ảnh, {end_value:.1f}s ---", "", "--- Tổng thời gian theo giai đoạn ---"]
+        for stage, seconds in sorted(stage_totals.items(), key=lambda item: -item[1]):
+            lines.append(f"  {stage:<20} {seconds:>9.3f}s")
+        lines += ["", f"--- {len(slowest)} ảnh chậm nhất ---"]
+        for record in slowest:
+            stages = ", ".join(f"{stage} {seconds:.2f}s" for stage, seconds in
+                               sorted(record.stage_seconds.items(), key=lambda item: -item[1])[:3])
+            lines += [
+                f"  {record.total_seconds:>8.3f}s  {record.label}",
+                f"            nguồn: {record.source or '-'} | rule: {record.rule or '-'} | cấp phát đỉnh: {record.peak_alloc / MB:.1f} MB",
+                f"            giai đoạn: {stages}",
+                f"            file: {', '.join(os.path.basename(path) for path in record.files)}",
+            ]
+        summary_path = os.path.join(self.output_dir, "summary.txt")
+        with open(summary_path, "w", encoding="utf-8") as f:
+            f.write("\n".join(lines) + "\n")
+        print(f"🔬 Đã ghi profile ({len(self._records)} ảnh): {summary_path}")
@@ -0,0 +1,265 @@
+# utils/publisher.py
+"""
+Publisher cho các file output: chỉ stage đúng những file mà một lần chạy đã tạo ra
+(dựa trên run manifest), gom nhiều manifest vào một commit, push ở luồng nền và
+giữ lại các manifest thất bại làm hàng đợi retry cho lần chạy sau.
+"""
+import os
+import json
+import time
+import threading
+import subprocess
+from datetime import datetime
+
+PUBLISH_DIR_NAME = ".publish"
+LOCK_STALE_SECONDS = 600
+
+# --- RUN MANIFEST ---
+
+class RunManifest:
+    """Ghi lại danh sách file output mà một lần chạy tạo ra."""
+
+    def __init__(self, tool_name):
+        self.tool_name = tool_name
+        self.paths = []
+
+    def add(self, path):
+        if path and path not in self.paths:
+            self.paths.append(path)
+
+    def extend(self, paths):
+        for path in paths:
+            self.add(path)
+
+    def __len__(self):
+        return len(self.paths)
+
+
+def _to_repo_path(project_root, path):
+    rel_path = os.path.relpath(os.path.abspath(path), project_root)
+    return rel_path.replace(os.sep, '/')
+
+
+def _write_json_atomic(path, data):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, path)
+
+# --- KHÓA GIỮA CÁC PROCESS (các tool có thể chạy song song) ---
+
+class _PublishLock:
+    def __init__(self, lock_path):
+        self.lock_path = lock_path
+        self.fd = None
+
+    def acquire(self, timeout=120):
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                self.fd = os.open(self.lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+                os.write(self.fd, str(os.getpid()).encode('ascii'))
+                return True
+            except FileExistsError:
+                try:
+                    if time.time() - os.path.getmtime(self.lock_path) > LOCK_STALE_SECONDS:
+                        os.remove(self.lock_path)
+                        continue
+                except OSError:
+                    continue
+                if time.monotonic() > deadline:
+                    return False
+                time.sleep(0.5)
+
+    def release(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+            try:
+                os.remove(self.lock_path)
+            except OSError:
+                pass
+
+# --- PUBLISHER ---
+
+class OutputPublisher:
+    """
+    Nhận các manifest từ pipeline và xử lý git ở một luồng nền:
+    - publish() chỉ ghi manifest xuống '.publish/pending' rồi trả về ngay.
+    - Luồng nền gom tất cả manifest đang chờ (kể cả từ lần chạy trước) thành một commit.
+    - Nếu add/commit/push lỗi, manifest được giữ lại để thử lại lần sau.
+    """
+
+    def __init__(self, project_root, tool_name, batch_window=2.0, max_attempts=3, retry_delay=5.0, push=True):
+        self.project_root = os.path.abspath(project_root)
+        self.tool_name = tool_name
+        self.batch_window = batch_window
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.push = push
+        self.publish_dir = os.path.join(self.project_root, PUBLISH_DIR_NAME)
+        self.pending_dir = os.path.join(self.publish_dir, "pending")
+        os.makedirs(self.pending_dir, exist_ok=True)
+        self._wakeup = threading.Event()
+        self._closing = False
+        self._counter = 0
+        self._thread = None
+        self._lock = threading.Lock()  # publish() có thể được gọi từ nhiều luồng xử lý domain
+
+    # --- API cho pipeline ---
+
+    def publish(self, manifest_or_paths, label=None):
+        """Ghi manifest xuống hàng đợi và đánh thức luồng nền. Không bao giờ gọi git ở đây."""
+        paths = manifest_or_paths.paths if isinstance(manifest_or_paths, RunManifest) else list(manifest_or_paths)
+        repo_paths = sorted({_to_repo_path(self.project_root, p) for p in paths if p})
+        if not repo_paths:
+            return None
+        with self._lock:
+            self._counter += 1
+            counter = self._counter
+        now = datetime.now()
+        manifest_name = f"{self.tool_name}.{now.strftime('%Y%m%d_%H%M%S')}.{os.getpid()}.{counter}.json"
+        _write_json_atomic(os.path.join(self.pending_dir, manifest_name), {
+            "tool": self.tool_name,
+            "label": label or self.tool_name,
+            "created": now.strftime('%Y-%m-%d %H:%M:%S'),
+            "paths": repo_paths
+        })
+        print(f"🗂️  Đã ghi manifest {manifest_name} ({len(repo_paths)} file) vào hàng đợi publish.")
+        with self._lock:
+            self._ensure_worker()
+        self._wakeup.set()
+        return manifest_name
+
+    def close(self):
+        """Báo cho luồng nền xử lý nốt hàng đợi rồi dừng. Hàm trả về ngay, không chờ git."""
+        self._closing = True
+        with self._lock:
+            if self._thread is None and self._pending_manifests():
+                self._ensure_worker()
+        self._wakeup.set()
+
+    def flush(self):
+        """Xử lý đồng bộ toàn bộ hàng đợi (dùng cho Push.bat / dòng lệnh)."""
+        return self._publish_pending()
+
+    # --- Luồng nền ---
+
+    def _ensure_worker(self):
+        if self._thread is None:
+            # Không dùng daemon: process sẽ chờ luồng này push xong trước khi thoát,
+            # nhưng pipeline xử lý ảnh thì không phải chờ.
+            self._thread = threading.Thread(target=self._run, name=f"publisher-{self.tool_name}")
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            if not self._closing:
+                self._wakeup.wait()
+                self._wakeup.clear()
+            if not self._closing:
+                # Chờ thêm một chút để gom nhiều manifest vào cùng một commit
+                time.sleep(self.batch_window)
+                self._wakeup.clear()
+            for attempt in range(1, self.max_attempts + 1):
+                if self._publish_pending():
+                    published = True
+                    break
+                if attempt < self.max_attempts:
+                    time.sleep(self.retry_delay * attempt)
+            else:
+                published = False
+                print("⚠️ Publisher: giữ lại các manifest chưa push được để thử lại ở lần chạy sau.")
+            # Khi đóng: xử lý tiếp các manifest được ghi trong lúc lượt trước đang chạy, tới khi hàng đợi trống
+            if self._closing and (not published or not self._pending_manifests()):
+                return
+
+    def _pending_manifests(self):
+        try:
+            return sorted(f for f in os.listdir(self.pending_dir) if f.endswith('.json'))
+        except FileNotFoundError:
+            return []
+
+    def _git(self, args, stdin_data=None, check=True):
+        env = dict(os.environ, GIT_LITERAL_PATHSPECS="1")
+        return subprocess.run(
+            ['git'] + args, cwd=self.project_root, input=stdin_data,
+            capture_output=True, env=env, check=check
+        )
+
+    def _ahead_of_remote(self, branch):
+        """
+        Nhánh có commit chưa push không (vd: lần push trước lỗi). So với upstream, không có thì với origin/<nhánh>;
+        không so được (nhánh chưa có trên remote) thì coi như cần push.
+        """
+        for upstream in ('@{u}', f'origin/{branch}'):
+            result = self._git(['rev-list', '--count', f'{upstream}..HEAD'], check=False)
+            if result.returncode == 0:
+                return int(result.stdout.decode('utf-8').strip() or 0) > 0
+        return True
+
+    def _publish_pending(self):
+        lock = _PublishLock(os.path.join(self.publish_dir, "lock"))
+        if not lock.acquire():
+            print("⚠️ Publisher: không lấy được khóa publish (tool khác đang push).")
+            return False
+        try:
+            manifest_files = self._pending_manifests()
+            if not manifest_files:
+                return True
+
+            all_paths, labels = set(), []
+            for manifest_file in manifest_files:
+                try:
+                    with open(os.path.join(self.pending_dir, manifest_file), 'r', encoding='utf-8') as f:
+                        manifest = json.load(f)
+                except (OSError, json.JSONDecodeError) as e:
+                    print(f"  - ⚠️ Bỏ qua manifest hỏng '{manifest_file}': {e}")
+                    continue
+                all_paths.update(manifest.get("paths", []))
+                labels.append(manifest.get("label", manifest.get("tool", "")))
+
+            existing_paths = sorted(p for p in all_paths if os.path.exists(os.path.join(self.project_root, p)))
+            committed = False
+            pathspec = "\0".join(existing_paths).encode('utf-8')
+
+            if existing_paths:
+                self._git(['add', '--pathspec-from-file=-', '--pathspec-file-nul', '--'], stdin_data=pathspec)
+                # So index với HEAD (không quét working tree) rồi lọc theo đúng các file của manifest
+                staged_output = self._git(['diff', '--cached', '--name-only', '-z']).stdout.decode('utf-8')
+                staged_paths = set(staged_output.split('\0')) & set(existing_paths)
+                if staged_paths:
+                    tools = ", ".join(sorted(set(labels)))
+                    commit_message = f"Update via {tools} - {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}"
+                    self._git(['commit', '-m', commit_message, '--pathspec-from-file=-', '--pathspec-file-nul', '--'],
+                              stdin_data=pathspec)
+                    committed = True
+                    print(f"✅ Publisher: đã commit {len(existing_paths)} file từ {len(manifest_files)} manifest.")
+
+            if self.push:
+                branch = self._git(['rev-parse', '--abbrev-ref', 'HEAD']).stdout.decode('utf-8').strip()
+                if committed or self._ahead_of_remote(branch):
+                    self._git(['push', 'origin', branch])
+                    print(f"✅ Publisher: push lên nhánh '{branch}' thành công.")
+
+            for manifest_file in manifest_files:
+                try:
+                    os.remove(os.path.join(self.pending_dir, manifest_file))
+                except OSError:
+                    pass
+            return True
+        except (subprocess.CalledProcessError, FileNotFoundError) as e:
+            detail = e.stderr.decode('utf-8', 'replace').strip() if getattr(e, 'stderr', None) else e
+            print(f"❌ Publisher: lỗi trong quá trình Git: {detail}")
+            return False
+        finally:
+            lock.release()
+
+
+if __name__ == "__main__":
+    # Xử lý các manifest còn tồn đọng: python -m utils.publisher
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    publisher = OutputPublisher(root, "manual")
+    pending_count = len(publisher._pending_manifests())
+    print(f"🚀 Đang publish {pending_count} manifest còn tồn đọng...")
+    publisher.flush()
@@ -0,0 +1,93 @@
+# utils/scheduler.py
+"""
+Lập lịch xử lý nhiều domain song song cho ktbimage.
+- Các domain chạy đồng thời trong giới hạn số worker chung; domain ưu tiên cao được bắt đầu trước.
+- Hạn chót theo giờ thực (time budget) cho cả lần chạy: hết giờ thì các URL chưa xử lý
+  được ghi vào hàng đợi hoãn (DeferredQueue) và được xử lý đầu tiên ở lần chạy sau.
+- Một domain lỗi/chậm không chặn các domain khác.
+"""
+import os
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+
+class RunDeadline:
+    """Hạn chót của lần chạy. budget_seconds = None/0 nghĩa là không giới hạn."""
+
+    def __init__(self, budget_seconds=None):
+        self.deadline = time.monotonic() + budget_seconds if budget_seconds else None
+
+    def expired(self):
+        return self.deadline is not None and time.monotonic() >= self.deadline
+
+    def remaining(self):
+        return None if self.deadline is None else max(0.0, self.deadline - time.monotonic())
+
+
+class DeferredQueue:
+    """
+    Các URL bị hoãn, lưu mỗi domain một file '<domain>.txt' (mỗi dòng một URL).
+    File chỉ bị xoá/ghi lại sau khi domain đã chạy xong, nên nếu process chết giữa chừng
+    thì lần sau vẫn còn đủ URL.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def _path(self, domain):
+        return os.path.join(self.directory, f"{domain}.txt")
+
+    def domains(self):
+        if not os.path.isdir(self.directory):
+            return []
+        return sorted(os.path.splitext(f)[0] for f in os.listdir(self.directory) if f.endswith(".txt"))
+
+    def load(self, domain):
+        try:
+            with open(self._path(domain), "r", encoding="utf-8") as f:
+                return [line.strip() for line in f if line.strip()]
+        except FileNotFoundError:
+            return []
+
+    def save(self, domain, urls):
+        """Ghi lại danh sách URL còn hoãn của domain (rỗng = xoá file)."""
+        path = self._path(domain)
+        if not urls:
+            if os.path.exists(path):
+                os.remove(path)
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write("\n".join(urls))
+        os.replace(tmp_path, path)
+
+
+def merge_url_lists(*url_lists):
+    """Ghép các danh sách URL, bỏ trùng nhưng giữ thứ tự xuất hiện đầu tiên."""
+    return list(dict.fromkeys(url for urls in url_lists for url in urls))
+
+
+def run_jobs(jobs, worker, max_workers=1, priority_of=None):
+    """
+    Chạy worker(key, payload) cho từng job {key: payload} trong thread pool.
+    Job có priority_of(key) lớn hơn được đưa vào pool trước; cùng độ ưu tiên thì giữ thứ tự ban đầu.
+    Trả về {key: kết quả}; job bị lỗi không làm dừng các job khác (kết quả là None).
+    """
+    keys = list(jobs)
+    if priority_of:
+        keys.sort(key=lambda k: -priority_of(k))  # sort ổn định: giữ thứ tự gốc khi bằng nhau
+
+    results = {}
+    with ThreadPoolExecutor(max_workers=max(1, int(max_workers))) as executor:
+        futures = {executor.submit(worker, key, jobs[key]): key for key in keys}
+        for future in as_completed(futures):
+            key = futures[future]
+            try:
+                results[key] = future.result()
+            except Exception as e:
+                print(f"❌ Lỗi không mong muốn khi xử lý '{key}': {e}")
+                traceback.print_exc()
+                results[key] = None
+    return results